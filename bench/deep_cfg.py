@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Time the reverse post order and the dominators of deep control flow graphs: a loop
+around a row of if/else diamonds, about 2n nodes deep.
+
+Before (run on the parent commit, in a thread with a 512MB stack and the recursion
+limit raised to 1000000) and after the iterative traversals:
+
+    3002 blocks      rpo    0.302s  0.004s    dom_lt  0.009s  0.008s
+    9002 blocks      rpo    3.223s  0.013s    dom_lt  0.048s  0.043s
+    30002 blocks     rpo   39.493s  0.043s    dom_lt  0.244s  0.069s
+    100001 blocks    rpo        -   0.177s    dom_lt      -   0.435s
+
+With the recursion limit of 5000 dcc used to set, the old code failed at 9002 blocks.
+"""
+import argparse
+import time
+
+import dexgen  # noqa: F401, puts the sources on the path
+
+from dex2c.graph import Graph, dom_lt
+
+
+class Node(object):
+    def __init__(self, num):
+        self.id = -1
+        self.num = num
+        self.start = num
+
+
+def ladder(n):
+    graph = Graph()
+    nodes = [Node(i) for i in range(3 * n + 2)]
+    for node in nodes:
+        graph.add_node(node)
+    for k in range(n):
+        head = 3 * k
+        graph.add_edge(nodes[head], nodes[head + 1])
+        graph.add_edge(nodes[head], nodes[head + 2])
+        graph.add_edge(nodes[head + 1], nodes[head + 3])
+        graph.add_edge(nodes[head + 2], nodes[head + 3])
+    graph.add_edge(nodes[3 * n], nodes[0])
+    graph.add_edge(nodes[3 * n], nodes[3 * n + 1])
+    graph.entry = nodes[0]
+    return graph
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('sizes', nargs='*', type=int, default=[1000, 3000, 10000, 33333],
+                        help='numbers of diamonds')
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        graph = ladder(n)
+        start = time.perf_counter()
+        graph.compute_rpo()
+        rpo = time.perf_counter() - start
+        start = time.perf_counter()
+        dom_lt(graph)
+        dom = time.perf_counter() - start
+        print('%6d blocks  rpo %.3fs  dom_lt %.3fs' % (len(graph.nodes), rpo, dom))
+
+
+if __name__ == '__main__':
+    main()
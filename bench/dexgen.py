@@ -0,0 +1,226 @@
+# coding=utf-8
+"""
+Synthetic dex files for the benchmarks: one class `LBench;` of static methods, each
+method given by its code units. The generators below make the shapes of methods that
+are slow to compile, large enough to time.
+"""
+import hashlib
+import logging
+import os
+import struct
+import sys
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from androguard.core.analysis import analysis
+from androguard.core.bytecodes import dvm
+
+CLASS_NAME = 'LBench;'
+
+
+def uleb128(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def shorty(descriptor):
+    return 'L' if descriptor[0] in 'L[' else descriptor
+
+
+class Method(object):
+    def __init__(self, name, ret, params, registers, code):
+        self.name = name
+        self.ret = ret
+        self.params = tuple(params)
+        self.registers = registers
+        self.code = code
+
+    @property
+    def proto(self):
+        return self.ret, self.params
+
+    @property
+    def shorty(self):
+        return ''.join(shorty(t) for t in (self.ret,) + self.params)
+
+
+def build_dex(methods):
+    """
+    Raw dex file of class LBench; with the static `methods`, which do not reference other
+    methods, fields or strings.
+    """
+    methods = sorted(methods, key=lambda m: m.name)
+    types = {CLASS_NAME, 'Ljava/lang/Object;'}
+    protos = set()
+    strings = set()
+    for m in methods:
+        types.add(m.ret)
+        types.update(m.params)
+        protos.add(m.proto)
+        strings.update((m.name, m.shorty))
+    strings = sorted(strings | types)
+    string_index = dict((s, i) for i, s in enumerate(strings))
+    types = sorted(types, key=lambda t: string_index[t])
+    type_index = dict((t, i) for i, t in enumerate(types))
+    protos = sorted(protos, key=lambda p: (type_index[p[0]], [type_index[t] for t in p[1]]))
+    proto_index = dict((p, i) for i, p in enumerate(protos))
+
+    string_ids_off = 0x70
+    type_ids_off = string_ids_off + 4 * len(strings)
+    proto_ids_off = type_ids_off + 4 * len(types)
+    method_ids_off = proto_ids_off + 12 * len(protos)
+    class_defs_off = method_ids_off + 8 * len(methods)
+    data_off = class_defs_off + 32
+
+    data = bytearray()
+    sections = []
+
+    def offset():
+        return data_off + len(data)
+
+    def align():
+        data.extend(b'\0' * (-len(data) % 4))
+
+    code_offs = []
+    sections.append((0x2001, len(methods), offset()))
+    for m in methods:
+        align()
+        code_offs.append(offset())
+        data.extend(struct.pack('<HHHHII', m.registers, len(m.params), 0, 0, 0, len(m.code)))
+        data.extend(struct.pack('<%dH' % len(m.code), *m.code))
+
+    align()
+    type_list_offs = {}
+    type_lists = sorted(set(p[1] for p in protos if p[1]))
+    if type_lists:
+        sections.append((0x1001, len(type_lists), offset()))
+    for params in type_lists:
+        align()
+        type_list_offs[params] = offset()
+        data.extend(struct.pack('<I', len(params)))
+        data.extend(b''.join(struct.pack('<H', type_index[t]) for t in params))
+
+    string_data_offs = []
+    sections.append((0x2002, len(strings), offset()))
+    for s in strings:
+        string_data_offs.append(offset())
+        data.extend(uleb128(len(s)) + s.encode('utf-8') + b'\0')
+
+    class_data_off = offset()
+    sections.append((0x2000, 1, class_data_off))
+    data.extend(uleb128(0) + uleb128(0) + uleb128(len(methods)) + uleb128(0))
+    for i, code_off in enumerate(code_offs):
+        # method indexes are given as differences, all the methods being of the class
+        data.extend(uleb128(1 if i else 0) + uleb128(0x9) + uleb128(code_off))
+
+    align()
+    map_off = offset()
+    sections += [(0, 1, 0), (1, len(strings), string_ids_off), (2, len(types), type_ids_off),
+                 (3, len(protos), proto_ids_off), (5, len(methods), method_ids_off), (6, 1, class_defs_off),
+                 (0x1000, 1, map_off)]
+    sections.sort(key=lambda section: section[2])
+    data.extend(struct.pack('<I', len(sections)))
+    for kind, size, off in sections:
+        data.extend(struct.pack('<HHII', kind, 0, size, off))
+
+    ids = bytearray()
+    for off in string_data_offs:
+        ids.extend(struct.pack('<I', off))
+    for t in types:
+        ids.extend(struct.pack('<I', string_index[t]))
+    for ret, params in protos:
+        name = ''.join(shorty(t) for t in (ret,) + params)
+        ids.extend(struct.pack('<III', string_index[name], type_index[ret], type_list_offs.get(params, 0)))
+    for m in methods:
+        ids.extend(struct.pack('<HHI', type_index[CLASS_NAME], proto_index[m.proto], string_index[m.name]))
+    ids.extend(struct.pack('<8I', type_index[CLASS_NAME], 0x1, type_index['Ljava/lang/Object;'], 0,
+                           0xffffffff, 0, class_data_off, 0))
+
+    header = bytearray(b'dex\n035\0' + b'\0' * 24)
+    header.extend(struct.pack('<20I', data_off + len(data), 0x70, 0x12345678, 0, 0, map_off,
+                              len(strings), string_ids_off, len(types), type_ids_off, len(protos), proto_ids_off,
+                              0, 0, len(methods), method_ids_off, 1, class_defs_off, len(data), data_off))
+    buff = header + ids + data
+    buff[12:32] = hashlib.sha1(bytes(buff[32:])).digest()
+    buff[8:12] = struct.pack('<I', zlib.adler32(bytes(buff[12:])))
+    return bytes(buff)
+
+
+def loop_method(n, name='loop'):
+    """
+    A loop around `n` if/else diamonds on 4 registers: 2n + 3 blocks, and phis at each
+    join.
+    """
+    code = [0x12 | (r << 8) for r in range(4)]
+    start = len(code)
+    for k in range(n):
+        a, b, d = k % 4, (k + 1) % 4, (k + 2) % 4
+        # add-int/lit8 va, vb, 1; if-eqz v14, +3; move vd, va
+        code += [0xd8 | (a << 8), b | (1 << 8), 0x38 | (14 << 8), 3, 0x01 | (d << 8) | (a << 12)]
+    # if-nez v15, start; return v0
+    code += [0x39 | (15 << 8), (start - len(code)) & 0xffff, 0x0f]
+    return Method(name, 'I', ['I', 'I'], 16, code)
+
+
+def chain_method(n, name='chain'):
+    """
+    `n` moves from register to register of a constant returned as a float: its type
+    travels back one move per sweep of the type inference.
+    """
+    code = [0x12]
+    for k in range(n):
+        # move/from16 vk+1, vk
+        code += [0x03, k + 1, k]
+    code += [0x03, 0, n, 0x0f]
+    return Method(name, 'F', [], n + 1, code)
+
+
+def const_method(n, name='const'):
+    """
+    A constant used by `n` additions.
+    """
+    # const/4 v0, 0; n x add-int/2addr v0, v1; return v1
+    return Method(name, 'I', ['I'], 2, [0x12] + [0xb0 | (1 << 8)] * n + [0x0f | (1 << 8)])
+
+
+GENERATORS = {
+    'loop': loop_method,
+    'chain': chain_method,
+    'const': const_method,
+}
+
+
+def parse_spec(spec):
+    """
+    'kind:n' -> method, e.g. 'chain:450'.
+    """
+    kind, _, size = spec.partition(':')
+    if kind not in GENERATORS or not size.isdigit():
+        raise ValueError('bad method %s, expected one of %s followed by :n' % (spec, ', '.join(sorted(GENERATORS))))
+    return GENERATORS[kind](int(size), '%s%s' % (kind, size))
+
+
+def analyze(buff):
+    """
+    The dvm and its Analysis of the raw dex file `buff`.
+    """
+    logging.disable(logging.WARNING)
+    vm = dvm.DalvikVMFormat(buff)
+    dx = analysis.Analysis(vm)
+    dx.create_xref()
+    return vm, dx
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit('usage: %s out.dex kind:n [kind:n ...]' % sys.argv[0])
+    with open(sys.argv[1], 'wb') as fp:
+        fp.write(build_dex([parse_spec(spec) for spec in sys.argv[2:]]))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Time the method filter: the rules searched one by one, as MethodFilter used to, against
+FilterRules, over synthetic method names.
+
+On 333 rules (210 prefix rules, 120 `.*...` rules, 3 others) and 200000 names, the loop
+took 54.9s and FilterRules 3.1s, both accepting the same 83842 names.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dcc import FilterRules
+
+
+def make_names(packages, count):
+    names = []
+    for _ in range(count):
+        method = random.choice(['onCreate', 'run', 'get', 'set', '<init>', '<clinit>', 'toString',
+                                'm%d' % random.randrange(300)])
+        names.append('%sC%d;%s(%s)V' % (random.choice(packages), random.randrange(5000), method,
+                                        random.choice(['', 'I', 'Landroid/os/Bundle;', 'Ljava/lang/String;I'])))
+    return names
+
+
+def make_rules(packages):
+    rules = ['^%sC%d;.*' % (random.choice(packages), random.randrange(5000)) for _ in range(200)]
+    rules += ['^%s' % p for p in random.sample(packages, 10)]
+    rules += ['.*;m%d\\(.*' % random.randrange(300) for _ in range(80)]
+    rules += ['.*C%d;onCreate\\(Landroid/os/Bundle;.*' % random.randrange(5000) for _ in range(40)]
+    rules += ['(C1)2;run\\(\\)', '<clinit|init>', '.*;get\\(I\\)V$']
+    return rules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--names', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    packages = ['Lcom/%s/%s/' % (a, b)
+                for a in ('foo', 'bar', 'baz', 'acme', 'example', 'google', 'android', 'kotlin')
+                for b in ('app', 'ui', 'net', 'util', 'data', 'core', 'io', 'model')]
+    names = make_names(packages, args.names)
+    rules = make_rules(packages)
+    print('%d rules, %d names' % (len(rules), len(names)))
+
+    compiled = [re.compile(rule) for rule in rules]
+    start = time.time()
+    old = [any(rule.search(name) for rule in compiled) for name in names]
+    t_old = time.time() - start
+
+    start = time.time()
+    filter_rules = FilterRules(rules)
+    new = [filter_rules.search(name) is not None for name in names]
+    t_new = time.time() - start
+
+    assert old == new
+    print('%d matched; loop %.2fs, FilterRules %.2fs (%.1fx)' % (sum(old), t_old, t_new, t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
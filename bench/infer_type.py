@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Time the type inference of synthetic methods, best of a few compilations.
+
+Before (run on the parent commit, with a raised recursion limit) and after the
+worklist driven inference, best of 5:
+
+    loop:3000    6003 blocks, settles in 3 sweeps   0.061s  0.062s
+    chain:250    250 moves                          0.070s  0.003s
+    chain:450    450 moves                          0.226s  0.006s
+
+The md5 of the generated code is printed to check that it does not change.
+"""
+import argparse
+import hashlib
+
+from dexgen import analyze, build_dex, parse_spec
+
+from dex2c.compiler import Dex2C
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('methods', nargs='*', default=['loop:3000', 'chain:250', 'chain:450'],
+                        help='methods to compile, as kind:n (see dexgen.py)')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    vm, dx = analyze(build_dex([parse_spec(spec) for spec in args.methods]))
+    compiler = Dex2C([vm], dx, False)
+    for m in vm.get_methods():
+        best = None
+        for _ in range(args.runs):
+            stats = {}
+            code, _ = compiler.get_source_method(m, stats)
+            best = stats['infer_type'] if best is None else min(best, stats['infer_type'])
+        print('%-12s %6d blocks %6d instructions  infer_type %.3fs  %s' % (
+            m.get_name(), stats['blocks'], stats['instructions'], best, hashlib.md5(code.encode()).hexdigest()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Measure the memory held by the IR of methods, in bytes per IR instruction: the IR of
+every method is built once to fill the caches of androguard, then built again and kept
+while tracemalloc counts the memory allocated.
+
+Before (run on the parent commit) and after the slots and the lazily allocated sets:
+
+    468 methods (1401 instructions)     3395  2257 bytes per instruction
+    6018 methods (18051 instructions)   3386  2250
+    loop:1000 (3005 instructions)       4032  2650
+"""
+import argparse
+import gc
+import tracemalloc
+
+from dexgen import analyze, build_dex, parse_spec
+
+from androguard.core.analysis import analysis
+from androguard.core.bytecodes import dvm
+from dex2c.compiler import IrBuilder
+
+
+def load(inputs):
+    specs = [spec for spec in inputs if not spec.endswith('.dex')]
+    vms = []
+    dx = None
+    if specs:
+        vm, dx = analyze(build_dex([parse_spec(spec) for spec in specs]))
+        vms.append(vm)
+    for path in inputs:
+        if path.endswith('.dex'):
+            with open(path, 'rb') as fp:
+                vm = dvm.DalvikVMFormat(fp.read())
+            vms.append(vm)
+            if dx is None:
+                dx = analysis.Analysis(vm)
+            else:
+                dx.add(vm)
+    dx.create_xref()
+    return vms, dx
+
+
+def build_all(methods, dx):
+    kept = []
+    for m in methods:
+        builder = IrBuilder(dx.get_method(m), False)
+        try:
+            irmethod = builder.process()
+        except Exception:
+            continue
+        if irmethod is not None:
+            irmethod.writer = None
+            kept.append(builder)
+    return kept
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('inputs', nargs='*', default=['loop:1000'],
+                        help='dex files, or methods to generate as kind:n (see dexgen.py)')
+    args = parser.parse_args()
+
+    vms, dx = load(args.inputs)
+    methods = [m for vm in vms for m in vm.get_methods() if m.get_code()]
+    build_all(methods, dx)
+
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    kept = build_all(methods, dx)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    instructions = sum(builder.stats['instructions'] for builder in kept)
+    phis = sum(builder.stats['phis'] for builder in kept)
+    print('%d methods, %d instructions, %d phis: %d bytes, %.0f bytes per instruction' % (
+        len(kept), instructions, phis, used, used / max(1, instructions)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Time the SSA cleanup passes of IrBuilder on synthetic methods.
+
+Before (run on the parent commit, with a raised recursion limit) and after the use
+lists keyed by user and the worklist of trivial phis:
+
+    loop:2500    5003 blocks    remove_trivial_phi          2.268s  0.051s
+    const:8000   8000 uses      hack_polymorphic_constant   6.142s  0.042s
+
+The md5 of the generated code is printed to check that it does not change.
+"""
+import argparse
+import hashlib
+import time
+
+from dexgen import analyze, build_dex, parse_spec
+
+from dex2c.compiler import IrBuilder
+
+PASSES = ('remove_trivial_phi', 'hack_polymorphic_constant', 'build')
+
+times = {}
+
+
+def timed(name):
+    run = getattr(IrBuilder, name)
+
+    def wrapper(self, *args):
+        start = time.perf_counter()
+        result = run(self, *args)
+        times[name] = time.perf_counter() - start
+        return result
+
+    setattr(IrBuilder, name, wrapper)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('methods', nargs='*', default=['loop:2500', 'const:8000'],
+                        help='methods to compile, as kind:n (see dexgen.py)')
+    args = parser.parse_args()
+
+    for name in PASSES:
+        timed(name)
+    vm, dx = analyze(build_dex([parse_spec(spec) for spec in args.methods]))
+    for m in vm.get_methods():
+        times.clear()
+        builder = IrBuilder(dx.get_method(m), False)
+        irmethod = builder.process()
+        print('%-12s %6d blocks %6d phis  %s  %s' % (
+            m.get_name(), builder.stats['blocks'], builder.stats['phis'],
+            '  '.join('%s %.3fs' % (name, times.get(name, 0.0)) for name in PASSES),
+            hashlib.md5(irmethod.get_source().encode()).hexdigest()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,55 @@
 #!/usr/bin/env python
 # coding=utf-8
 import argparse
+import filecmp
+import hashlib
 import logging
+import multiprocessing
 import os
 import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import json
+import zipfile
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from androguard.core import androconf
 from androguard.core.analysis import analysis
 from androguard.core.androconf import show_logging
 from androguard.core.bytecodes import apk, dvm
 from androguard.util import read
+from dex2c.cache import CompileCache, method_cache_key
 from dex2c.compiler import Dex2C
+from dex2c.cost import write_jni_report
+from dex2c.distributed import Coordinator, get_authkey, parse_address, run_worker
+from dex2c.patcher import patch_native_methods
+from dex2c.profiling import CompileProfile, cache_counters, cache_stats, make_report, write_report
+from dex2c.repack import ApkRepacker, NewEntry
+from dex2c.server import DccServer, request
+from dex2c.signer import ApkSigner
+from dex2c.stages import StageExecutor, WarmupBuilder
+from dex2c.supervisor import Supervisor
 from dex2c.util import JniLongName, get_method_triple, get_access_method, is_synthetic_method, is_native_method
 
 APKTOOL = 'tools/apktool.jar'
-SIGNJAR = 'tools/signapk.jar'
 NDKBUILD = 'ndk-build'
 LIBNATIVECODE = 'libnc.so'
+UNITY_SOURCE = 'unity_%04d.cpp'
+SOURCE_HEADER = '#include "Dex2C.h"\n'
+UNITY_SOURCE_RE = re.compile(r'^unity_\d{4}\.cpp$')
+
+# What to do with the methods above --max-jni-density
+JNI_POLICY_REFUSE = 'refuse'
+JNI_POLICY_WARN = 'warn'
+# jni_verdict results
+JNI_OK = 'ok'
+JNI_WARN = 'warn'
+JNI_REFUSED = 'refused'
 
 logger = logging.getLogger('dcc')
 
@@ -60,6 +88,7 @@ def clean_temp_files():
             shutil.rmtree(name)
         else:
             os.unlink(name)
+    del tempfiles[:]
 
 
 class ApkTool(object):
@@ -76,47 +105,324 @@ class ApkTool(object):
         return unsiged_apk
 
 
-def sign(unsigned_apk, signed_apk):
+def get_min_sdk_version(apk_obj):
+    try:
+        return int(apk_obj.get_min_sdk_version())
+    except (TypeError, ValueError):
+        return None
+
+
+def sign_repacked(repacker, signed_apk, min_sdk_version=None):
     pem = os.path.join('tests/testkey/testkey.x509.pem')
     pk8 = os.path.join('tests/testkey/testkey.pk8')
-    logger.info("signing %s -> %s" % (unsigned_apk, signed_apk))
-    subprocess.check_call(['java', '-jar', SIGNJAR, pem, pk8, unsigned_apk, signed_apk])
+    logger.info("signing %s -> %s" % (repacker.src_path, signed_apk))
+    ApkSigner(pk8, pem).sign(repacker, signed_apk, min_sdk_version)
+
+
+def sign(unsigned_apk, signed_apk):
+    sign_repacked(ApkRepacker(unsigned_apk, drop=is_signature_file), signed_apk,
+                  get_min_sdk_version(apk.APK(unsigned_apk)))
+
+
+# ABIs the NDK can build, an app's armeabi libraries are served by armeabi-v7a
+NDK_ABIS = ('armeabi-v7a', 'arm64-v8a', 'x86', 'x86_64')
+
+
+def default_abis(project_dir):
+    """
+    The APP_ABI list of the project's Application.mk.
+    """
+    abis = []
+    with open(os.path.join(project_dir, 'jni', 'Application.mk')) as fp:
+        for line in fp:
+            line = line.split('#', 1)[0].strip()
+            m = re.match(r'APP_ABI\s*:?=\s*(.*)', line)
+            if m:
+                abis = m.group(1).split()
+    return abis
+
+
+def target_abis(apkfile, project_dir):
+    """
+    ABIs to build: those the app ships native libraries for, or the default ones of the
+    project if it has none.
+    """
+    abis = []
+    if is_apk(apkfile):
+        for abi in sorted(get_apk_abis(apkfile)):
+            if abi == 'armeabi':
+                abi = 'armeabi-v7a'
+            if abi not in NDK_ABIS:
+                logger.warning('ABI %s can not be built' % abi)
+                continue
+            if abi not in abis:
+                abis.append(abi)
+    return abis or default_abis(project_dir)
+
+
+def ndk_build_command(project_dir, num_processes=0, compiler_launcher=None, keep_going=False, abi=None):
+    cmd = [NDKBUILD, '-j%d' % (num_processes or cpu_count()), '-C', project_dir]
+    if keep_going:
+        cmd.append('-k')
+    if compiler_launcher:
+        # see project/jni/Android.mk
+        cmd.append('DCC_COMPILER_LAUNCHER=%s' % compiler_launcher)
+    if abi:
+        # ndk-build removes the libraries of the ABIs it does not build from its output
+        # directory, concurrent builds need one each
+        out_dir = os.path.join(project_dir, 'obj', abi)
+        cmd += ['APP_ABI=%s' % abi, 'NDK_OUT=%s' % out_dir, 'NDK_LIBS_OUT=%s' % os.path.join(out_dir, 'libs')]
+    return cmd
+
+
+def ndk_build_commands(project_dir, abis, num_processes=0, compiler_launcher=None, keep_going=False):
+    """
+    One ndk-build command per ABI, the cores being shared between them.
+    """
+    jobs = max(1, (num_processes or cpu_count()) // len(abis))
+    return [ndk_build_command(project_dir, jobs, compiler_launcher, keep_going, abi) for abi in abis]
+
+
+def build_project(project_dir, num_processes=0, compiler_launcher=None, abis=None):
+    if not abis:
+        subprocess.check_call(ndk_build_command(project_dir, num_processes, compiler_launcher))
+        return
+
+    cmds = ndk_build_commands(project_dir, abis, num_processes, compiler_launcher)
+    logger.info('building %s' % ' '.join(abis))
+    procs = [subprocess.Popen(cmd) for cmd in cmds]
+    failed = [abi for abi, proc in zip(abis, procs) if proc.wait() != 0]
+    if failed:
+        raise Exception('ndk-build failed for %s' % ' '.join(failed))
 
+    libs_dir = os.path.join(project_dir, 'libs')
+    if os.path.exists(libs_dir):
+        # left by a previous build of a persistent project
+        for abi in set(os.listdir(libs_dir)) - set(abis):
+            shutil.rmtree(os.path.join(libs_dir, abi))
 
-def build_project(project_dir, num_processes=0):
-    subprocess.check_call([NDKBUILD, '-j%d' % cpu_count(), '-C', project_dir])
+    for abi in abis:
+        lib_dir = os.path.join(libs_dir, abi)
+        if not os.path.exists(lib_dir):
+            os.makedirs(lib_dir)
+        shutil.copyfile(os.path.join(project_dir, 'obj', abi, 'libs', abi, LIBNATIVECODE),
+                        os.path.join(lib_dir, LIBNATIVECODE))
 
 
-def auto_vm(filename):
+def load_dexes(dexes):
+    """
+    Parse the raw dex files in `dexes`, in this process: sending a parsed dex back from a
+    worker process costs more than parsing it.
+    """
+    return [dvm.DalvikVMFormat(buff) for buff in dexes]
+
+
+def auto_vms(filename):
     ret = androconf.is_android(filename)
     if ret == 'APK':
-        return dvm.DalvikVMFormat(apk.APK(filename).get_dex())
+        return load_dexes(list(apk.APK(filename).get_all_dex()))
     elif ret == 'DEX':
-        return dvm.DalvikVMFormat(read(filename))
+        return [dvm.DalvikVMFormat(read(filename))]
     elif ret == 'DEY':
-        return dvm.DalvikOdexVMFormat(read(filename))
+        return [dvm.DalvikOdexVMFormat(read(filename))]
     raise Exception("unsupported file %s" % filename)
 
 
+def make_analysis(vms):
+    dx = analysis.Analysis()
+    for vm in vms:
+        dx.add(vm)
+    return dx
+
+
+class LoadedDexes(object):
+    """
+    The parsed dex files of an input and their analysis, made on first use. The jobs of
+    a dcc server share them but androguard objects are not thread safe: users hold `lock`.
+    """
+
+    def __init__(self, vms):
+        self.vms = vms
+        self.dx = None
+        self.lock = threading.Lock()
+
+    def analysis(self):
+        if self.dx is None:
+            self.dx = make_analysis(self.vms)
+        return self.dx
+
+
+def dex_digest(filename):
+    """
+    Digest of the dex files of an APK (or of a dex file), which identifies its parsed
+    dex files whatever the resources and the signature.
+    """
+    h = hashlib.sha256()
+    if is_apk(filename):
+        with zipfile.ZipFile(filename) as zf:
+            for name in sorted(zf.namelist()):
+                if re.match(r'^classes\d*\.dex$', name):
+                    h.update(name.encode('utf-8'))
+                    with zf.open(name) as fp:
+                        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                            h.update(chunk)
+    else:
+        with open(filename, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class WarmDexes(object):
+    """
+    The LoadedDexes of the last `size` distinct inputs, so that the variants of an app
+    sharing its code are only parsed and analyzed once.
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, filename):
+        key = dex_digest(filename)
+        with self.lock:
+            dexes = self.entries.get(key)
+            if dexes is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return dexes
+            self.misses += 1
+
+        dexes = LoadedDexes(auto_vms(filename))
+        with self.lock:
+            dexes = self.entries.setdefault(key, dexes)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return dexes
+
+
+_REGEX_META = set('.^$*+?{}[]|()')
+
+
+def literal_prefix_rule(pattern):
+    """
+    If `pattern` is `^literal`, optionally followed by `.*` or `.*$`, return the literal,
+    else None.
+    """
+    if not pattern.startswith('^'):
+        return None
+    body = pattern[1:]
+    for suffix in ('.*$', '.*'):
+        if body.endswith(suffix) and not body.endswith('\\' + suffix):
+            body = body[:-len(suffix)]
+            break
+
+    literal = []
+    i = 0
+    while i < len(body):
+        c = body[i]
+        if c == '\\':
+            if i + 1 >= len(body) or body[i + 1].isalnum():
+                return None
+            literal.append(body[i + 1])
+            i += 2
+        elif c in _REGEX_META:
+            return None
+        else:
+            literal.append(c)
+            i += 1
+    return ''.join(literal)
+
+
+def strip_search_wildcards(pattern):
+    """
+    Drop a leading and a trailing `.*`, which do not change whether `search` matches but
+    make the combined alternation backtrack over the whole name at every position.
+    """
+    if pattern.startswith('.*') and pattern[2:3] not in ('?', '+', '*', '{'):
+        pattern = pattern[2:]
+    if pattern.endswith('.*') and not pattern.endswith('\\.*'):
+        pattern = pattern[:-2]
+    return pattern
+
+
+class FilterRules(object):
+    """
+    A list of filter regexes matched in one pass: `^literal` prefix rules are looked up in
+    per-length sets of prefixes, the other rules are combined into a single alternation
+    tagged with a named group per rule. Rules that can not be combined (rules with groups or
+    backreferences, or inline flags) are searched separately.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.prefixes = {}
+        self.separate = []
+        combined = []
+        for i, pattern in enumerate(self.patterns):
+            rule = re.compile(pattern)
+            prefix = literal_prefix_rule(pattern)
+            if prefix is not None:
+                self.prefixes.setdefault(len(prefix), {}).setdefault(prefix, pattern)
+            elif rule.groups == 0 and not pattern.startswith('(?'):
+                # the empty group after the rule tells which rule matched, a group around
+                # the rule would make the regex engine save its state at every attempt
+                combined.append('(?:%s)(?P<r%d>)' % (strip_search_wildcards(pattern), i))
+            else:
+                self.separate.append(rule)
+        self.prefix_lengths = sorted(self.prefixes)
+        self.combined = re.compile('|'.join(combined)) if combined else None
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def search(self, text):
+        """
+        Return a rule matching `text`, or None.
+        """
+        for length in self.prefix_lengths:
+            pattern = self.prefixes[length].get(text[:length])
+            if pattern is not None:
+                return pattern
+
+        if self.combined is not None:
+            m = self.combined.search(text)
+            if m:
+                return self.patterns[int(m.lastgroup[1:])]
+
+        for rule in self.separate:
+            if rule.search(text):
+                return rule.pattern
+        return None
+
+
 class MethodFilter(object):
-    def __init__(self, configure, vm):
-        self._compile_filters = []
-        self._keep_filters = []
+    def __init__(self, configure, vms, max_jni_density=None, jni_policy=JNI_POLICY_REFUSE):
         self._compile_full_match = set()
+        self.max_jni_density = max_jni_density
+        self.jni_policy = jni_policy
 
         self.conflict_methods = set()
         self.native_methods = set()
         self.annotated_methods = set()
 
         self._load_filter_configure(configure)
-        self._init_conflict_methods(vm)
-        self._init_native_methods(vm)
-        self._init_annotation_methods(vm)
+        self._init_conflict_methods(vms)
+        self._init_native_methods(vms)
+        for vm in vms:
+            self._init_annotation_methods(vm)
 
     def _load_filter_configure(self, configure):
+        self._keep_filters = FilterRules([])
+        self._compile_filters = FilterRules([])
         if not os.path.exists(configure):
             return
 
+        keep_filters = []
+        compile_filters = []
         with open(configure) as fp:
             for line in fp:
                 line = line.strip()
@@ -125,16 +431,19 @@ class MethodFilter(object):
 
                 if line[0] == '!':
                     line = line[1:].strip()
-                    self._keep_filters.append(re.compile(line))
+                    keep_filters.append(line)
                 elif line[0] == '=':
                     line = line[1:].strip()
                     self._compile_full_match.add(line)
                 else:
-                    self._compile_filters.append(re.compile(line))
+                    compile_filters.append(line)
+
+        self._keep_filters = FilterRules(keep_filters)
+        self._compile_filters = FilterRules(compile_filters)
 
-    def _init_conflict_methods(self, vm):
+    def _init_conflict_methods(self, vms):
         all_methods = {}
-        for m in vm.get_methods():
+        for m in (m for vm in vms for m in vm.get_methods()):
             method_triple = get_method_triple(m, return_type=False)
             if method_triple in all_methods:
                 self.conflict_methods.add(m)
@@ -142,8 +451,8 @@ class MethodFilter(object):
             else:
                 all_methods[method_triple] = m
 
-    def _init_native_methods(self, vm):
-        for m in vm.get_methods():
+    def _init_native_methods(self, vms):
+        for m in (m for vm in vms for m in vm.get_methods()):
             cls_name, name, _ = get_method_triple(m)
 
             access = get_access_method(m.get_access_flags())
@@ -205,9 +514,8 @@ class MethodFilter(object):
             return False
 
         full_name = ''.join(method_triple)
-        for rule in self._keep_filters:
-            if rule.search(full_name):
-                return False
+        if self._keep_filters.search(full_name) is not None:
+            return False
 
         if full_name in self._compile_full_match:
             return True
@@ -215,11 +523,56 @@ class MethodFilter(object):
         if method in self.annotated_methods:
             return True
 
-        for rule in self._compile_filters:
-            if rule.search(full_name):
-                return True
+        return self._compile_filters.search(full_name) is not None
+
+    def is_explicit(self, method):
+        """
+        Whether `method` was asked for by its full name or a Dex2C annotation.
+        """
+        return ''.join(get_method_triple(method)) in self._compile_full_match or method in self.annotated_methods
+
+    def jni_verdict(self, method, cost):
+        """
+        What to do with compiled `method` given its JNI `cost`: keep it, keep it with a
+        warning, or leave the method in Java because it would likely get slower. Methods
+        asked for explicitly are only warned about.
+        """
+        if self.max_jni_density is None or cost is None or cost['density'] <= self.max_jni_density:
+            return JNI_OK
+        full_name = ''.join(get_method_triple(method))
+        if self.jni_policy == JNI_POLICY_WARN or self.is_explicit(method):
+            logger.warning("%s: JNI density %.2f above %.2f, compiled anyway" % (
+                full_name, cost['density'], self.max_jni_density))
+            return JNI_WARN
+        logger.info("%s: JNI density %.2f above %.2f, not compiled" % (
+            full_name, cost['density'], self.max_jni_density))
+        return JNI_REFUSED
+
+
+def select_compiled_libs(project_dir, abis):
+    """
+    Map the ABIs of the app to the built libnc.so to ship for each of them.
+    If the app has no native libraries, every ABI that was built is used.
+    """
+    compiled_libs_dir = os.path.join(project_dir, "libs")
+    if not os.path.exists(compiled_libs_dir):
+        return {}
+    if not abis:
+        return dict((abi, os.path.join(compiled_libs_dir, abi, LIBNATIVECODE))
+                    for abi in os.listdir(compiled_libs_dir))
 
-        return False
+    libs = {}
+    for abi in abis:
+        src = os.path.join(compiled_libs_dir, abi)
+        if not os.path.exists(src) and abi == 'armeabi':
+            src = os.path.join(compiled_libs_dir, 'armeabi-v7a')
+            logger.warning('Use armeabi-v7a for armeabi')
+
+        if not os.path.exists(src):
+            raise Exception("ABI %s is not supported!" % abi)
+
+        libs[abi] = os.path.join(src, LIBNATIVECODE)
+    return libs
 
 
 def copy_compiled_libs(project_dir, decompiled_dir):
@@ -231,21 +584,74 @@ def copy_compiled_libs(project_dir, decompiled_dir):
         shutil.copytree(compiled_libs_dir, decompiled_libs_dir)
         return
 
-    for abi in os.listdir(decompiled_libs_dir):
-        dst = os.path.join(decompiled_libs_dir, abi)
-        src = os.path.join(compiled_libs_dir, abi)
-        if not os.path.exists(src) and abi == 'armeabi':
-            src = os.path.join(compiled_libs_dir, 'armeabi-v7a')
-            logger.warning('Use armeabi-v7a for armeabi')
+    for abi, libnc in select_compiled_libs(project_dir, os.listdir(decompiled_libs_dir)).items():
+        shutil.copy(libnc, os.path.join(decompiled_libs_dir, abi))
 
-        if not os.path.exists(src):
-            raise Exception("ABI %s is not supported!" % abi)
 
-        libnc = os.path.join(src, LIBNATIVECODE)
-        shutil.copy(libnc, dst)
+def get_apk_abis(apkfile):
+    """
+    Return {abi: compress type of its native libraries} for the lib/<abi>/ entries of the
+    APK. An ABI is stored if any of its libraries is, as it is then extracted from the APK
+    at runtime rather than at install time.
+    """
+    abis = {}
+    with zipfile.ZipFile(apkfile) as zf:
+        for info in zf.infolist():
+            parts = info.filename.split('/')
+            if len(parts) == 3 and parts[0] == 'lib' and parts[1] and parts[2]:
+                if abis.get(parts[1]) != zipfile.ZIP_STORED:
+                    abis[parts[1]] = info.compress_type
+    return abis
+
+
+def is_signature_file(name):
+    if not name.startswith('META-INF/'):
+        return False
+    name = name.upper()
+    return name == 'META-INF/MANIFEST.MF' or name.endswith(('.SF', '.RSA', '.DSA', '.EC'))
+
+
+def patch_compiled_dexes(apk_obj, vms, compiled_methods):
+    """
+    Flip the compiled methods to native directly in the dex files of the APK.
+    Returns {dex name: patched dex} for the dex files that changed.
+    """
+    dexes = {}
+    for name, vm in zip(apk_obj.get_dex_names(), vms):
+        buff, patched = patch_native_methods(vm, compiled_methods)
+        if patched:
+            logger.info("patched %d methods of %s" % (patched, name))
+            dexes[name] = bytes(buff)
+    return dexes
+
+
+def make_apk_repacker(apkfile, dexes, project_dir):
+    """
+    Repacker for a copy of `apkfile` with the dex files replaced by `dexes` and libnc.so
+    added for the ABIs of the app. Unchanged entries are copied as is.
+    """
+    abis = get_apk_abis(apkfile)
+    libs = select_compiled_libs(project_dir, abis)
+
+    with zipfile.ZipFile(apkfile) as zf:
+        compress_types = dict((info.filename, info.compress_type) for info in zf.infolist())
+
+    replace = {}
+    for name, data in dexes.items():
+        replace[name] = NewEntry(name, data, compress_types.get(name, zipfile.ZIP_DEFLATED))
+    for abi, libnc in libs.items():
+        name = 'lib/%s/%s' % (abi, LIBNATIVECODE)
+        with open(libnc, 'rb') as fp:
+            replace[name] = NewEntry(name, fp.read(), abis.get(abi, zipfile.ZIP_DEFLATED))
+
+    return ApkRepacker(apkfile, replace, drop=is_signature_file)
 
 
 def native_class_methods(smali_path, compiled_methods):
+    """
+    Turn the compiled methods of a smali class into native methods, in a single pass
+    over the file.
+    """
     def next_line():
         return fp.readline()
 
@@ -255,7 +661,7 @@ def native_class_methods(smali_path, compiled_methods):
             if not line:
                 break
             s = line.strip()
-            code_lines.append(line)
+            out.write(line)
             if s == '.end annotation':
                 break
             else:
@@ -270,90 +676,435 @@ def native_class_methods(smali_path, compiled_methods):
             if s == '.end method':
                 break
             elif s.startswith('.annotation runtime') and s.find('Dex2C') < 0:
-                code_lines.append(line)
+                out.write(line)
                 handle_annotanion()
             else:
                 continue
 
-    code_lines = []
     class_name = ''
-    with open(smali_path, 'r') as fp:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(smali_path))
+    with open(smali_path, 'r', encoding='utf-8') as fp, os.fdopen(fd, 'w', encoding='utf-8') as out:
         while True:
             line = next_line()
             if not line:
                 break
-            code_lines.append(line)
-            line = line.strip()
-            if line.startswith('.class'):
-                class_name = line.split(' ')[-1]
-            elif line.startswith('.method'):
-                current_method = line.split(' ')[-1]
+            s = line.strip()
+            if s.startswith('.class'):
+                class_name = s.split(' ')[-1]
+            elif s.startswith('.method'):
+                current_method = s.split(' ')[-1]
                 param = current_method.find('(')
                 name, proto = current_method[:param], current_method[param:]
                 if (class_name, name, proto) in compiled_methods:
-                    if line.find(' native ') < 0:
-                        code_lines[-1] = code_lines[-1].replace(current_method, 'native ' + current_method)
+                    if s.find(' native ') < 0:
+                        line = line.replace(current_method, 'native ' + current_method)
+                    out.write(line)
                     handle_method_body()
-                    code_lines.append('.end method\n')
+                    out.write('.end method\n')
+                    continue
+            out.write(line)
 
-    with open(smali_path, 'w') as fp:
-        fp.writelines(code_lines)
+    os.replace(tmp_path, smali_path)
 
 
-def native_compiled_dexes(decompiled_dir, compiled_methods):
+def native_compiled_dexes(decompiled_dir, compiled_methods, jobs=1):
     # smali smali_classes2 smali_classes3 ...
-    classes_output = list(filter(lambda x: x.find('smali') >= 0, os.listdir(decompiled_dir)))
+    classes_output = sorted(filter(lambda x: x.find('smali') >= 0, os.listdir(decompiled_dir)))
+
+    class_methods = {}
+    for method_triple in compiled_methods:
+        class_methods.setdefault(method_triple[0], set()).add(method_triple)
+
     todo = []
-    for classes in classes_output:
-        for method_triple in compiled_methods.keys():
-            cls_name, name, proto = method_triple
-            cls_name = cls_name[1:-1]  # strip L;
-            smali_path = os.path.join(decompiled_dir, classes, cls_name) + '.smali'
+    for cls_name, methods in class_methods.items():
+        cls_path = cls_name[1:-1]  # strip L;
+        for classes in classes_output:
+            smali_path = os.path.join(decompiled_dir, classes, cls_path) + '.smali'
             if os.path.exists(smali_path):
-                todo.append(smali_path)
+                todo.append((smali_path, methods))
+
+    if jobs > 1 and len(todo) > 1:
+        pool = ThreadPool(min(jobs, len(todo)))
+        try:
+            pool.starmap(native_class_methods, todo)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for smali_path, methods in todo:
+            native_class_methods(smali_path, methods)
+
+
+def write_file_if_changed(filepath, content):
+    """
+    Write `content` to `filepath` unless the file already holds it, so that unchanged
+    sources keep their mtime and are not rebuilt by ndk-build. The file is replaced
+    atomically, the warm-up build may be compiling it meanwhile.
+    """
+    if os.path.exists(filepath):
+        with open(filepath, 'r', encoding='utf-8') as fp:
+            if fp.read() == content:
+                return False
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filepath) or '.')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+            fp.write(content)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filepath)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return True
+
+
+def sync_project_template(project_dir, template_dir='project'):
+    """
+    Bring a persistent project directory up to date with the template, copying only the
+    files that differ. Build outputs (obj/, libs/) are left untouched.
+    """
+    for dirpath, _, filenames in os.walk(template_dir):
+        dst_dir = os.path.join(project_dir, os.path.relpath(dirpath, template_dir))
+        if not os.path.exists(dst_dir):
+            os.makedirs(dst_dir)
+        for name in filenames:
+            src = os.path.join(dirpath, name)
+            dst = os.path.join(dst_dir, name)
+            if os.path.exists(dst) and filecmp.cmp(src, dst, shallow=False):
+                continue
+            # copyfile gives the file a new mtime, so make notices the change
+            shutil.copyfile(src, dst)
 
-    for smali_path in todo:
-        native_class_methods(smali_path, compiled_methods)
 
+def _read_compiled_method_list(filepath):
+    triples = set()
+    if not os.path.exists(filepath):
+        return triples
 
-def write_compiled_methods(project_dir, compiled_methods):
+    with open(filepath, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            cls_end = line.index(';') + 1
+            proto_start = line.index('(', cls_end)
+            triples.add((line[:cls_end], line[cls_end:proto_start], line[proto_start:]))
+    return triples
+
+
+def method_source_path(source_dir, method_triple):
+    return os.path.join(source_dir, JniLongName(*method_triple)) + '.cpp'
+
+
+def write_method_source(source_dir, method_triple, code):
+    return write_file_if_changed(method_source_path(source_dir, method_triple), SOURCE_HEADER + code)
+
+
+def read_method_source(source_dir, method_triple):
+    with open(method_source_path(source_dir, method_triple), 'r', encoding='utf-8') as fp:
+        return fp.read()[len(SOURCE_HEADER):]
+
+
+def unity_units(code_sizes, count=0):
+    """
+    Split the compiled methods, given as {method triple: size of its code}, in `count`
+    translation units (a few per core if 0). Methods of a class stay together, classes
+    are spread over the units largest first so that the units have about the same
+    amount of code.
+    """
+    classes = {}
+    for method_triple in code_sizes:
+        classes.setdefault(method_triple[0], []).append(method_triple)
+
+    if count <= 0:
+        count = cpu_count() * 4
+    count = max(1, min(count, len(classes)))
+
+    sizes = dict((cls_name, sum(code_sizes[t] for t in triples))
+                 for cls_name, triples in classes.items())
+    units = [[] for _ in range(count)]
+    unit_sizes = [0] * count
+    for cls_name in sorted(classes, key=lambda c: (-sizes[c], c)):
+        i = unit_sizes.index(min(unit_sizes))
+        units[i].extend(sorted(classes[cls_name]))
+        unit_sizes[i] += sizes[cls_name]
+    return units
+
+
+def write_compiled_methods(project_dir, compiled_methods, unity=None):
+    """
+    Write a source per compiled method, or with `unity` (a number of units, 0 for auto)
+    the methods concatenated in a few translation units, which saves the compiler the
+    same headers for every method.
+
+    The code of a method is None when compile_dex already wrote its source, unity
+    sources then being made from these files, which are removed.
+    """
     source_dir = os.path.join(project_dir, 'jni', 'nc')
     if not os.path.exists(source_dir):
         os.makedirs(source_dir)
 
-    for method_triple, code in compiled_methods.items():
+    list_file = os.path.join(source_dir, 'compiled_methods.txt')
+
+    # one method per JNI name, the last one wins as when a source is overwritten
+    methods = {}
+    for method_triple in compiled_methods:
         full_name = JniLongName(*method_triple)
-        filepath = os.path.join(source_dir, full_name) + '.cpp'
+        if full_name in methods:
+            logger.warning("Overwrite file %s %s" % (full_name, method_triple))
+        methods[full_name] = method_triple
+
+    def method_code(method_triple):
+        code = compiled_methods[method_triple]
+        if code is None:
+            code = read_method_source(source_dir, method_triple)
+        return code
+
+    # name -> function making the content of the source, None if it is already written.
+    # Unity sources are made one at a time, not to hold all the code in memory.
+    sources = {}
+    streamed = set()
+    if unity is None:
+        for full_name, method_triple in methods.items():
+            code = compiled_methods[method_triple]
+            sources[full_name + '.cpp'] = None if code is None else (lambda code=code: SOURCE_HEADER + code)
+    else:
+        code_sizes = {}
+        for full_name, method_triple in methods.items():
+            code = compiled_methods[method_triple]
+            if code is None:
+                streamed.add(full_name + '.cpp')
+                code_sizes[method_triple] = os.path.getsize(method_source_path(source_dir, method_triple))
+            else:
+                code_sizes[method_triple] = len(code)
+        for i, unit in enumerate(unity_units(code_sizes, unity)):
+            sources[UNITY_SOURCE % i] = lambda unit=unit: SOURCE_HEADER + '\n'.join(method_code(t) for t in unit)
+
+    written = 0
+    for name, content in sources.items():
+        if content is not None:
+            written += write_file_if_changed(os.path.join(source_dir, name), content())
+
+    # Remove the sources generated by a previous run but not by this one
+    previous = set(JniLongName(*t) + '.cpp' for t in _read_compiled_method_list(list_file))
+    previous.update(name for name in os.listdir(source_dir) if UNITY_SOURCE_RE.match(name))
+    for name in (previous | streamed) - set(sources):
+        filepath = os.path.join(source_dir, name)
         if os.path.exists(filepath):
-            logger.warning("Overwrite file %s %s" % (filepath, method_triple))
+            logger.debug("Remove stale file %s" % filepath)
+            os.unlink(filepath)
 
-        with open(filepath, 'w', encoding='utf-8') as fp:
-            fp.write('#include "Dex2C.h"\n' + code)
+    logger.info("%d of %d sources changed (%d methods)" % (written, len(sources), len(compiled_methods)))
 
-    with open(os.path.join(source_dir, 'compiled_methods.txt'), 'w') as fp:
-        fp.write('\n'.join(list(map(''.join, compiled_methods.keys()))))
+    write_file_if_changed(list_file, '\n'.join(list(map(''.join, compiled_methods.keys()))))
 
 
 def archive_compiled_code(project_dir):
     outfile = make_temp_file('-dcc')
-    outfile = shutil.make_archive(outfile, 'zip', project_dir)
+    # only the sources, a persistent build directory also holds ndk-build outputs
+    outfile = shutil.make_archive(outfile, 'zip', project_dir, 'jni')
     return outfile
 
-def compile_dex(apkfile, filtercfg, dynamic_register):
+
+# Per-process compiler state. Workers forked from the parent inherit it; with the
+# 'spawn' start method it is rebuilt by _init_compile_worker.
+_worker_state = {}
+# jobs of a dcc server may start compile pools concurrently
+_worker_state_lock = threading.Lock()
+# Starts the compile processes. A dcc server runs its jobs in threads and forking a
+# threaded process is unsafe, it starts them from a fork server instead.
+_mp_context = multiprocessing.get_context()
+
+
+def _init_compile_worker(apkfile, dynamic_register, with_jni_cost=False):
+    if _worker_state.get('key') == (apkfile, dynamic_register, with_jni_cost):
+        return
+
+    vms = auto_vms(apkfile)
+    dx = make_analysis(vms)
+    _worker_state['key'] = (apkfile, dynamic_register, with_jni_cost)
+    _worker_state['methods'] = [m for vm in vms for m in vm.get_methods()]
+    _worker_state['compiler'] = Dex2C(vms, dx, dynamic_register, with_jni_cost)
+
+
+def _compile_method(compiler, m):
+    """
+    (code, prototype, error, stats) of method `m`, stats being the time spent on the
+    method and the size of its IR.
+    """
+    full_name = ''.join(get_method_triple(m))
+    logger.debug("compiling %s" % (full_name))
+    stats = {}
+    start = time.perf_counter()
+    try:
+        code, prototype = compiler.get_source_method(m, stats)
+    except Exception as e:
+        # a MemoryError has no message
+        reason = str(e) or e.__class__.__name__
+        logger.warning("compile method failed:%s (%s)" % (full_name, reason), exc_info=True)
+        return None, None, '%s:%s' % (full_name, reason), None
+    stats['time'] = time.perf_counter() - start
+    return code, prototype, None, stats
+
+
+def _compile_method_worker(index):
+    m = _worker_state['methods'][index]
+    return _compile_method(_worker_state['compiler'], m)
+
+
+def compile_methods_parallel(apkfile, dynamic_register, indexes, jobs, methods=None, compiler=None,
+                             with_jni_cost=False):
+    """
+    Compile the methods at `indexes` of the methods of all dex files using `jobs` worker processes.
+    Results are yielded in the order of `indexes`.
+    """
+    chunksize = max(1, min(64, len(indexes) // (jobs * 4)))
+    with _worker_state_lock:
+        if compiler is not None:
+            # Let forked workers inherit the parsed dex instead of parsing it again
+            _worker_state['key'] = (apkfile, dynamic_register, with_jni_cost)
+            _worker_state['methods'] = methods
+            _worker_state['compiler'] = compiler
+        pool = _mp_context.Pool(jobs, _init_compile_worker, (apkfile, dynamic_register, with_jni_cost))
+    with pool:
+        for result in pool.imap(_compile_method_worker, indexes, chunksize):
+            yield result
+
+
+def compile_methods_supervised(apkfile, dynamic_register, indexes, jobs, methods, compiler, timeout=None,
+                               memory_limit=None, with_jni_cost=False):
+    """
+    Compile the methods at `indexes` in `jobs` supervised processes. A method taking
+    more than `timeout` seconds or `memory_limit` bytes fails, its process being killed
+    or its allocations refused, and the next methods go on in a new process.
+    Results are yielded in the order of `indexes`.
+    """
+    def failed(index, reason):
+        full_name = ''.join(get_method_triple(methods[index]))
+        logger.warning("compile method failed:%s (%s), left in Java" % (full_name, reason))
+        return None, None, '%s:%s' % (full_name, reason), None
+
+    with _worker_state_lock:
+        _worker_state['key'] = (apkfile, dynamic_register, with_jni_cost)
+        _worker_state['methods'] = methods
+        _worker_state['compiler'] = compiler
+        supervisor = Supervisor(jobs, _compile_method_worker, failed, _init_compile_worker,
+                                (apkfile, dynamic_register, with_jni_cost), timeout, memory_limit, _mp_context)
+        # the first workers are forked while the state is this run's
+        supervisor.start()
+    with supervisor:
+        for result in supervisor.map(indexes):
+            yield result
+
+
+# Parsed dex files of the last runs a distributed worker took part in
+_distributed_state = OrderedDict()
+
+
+def _compile_unit(key, fetch, indexes, loaded):
+    state = _distributed_state.get(key)
+    if state is None:
+        dexes, params = fetch()
+        vms = load_dexes(dexes)
+        methods = [m for vm in vms for m in vm.get_methods()]
+        state = _distributed_state[key] = (methods, Dex2C(vms, make_analysis(vms), params['dynamic_register'],
+                                                          params.get('with_jni_cost', False)))
+        while len(_distributed_state) > 2:
+            _distributed_state.popitem(last=False)
+    _distributed_state.move_to_end(key)
+    methods, compiler = state
+    loaded()
+    return [_compile_method(compiler, methods[index]) for index in indexes]
+
+
+def run_compile_worker(address, authkey):
+    run_worker(address, authkey, _compile_unit)
+
+
+def run_compile_workers(address, jobs):
+    """
+    Compile methods for the coordinator at `address` in `jobs` processes, each keeping
+    its own parsed dex files, until interrupted.
+    """
     show_logging(level=logging.INFO)
+    authkey = get_authkey()
+    if jobs <= 1:
+        run_compile_worker(address, authkey)
+        return
+    procs = [multiprocessing.Process(target=run_compile_worker, args=(address, authkey)) for _ in range(jobs)]
+    for proc in procs:
+        proc.start()
+    try:
+        for proc in procs:
+            proc.join()
+    finally:
+        for proc in procs:
+            proc.terminate()
+
+
+def compile_methods_distributed(address, vms, dynamic_register, indexes, with_jni_cost=False):
+    """
+    Compile the methods at `indexes` on the workers connecting to `address`.
+    Results are yielded in the order of `indexes`.
+    """
+    for vm in vms:
+        if isinstance(vm, dvm.DalvikOdexVMFormat):
+            raise Exception('distributed compilation of odex files is not supported')
+    coordinator = Coordinator(address, [bytes(vm.get_buff()) for vm in vms],
+                              {'dynamic_register': dynamic_register, 'with_jni_cost': with_jni_cost}, get_authkey())
+    coordinator.start()
+    methods = [m for vm in vms for m in vm.get_methods()]
+    names = dict((index, ''.join(get_method_triple(methods[index]))) for index in indexes)
+    try:
+        for result in coordinator.compile(indexes, names):
+            yield result
+    finally:
+        coordinator.close()
+
+
+def compile_dex(apkfile, filtercfg, dynamic_register, jobs=1, cache=None, vms=None, on_compiled=None, dx=None,
+                coordinator=None, profile=None, max_jni_density=None, jni_policy=JNI_POLICY_REFUSE, jni_report=None,
+                keep_code=True, method_timeout=None, method_memory=None):
+    """
+    Compile the methods selected by `filtercfg`. `on_compiled(method_triple, code)` is
+    called as soon as the code of a method is available. With a `coordinator` address,
+    the methods are compiled by the workers connecting to it. The statistics of the
+    compiled methods are added to the CompileProfile `profile`.
+
+    Methods whose JNI density is above `max_jni_density` are left in Java or only
+    warned about, according to `jni_policy`. The JNI cost and verdict of each method
+    are appended to the `jni_report` list.
+
+    Without `keep_code`, the code of a method is only handed to `on_compiled`, and is
+    None in the returned {method triple: code}, so that memory does not grow with the
+    number of compiled methods.
 
-    d = auto_vm(apkfile)
-    dx = analysis.Analysis(d)
+    With a `method_timeout` in seconds or a `method_memory` in bytes, the methods are
+    compiled in supervised processes and a method going over either budget is left in
+    Java, reported with the methods that failed to compile.
+    """
+    if not logging.getLogger().handlers:
+        show_logging(level=logging.INFO)
 
-    method_filter = MethodFilter(filtercfg, d)
+    if vms is None:
+        vms = auto_vms(apkfile)
+    if dx is None:
+        dx = make_analysis(vms)
 
-    compiler = Dex2C(d, dx, dynamic_register)
+    method_filter = MethodFilter(filtercfg, vms, max_jni_density, jni_policy)
+
+    # the JNI cost of a method is only computed when something reads it
+    with_jni_cost = max_jni_density is not None or jni_report is not None
+    compiler = Dex2C(vms, dx, dynamic_register, with_jni_cost)
 
     native_method_prototype = {}
     compiled_method_code = {}
     errors = []
 
-    for m in d.get_methods():
+    # Methods of all dex files, a method is identified by its index in this list
+    methods = [m for vm in vms for m in vm.get_methods()]
+    selected = []
+    for index, m in enumerate(methods):
         method_triple = get_method_triple(m)
 
         jni_longname = JniLongName(*method_triple)
@@ -364,17 +1115,74 @@ def compile_dex(apkfile, filtercfg, dynamic_register):
             continue
 
         if method_filter.should_compile(m):
-            logger.debug("compiling %s" % (full_name))
-            try:
-                code = compiler.get_source_method(m)
-            except Exception as e:
-                logger.warning("compile method failed:%s (%s)" % (full_name, str(e)), exc_info=True)
-                errors.append('%s:%s' % (full_name, str(e)))
-                continue
-
-            if code[0]:
-                compiled_method_code[method_triple] = code[0]
-                native_method_prototype[jni_longname] = code[1]
+            selected.append(index)
+
+    # index -> (compiled, code, prototype, error), the code being dropped unless keep_code
+    outcomes = {}
+
+    def done(index, code, prototype, error, stats, cost):
+        method = methods[index]
+        full_name = ''.join(get_method_triple(method))
+        if profile is not None:
+            profile.add(full_name, stats, error)
+        if error or not code:
+            outcomes[index] = (False, None, None, error)
+            return
+        verdict = method_filter.jni_verdict(method, cost)
+        if jni_report is not None:
+            jni_report.append(dict(cost or {}, method=full_name, verdict=verdict))
+        if verdict == JNI_REFUSED:
+            outcomes[index] = (False, None, None, None)
+            refused.append(index)
+            return
+        if on_compiled:
+            on_compiled(get_method_triple(method), code)
+        outcomes[index] = (True, code if keep_code else None, prototype, None)
+
+    refused = []
+    todo = selected
+    if cache:
+        cache_keys = {}
+        todo = []
+        for index in selected:
+            key = cache_keys[index] = method_cache_key(methods[index], dynamic_register)
+            cached = cache.get(key, with_jni_cost)
+            if cached:
+                code, prototype, cost = cached
+                done(index, code, prototype, None, None, cost)
+            else:
+                todo.append(index)
+
+    if coordinator and todo:
+        logger.info("compiling %d methods on distributed workers" % len(todo))
+        compiled = compile_methods_distributed(coordinator, vms, dynamic_register, todo, with_jni_cost)
+    elif (method_timeout or method_memory) and todo:
+        logger.info("compiling %d methods with %d supervised processes" % (len(todo), min(jobs, len(todo))))
+        compiled = compile_methods_supervised(apkfile, dynamic_register, todo, min(jobs, len(todo)), methods,
+                                              compiler, method_timeout, method_memory, with_jni_cost)
+    elif jobs > 1 and len(todo) > 1:
+        logger.info("compiling %d methods with %d processes" % (len(todo), jobs))
+        compiled = compile_methods_parallel(apkfile, dynamic_register, todo, jobs, methods, compiler, with_jni_cost)
+    else:
+        compiled = (_compile_method(compiler, methods[index]) for index in todo)
+
+    for index, (code, prototype, error, stats) in zip(todo, compiled):
+        cost = stats.get('jni') if stats else None
+        if cache and code and not error:
+            cache.put(cache_keys[index], code, prototype, cost)
+        done(index, code, prototype, error, stats, cost)
+
+    for index in selected:
+        compiled, code, prototype, error = outcomes[index]
+        if error:
+            errors.append(error)
+        elif compiled:
+            method_triple = get_method_triple(methods[index])
+            compiled_method_code[method_triple] = code
+            native_method_prototype[JniLongName(*method_triple)] = prototype
+
+    if refused:
+        logger.info("%d methods left in Java, their JNI density is above %.2f" % (len(refused), max_jni_density))
 
     return compiled_method_code, native_method_prototype, errors
 
@@ -387,8 +1195,7 @@ def write_dummy_dynamic_register(project_dir):
         os.makedirs(source_dir)
 
     filepath = os.path.join(source_dir, 'DynamicRegister.cpp')
-    with open(filepath, 'w', encoding='utf-8') as fp:
-        fp.write('#include "DynamicRegister.h"\n\nconst char *dynamic_register_compile_methods(JNIEnv *env) { return nullptr; }')
+    write_file_if_changed(filepath, '#include "DynamicRegister.h"\n\nconst char *dynamic_register_compile_methods(JNIEnv *env) { return nullptr; }')
 
 def write_dynamic_register(project_dir, compiled_methods, method_prototypes):
     source_dir = os.path.join(project_dir, 'jni', 'nc')
@@ -438,19 +1245,142 @@ def write_dynamic_register(project_dir, compiled_methods, method_prototypes):
 
     # Write DynamicRegister.cpp
     filepath = os.path.join(source_dir, 'DynamicRegister.cpp')
-    with open(filepath, 'w', encoding='utf-8') as fp:
-        fp.write('#include "DynamicRegister.h"\n\n')
-        fp.write('\n'.join(extern_block))
-        fp.write('\n\nconst char *dynamic_register_compile_methods(JNIEnv *env) {')
-        fp.write('\n'.join(export_block))
-        fp.write('}')
-
-def dcc_main(apkfile, filtercfg, outapk, do_compile=True, project_dir=None, source_archive='project-source.zip', dynamic_register=False):
+    write_file_if_changed(filepath, ''.join([
+        '#include "DynamicRegister.h"\n\n',
+        '\n'.join(extern_block),
+        '\n\nconst char *dynamic_register_compile_methods(JNIEnv *env) {',
+        '\n'.join(export_block),
+        '}']))
+
+def setup_project_dir(project_dir, build_dir):
+    if project_dir:
+        if not os.path.exists(project_dir):
+            shutil.copytree('project', project_dir)
+    elif build_dir:
+        # persistent project, ndk-build only recompiles the sources that changed
+        project_dir = build_dir
+        sync_project_template(project_dir)
+    else:
+        project_dir = make_temp_dir('dcc-project-')
+        shutil.rmtree(project_dir)
+        shutil.copytree('project', project_dir)
+    return project_dir
+
+
+def dcc_main(apkfile, filtercfg, outapk, do_compile=True, project_dir=None, source_archive='project-source.zip', dynamic_register=False,
+             jobs=1, cache_dir=None, cache_size=512, build_dir=None, compiler_launcher=None, use_apktool=False,
+             unity=None, warm=None, cache=None, coordinator=None, profile_report=None, max_jni_density=None,
+             jni_policy=JNI_POLICY_REFUSE, jni_report=None, method_timeout=None, method_memory=None):
+    """
+    Protect `apkfile`. A dcc server passes its `warm` WarmDexes and its compile `cache`,
+    which are shared by its jobs. Returns the StageExecutor that ran the stages.
+
+    With `profile_report`, the timings and resource usage of the stages, the statistics
+    of the compiled methods and the cache hit rate are written there as JSON.
+    `jni_report` gets the JNI cost of the compiled methods, see compile_dex for
+    `max_jni_density` and `jni_policy`.
+
+    A method taking more than `method_timeout` seconds or `method_memory` MB to compile
+    is left in Java.
+    """
     if not os.path.exists(apkfile):
         logger.error("file %s is not exists", apkfile)
         return
 
-    compiled_methods, method_prototypes, errors = compile_dex(apkfile, filtercfg, dynamic_register)
+    if cache is None and cache_dir:
+        cache = CompileCache(cache_dir, cache_size * 1024 * 1024)
+
+    profile = CompileProfile() if profile_report else None
+    jni_costs = [] if jni_report else None
+    jni = (max_jni_density, jni_policy, jni_costs)
+    budgets = (method_timeout, method_memory * 1024 * 1024 if method_memory else None)
+    cache_before = cache_counters(cache)
+    stages = StageExecutor()
+    try:
+        _dcc_stages(stages, apkfile, filtercfg, outapk, do_compile, project_dir, source_archive, dynamic_register,
+                    jobs, cache, build_dir, compiler_launcher, use_apktool, unity, warm, coordinator, profile, jni,
+                    budgets)
+    finally:
+        stages.shutdown()
+        stages.report()
+        if profile_report:
+            write_report(profile_report, make_report(apkfile, stages, profile, cache_stats(cache, cache_before)))
+        if jni_report:
+            write_jni_report(jni_report, jni_costs, max_jni_density)
+    return stages
+
+
+def _dcc_stages(stages, apkfile, filtercfg, outapk, do_compile, project_dir, source_archive, dynamic_register,
+                jobs, cache, build_dir, compiler_launcher, use_apktool, unity, warm, coordinator, profile, jni,
+                budgets):
+    """
+    The stages of dcc_main:
+
+        decompile (apktool only) ---------------------------.
+        load -> analyze -> compile -> write -> build -------+-> package
+                                  `-> patch dex / rewrite smali --'
+
+    apktool decompiles while the methods are compiled, and ndk-build already compiles
+    the sources written so far while the remaining methods are being generated.
+    """
+    repack = is_apk(apkfile) and outapk
+    decompile = None
+    if repack and use_apktool:
+        decompile = stages.submit('decompile', ApkTool.decompile, apkfile)
+
+    keep_source_dir = project_dir is not None
+    project_dir = setup_project_dir(project_dir, build_dir)
+
+    source_dir = os.path.join(project_dir, 'jni', 'nc')
+    if not os.path.exists(source_dir):
+        os.makedirs(source_dir)
+
+    abis = target_abis(apkfile, project_dir)
+    logger.info('target ABIs: %s' % ' '.join(abis))
+
+    # The source of each method is written as soon as it is generated, and its code
+    # dropped. The translation units of a unity build are only known once everything
+    # is compiled, they are made from these sources afterwards.
+    warmup = None
+    if unity is None and do_compile and shutil.which(NDKBUILD):
+        warmup = WarmupBuilder(ndk_build_commands(project_dir, abis, max(1, cpu_count() - jobs),
+                                                  compiler_launcher, keep_going=True))
+
+    def on_compiled(method_triple, code):
+        if write_method_source(source_dir, method_triple, code) and warmup:
+            warmup.notify()
+
+    if warm is not None:
+        load = stages.submit('load', warm.load, apkfile)
+    else:
+        load = stages.submit('load', lambda: LoadedDexes(auto_vms(apkfile)))
+
+    def analyze_stage():
+        dexes = load.result()
+        with dexes.lock:
+            dexes.analysis()
+
+    analyzing = stages.submit('analyze', analyze_stage, after=[load])
+
+    def compile_stage():
+        dexes = load.result()
+        try:
+            with dexes.lock:
+                max_jni_density, jni_policy, jni_costs = jni
+                method_timeout, method_memory = budgets
+                return compile_dex(apkfile, filtercfg, dynamic_register, jobs, cache, dexes.vms, on_compiled,
+                                   dexes.analysis(), coordinator, profile, max_jni_density, jni_policy, jni_costs,
+                                   keep_code=False, method_timeout=method_timeout, method_memory=method_memory)
+        finally:
+            if warmup:
+                warmup.stop()
+
+    compiling = stages.submit('compile', compile_stage, after=[analyzing])
+    compiled_methods, method_prototypes, errors = compiling.result()
+
+    if cache:
+        cache.prune()
+        logger.info(cache.summary())
 
     if errors:
         logger.warning('================================')
@@ -461,46 +1391,109 @@ def dcc_main(apkfile, filtercfg, outapk, do_compile=True, project_dir=None, sour
         logger.info("no compiled methods")
         return
 
-    if project_dir:
-        if not os.path.exists(project_dir):
-            shutil.copytree('project', project_dir)
-        write_compiled_methods(project_dir, compiled_methods)
+    def write_stage():
+        write_compiled_methods(project_dir, compiled_methods, unity)
 
         if dynamic_register:
             write_dynamic_register(project_dir, compiled_methods, method_prototypes)
         else:
             write_dummy_dynamic_register(project_dir)
+
+        if not keep_source_dir:
+            src_zip = archive_compiled_code(project_dir)
+            shutil.move(src_zip, source_archive)
+
+    writing = stages.submit('write', write_stage, after=[compiling])
+    building = writing
+    if do_compile:
+        building = stages.submit('build', build_project, project_dir, 0, compiler_launcher, abis, after=[writing])
+
+    if not repack:
+        building.result()
+        return
+
+    if use_apktool:
+        def rewrite_stage():
+            native_compiled_dexes(decompile.result(), compiled_methods, jobs)
+
+        def package_stage():
+            decompiled_dir = decompile.result()
+            copy_compiled_libs(project_dir, decompiled_dir)
+            unsigned_apk = ApkTool.compile(decompiled_dir)
+            sign(unsigned_apk, outapk)
+
+        rewriting = stages.submit('rewrite', rewrite_stage, after=[compiling, decompile])
     else:
-        project_dir = make_temp_dir('dcc-project-')
-        shutil.rmtree(project_dir)
-        shutil.copytree('project', project_dir)
-        write_compiled_methods(project_dir, compiled_methods)
+        apk_obj = apk.APK(apkfile)
 
-        if dynamic_register:
-            write_dynamic_register(project_dir, compiled_methods, method_prototypes)
-        else:
-            write_dummy_dynamic_register(project_dir)
+        def rewrite_stage():
+            dexes = load.result()
+            with dexes.lock:
+                return patch_compiled_dexes(apk_obj, dexes.vms, compiled_methods)
 
-        src_zip = archive_compiled_code(project_dir)
-        shutil.move(src_zip, source_archive)
+        def package_stage():
+            # the APK is repacked and signed in a single write
+            repacker = make_apk_repacker(apkfile, rewriting.result(), project_dir)
+            sign_repacked(repacker, outapk, get_min_sdk_version(apk_obj))
 
-    if do_compile:
-        build_project(project_dir)
+        rewriting = stages.submit('patch', rewrite_stage, after=[compiling])
 
-    if is_apk(apkfile) and outapk:
-        decompiled_dir = ApkTool.decompile(apkfile)
-        native_compiled_dexes(decompiled_dir, compiled_methods)
-        copy_compiled_libs(project_dir, decompiled_dir)
-        unsigned_apk = ApkTool.compile(decompiled_dir)
-        sign(unsigned_apk, outapk)
+    stages.submit('package', package_stage, after=[building, rewriting]).result()
 
 
-sys.setrecursionlimit(5000)
+# Parameters of dcc_main that are paths, made absolute before a job is sent to a server
+JOB_PATH_PARAMS = ('apkfile', 'filtercfg', 'outapk', 'project_dir', 'source_archive', 'cache_dir', 'build_dir',
+                   'profile_report', 'jni_report')
+
+
+def run_server(address, workers=2, cache_mem_size=64):
+    """
+    Serve dcc jobs on `address` until a shutdown request. The parsed dex files of the last
+    inputs and the compile caches stay in memory from one job to the next. Clients need
+    the secret in $DCC_AUTHKEY.
+    """
+    global _mp_context
+    authkey = get_authkey()
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        _mp_context = multiprocessing.get_context('forkserver')
+    else:
+        _mp_context = multiprocessing.get_context('spawn')
+    warm = WarmDexes()
+    caches = {}
+    caches_lock = threading.Lock()
+
+    def run_job(params):
+        params = dict(params)
+        cache_dir = params.get('cache_dir')
+        if cache_dir:
+            with caches_lock:
+                if cache_dir not in caches:
+                    caches[cache_dir] = CompileCache(cache_dir, params.get('cache_size', 512) * 1024 * 1024,
+                                                     cache_mem_size * 1024 * 1024)
+                params['cache'] = caches[cache_dir]
+        stages = dcc_main(warm=warm, **params)
+        return stages.summary() if stages else None
+
+    show_logging(level=logging.INFO)
+    DccServer(address, run_job, authkey, workers, on_idle=clean_temp_files).serve_forever()
+
+
+def print_job_status(status):
+    line = 'job %(id)d %(state)s: %(infile)s (queued %(queued).2fs, wall %(wall).2fs)' % status
+    print(line)
+    result = status.get('result')
+    if result:
+        for name, start, wall in result['stages']:
+            print('    %-12s start %7.2fs  wall %7.2fs' % (name, start, wall))
+        print('    critical path: %s' % ' -> '.join(result['critical_path']))
+    if status.get('error'):
+        print(status['error'])
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('infile', help='Input APK,DEX name')
+    parser.add_argument('infile', nargs='?', help='Input APK,DEX name')
     parser.add_argument('-o', '--out', nargs='?', help='Output APK file name')
     parser.add_argument('--sign', action='store_true', default=False, help='Sign apk')
     parser.add_argument('--filter', default='filter.txt', help='Method filter configure file')
@@ -508,6 +1501,35 @@ if __name__ == '__main__':
     parser.add_argument('--no-build', action='store_true', default=False, help='Do not build the compiled code')
     parser.add_argument('--source-dir', help='The compiled cpp code output directory.')
     parser.add_argument('--project-archive', default='project-source.zip', help='Archive the project directory')
+    parser.add_argument('--use-apktool', action='store_true', default=False,
+                        help='Rewrite the app with apktool instead of patching its dex files')
+    parser.add_argument('--unity', type=int, nargs='?', const=0, metavar='N',
+                        help='Concatenate the generated methods in N translation units, a few per core if N is omitted')
+    parser.add_argument('--build-dir', help='Persistent ndk-build project directory, only changed sources are rebuilt')
+    parser.add_argument('--compiler-launcher', help='Compiler launcher for ndk-build, e.g. ccache')
+    parser.add_argument('--cache-dir', help='Cache the generated code of methods in this directory')
+    parser.add_argument('--cache-size', type=int, default=512, help='Maximum size of the compile cache in MB')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes used to compile methods, 0 means all CPUs')
+    parser.add_argument('--serve', metavar='SOCKET', help='Run a dcc server on this UNIX socket, secret in $DCC_AUTHKEY')
+    parser.add_argument('--server-workers', type=int, default=2, help='Number of jobs a dcc server runs at once')
+    parser.add_argument('--daemon', metavar='SOCKET', help='Send the job to the dcc server on this UNIX socket, secret in $DCC_AUTHKEY')
+    parser.add_argument('--status', action='store_true', default=False, help='Show the jobs of the dcc server given by --daemon')
+    parser.add_argument('--no-wait', action='store_true', default=False, help='Do not wait for the job sent to a dcc server')
+    parser.add_argument('--profile-report', metavar='FILE',
+                        help='Write the time and memory used by each phase and the slowest methods as JSON')
+    parser.add_argument('--max-jni-density', type=float, metavar='D',
+                        help='Leave in Java the methods whose share of JNI calls, weighted by loop depth, is above D')
+    parser.add_argument('--jni-policy', choices=[JNI_POLICY_REFUSE, JNI_POLICY_WARN], default=JNI_POLICY_REFUSE,
+                        help='Leave the methods above --max-jni-density in Java (refuse) or only warn')
+    parser.add_argument('--jni-report', metavar='FILE', help='Write the JNI cost of the compiled methods as JSON')
+    parser.add_argument('--method-timeout', type=float, metavar='SECONDS',
+                        help='Leave in Java the methods taking longer to compile, compiling in supervised processes')
+    parser.add_argument('--method-memory', type=int, metavar='MB',
+                        help='Leave in Java the methods needing more memory to compile, compiling in supervised processes')
+    parser.add_argument('--coordinator', metavar='HOST:PORT',
+                        help='Compile the methods on the workers connecting to HOST:PORT, secret in $DCC_AUTHKEY')
+    parser.add_argument('--worker', metavar='HOST:PORT',
+                        help='Compile methods for the coordinator at HOST:PORT with -j processes, secret in $DCC_AUTHKEY')
 
     args = vars(parser.parse_args())
     infile = args['infile']
@@ -517,6 +1539,14 @@ if __name__ == '__main__':
     do_compile = not args['no_build']
     source_archive = args['project_archive']
     dynamic_register = args['dynamic_register']
+    jobs = args['jobs'] if args['jobs'] > 0 else cpu_count()
+    cache_dir = args['cache_dir']
+    cache_size = args['cache_size']
+    build_dir = args['build_dir']
+    compiler_launcher = args['compiler_launcher']
+    use_apktool = args['use_apktool']
+    unity = args['unity']
+    coordinator = parse_address(args['coordinator']) if args['coordinator'] else None
 
     if args['source_dir']:
         project_dir = args['source_dir']
@@ -537,8 +1567,51 @@ if __name__ == '__main__':
     if 'apktool' in dcc_cfg and os.path.exists(dcc_cfg['apktool']):
         APKTOOL = dcc_cfg['apktool']
 
+    if not compiler_launcher and dcc_cfg.get('compiler_launcher'):
+        compiler_launcher = dcc_cfg['compiler_launcher']
+
+    if args['worker']:
+        run_compile_workers(parse_address(args['worker']), jobs)
+        sys.exit(0)
+
+    if args['serve']:
+        run_server(args['serve'], args['server_workers'])
+        sys.exit(0)
+
+    if args['daemon'] and args['status']:
+        for status in request(args['daemon'], {'cmd': 'status'}, get_authkey())['jobs']:
+            print_job_status(status)
+        sys.exit(0)
+
+    if not infile:
+        parser.error('the following arguments are required: infile')
+
+    if args['daemon']:
+        params = dict(apkfile=infile, filtercfg=filtercfg, outapk=outapk, do_compile=do_compile,
+                      project_dir=project_dir, source_archive=source_archive, dynamic_register=dynamic_register,
+                      jobs=jobs, cache_dir=cache_dir, cache_size=cache_size, build_dir=build_dir,
+                      compiler_launcher=compiler_launcher, use_apktool=use_apktool, unity=unity,
+                      coordinator=coordinator, profile_report=args['profile_report'],
+                      max_jni_density=args['max_jni_density'], jni_policy=args['jni_policy'],
+                      jni_report=args['jni_report'], method_timeout=args['method_timeout'],
+                      method_memory=args['method_memory'])
+        for name in JOB_PATH_PARAMS:
+            if params[name]:
+                params[name] = os.path.abspath(params[name])
+        job = request(args['daemon'], {'cmd': 'submit', 'params': params}, get_authkey())['job']
+        print('job %d submitted' % job)
+        if not args['no_wait']:
+            status = request(args['daemon'], {'cmd': 'wait', 'job': job}, get_authkey())
+            print_job_status(status)
+            sys.exit(0 if status['state'] == 'done' else 1)
+        sys.exit(0)
+
     try:
-        dcc_main(infile, filtercfg, outapk, do_compile, project_dir, source_archive, dynamic_register)
+        dcc_main(infile, filtercfg, outapk, do_compile, project_dir, source_archive, dynamic_register, jobs,
+                 cache_dir, cache_size, build_dir, compiler_launcher, use_apktool, unity, coordinator=coordinator,
+                 profile_report=args['profile_report'], max_jni_density=args['max_jni_density'],
+                 jni_policy=args['jni_policy'], jni_report=args['jni_report'],
+                 method_timeout=args['method_timeout'], method_memory=args['method_memory'])
     except Exception as e:
         logger.error("Compile %s failed!" % infile, exc_info=True)
     finally:
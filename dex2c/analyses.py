@@ -0,0 +1,238 @@
+# encoding=utf8
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from collections import defaultdict
+
+from dex2c.graph import dom_lt
+
+logger = logging.getLogger('dex2c.analyses')
+
+# Names of the analyses
+RPO = 'rpo'
+DOMINATORS = 'dominators'
+LOOPS = 'loops'
+
+# Analyses of the control flow graph only, kept by the passes that do not add or
+# remove blocks or edges
+CFG_ANALYSES = (RPO, DOMINATORS, LOOPS)
+NO_ANALYSES = frozenset()
+
+
+def preserves(*names):
+    """
+    Declare the analyses that a pass leaves valid, all the others are dropped once it
+    has run. A pass declaring nothing preserves nothing.
+    """
+
+    def decorate(func):
+        func.preserves = frozenset(names)
+        return func
+
+    return decorate
+
+
+def reverse_post_order(graph):
+    """
+    The nodes reachable from the entry in reverse post order. Unlike
+    Graph.compute_rpo, the numbers of the nodes are left alone.
+    """
+    nodes = list(graph.post_order())
+    nodes.reverse()
+    return nodes
+
+
+class DominatorTree(object):
+    """
+    Immediate dominators of the reachable nodes (dom_lt), with a preorder and a
+    postorder numbering of the tree so that dominance is tested in constant time.
+    """
+
+    def __init__(self, graph):
+        self.entry = graph.entry
+        self.idom = dom_lt(graph)
+        # numbered on the first dominance query
+        self.children = None
+        self.pre = None
+        self.post = None
+
+    def __contains__(self, node):
+        return node in self.idom
+
+    def immediate_dominator(self, node):
+        return self.idom.get(node)
+
+    def number(self):
+        self.children = defaultdict(list)
+        for node, parent in self.idom.items():
+            if parent is not None:
+                self.children[parent].append(node)
+        self.pre = {}
+        self.post = {}
+        count = 0
+        stack = [(self.entry, False)]
+        while stack:
+            node, done = stack.pop()
+            if done:
+                self.post[node] = count
+            else:
+                self.pre[node] = count
+                stack.append((node, True))
+                stack.extend((child, False) for child in self.children.get(node, ()))
+            count += 1
+
+    def dominates(self, a, b):
+        """
+        Whether `a` dominates `b`, a node dominating itself.
+        """
+        pre = self.pre
+        if pre is None:
+            self.number()
+            pre = self.pre
+        if a not in pre or b not in pre:
+            return False
+        return pre[a] <= pre[b] and self.post[b] <= self.post[a]
+
+
+class Loop(object):
+    def __init__(self, header, body):
+        self.header = header
+        self.body = body
+        self.parent = None
+        self.children = []
+        self.depth = 1
+
+    def __contains__(self, node):
+        return node in self.body
+
+    def __repr__(self):
+        return 'Loop(%s, %d nodes, depth %d)' % (self.header, len(self.body), self.depth)
+
+
+class LoopForest(object):
+    """
+    Natural loops of the graph, found from the back edges, the edges whose target
+    dominates their source. The bodies of the back edges to a same header are merged
+    into one loop. A loop is the child of the smallest other loop containing its header.
+    """
+
+    def __init__(self, graph, dominators):
+        # header -> nodes of the loop
+        bodies = {}
+        for node in dominators.idom:
+            for suc in graph.all_sucs(node):
+                if suc in dominators and dominators.dominates(suc, node):
+                    body = bodies.get(suc)
+                    if body is None:
+                        body = bodies[suc] = {suc}
+                    todo = [node]
+                    while todo:
+                        n = todo.pop()
+                        if n in body:
+                            continue
+                        body.add(n)
+                        todo.extend(p for p in graph.all_preds(n) if p in dominators)
+
+        self.loops = [Loop(header, body) for header, body in bodies.items()]
+        # number of loops containing each node
+        self.depths = defaultdict(int)
+        # node -> smallest loop containing it
+        self.innermost = {}
+        # the larger loops first, so that the smaller ones inside them come later
+        for loop in sorted(self.loops, key=lambda l: -len(l.body)):
+            parent = self.innermost.get(loop.header)
+            if parent is not None:
+                loop.parent = parent
+                loop.depth = parent.depth + 1
+                parent.children.append(loop)
+            for node in loop.body:
+                self.innermost[node] = loop
+                self.depths[node] += 1
+        self.roots = [loop for loop in self.loops if loop.parent is None]
+
+    def depth(self, node):
+        return self.depths.get(node, 0)
+
+    def loop_of(self, node):
+        return self.innermost.get(node)
+
+    def __iter__(self):
+        return iter(self.loops)
+
+    def __len__(self):
+        return len(self.loops)
+
+
+# name -> (function of the manager computing the analysis, analyses it is built on)
+ANALYSES = {
+    RPO: (lambda am: reverse_post_order(am.graph), ()),
+    DOMINATORS: (lambda am: DominatorTree(am.graph), ()),
+    LOOPS: (lambda am: LoopForest(am.graph, am.get(DOMINATORS)), (DOMINATORS,)),
+}
+
+
+class AnalysisManager(object):
+    """
+    Analyses of the graph of a method, computed when first asked for and kept until a
+    pass not preserving them runs, so that passes share them instead of each computing
+    its own.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.results = {}
+        # name -> times computed
+        self.computed = defaultdict(int)
+
+    def get(self, name):
+        result = self.results.get(name)
+        if result is None:
+            compute, _ = ANALYSES[name]
+            result = self.results[name] = compute(self)
+            self.computed[name] += 1
+        return result
+
+    def is_cached(self, name):
+        return name in self.results
+
+    def provide(self, name, result):
+        """
+        Record `result` of analysis `name` computed elsewhere, e.g. while building the graph.
+        """
+        self.results[name] = result
+
+    def invalidate(self, preserved=()):
+        """
+        Drop the analyses not in `preserved`, and those built on a dropped one.
+        """
+        kept = {}
+        # ANALYSES lists an analysis after those it is built on
+        for name in ANALYSES:
+            if name in self.results and name in preserved and \
+                    all(required in kept for required in ANALYSES[name][1]):
+                kept[name] = self.results[name]
+        self.results = kept
+
+    def run(self, pass_, *args):
+        """
+        Run `pass_` and drop the analyses it does not declare as preserved.
+        """
+        result = pass_(*args)
+        preserved = getattr(pass_, 'preserves', NO_ANALYSES)
+        if not self.results.keys() <= preserved:
+            self.invalidate(preserved)
+        return result
+
+    def clear(self):
+        self.results = {}
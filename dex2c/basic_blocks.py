@@ -25,10 +25,84 @@ from dex2c.opcode_ins import INSTRUCTION_SET
 logger = logging.getLogger('dex2c.basic_blocks')
 
 
+class InstructionList(object):
+    """
+    Doubly-linked list of the instructions of a block, through their prev_ins and
+    next_ins, so that inserting and removing an instruction do not move the others.
+    The instruction being visited by an iteration may be removed, the iteration goes on
+    with the one that followed it.
+    """
+
+    __slots__ = ('first', 'last', 'size')
+
+    def __init__(self):
+        self.first = None
+        self.last = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        ins = self.first
+        while ins is not None:
+            yield ins
+            # still set if ins was removed meanwhile
+            ins = ins.next_ins
+
+    def append(self, ins):
+        if ins.ins_list is not None:
+            raise ValueError('instruction already in a list')
+        ins.ins_list = self
+        ins.prev_ins = self.last
+        ins.next_ins = None
+        if self.last is None:
+            self.first = ins
+        else:
+            self.last.next_ins = ins
+        self.last = ins
+        self.size += 1
+
+    def insert_before(self, ins, before):
+        if before.ins_list is not self:
+            raise ValueError('instruction not in list')
+        if ins.ins_list is not None:
+            raise ValueError('instruction already in a list')
+        ins.ins_list = self
+        ins.prev_ins = before.prev_ins
+        ins.next_ins = before
+        if before.prev_ins is None:
+            self.first = ins
+        else:
+            before.prev_ins.next_ins = ins
+        before.prev_ins = ins
+        self.size += 1
+
+    def remove(self, ins):
+        if ins.ins_list is not self:
+            raise ValueError('instruction not in list')
+        ins.ins_list = None
+        if ins.prev_ins is None:
+            self.first = ins.next_ins
+        else:
+            ins.prev_ins.next_ins = ins.next_ins
+        if ins.next_ins is None:
+            self.last = ins.prev_ins
+        else:
+            ins.next_ins.prev_ins = ins.prev_ins
+        ins.prev_ins = None
+        self.size -= 1
+
+
 class IrBasicBlock(object):
+    __slots__ = ('dvm_basicblock', 'instr_list', 'move_param_insns', 'var_to_declare',
+                 'class_to_declare', 'field_to_declare', 'method_to_declare', 'num', 'id', 'po',
+                 'in_catch', 'catch_type', 'filled', 'sealed', 'current_definitions',
+                 'incomplete_phis', 'phis', 'catch_successors', 'start')
+
     def __init__(self, dvm_basicblock):
         self.dvm_basicblock = dvm_basicblock
-        self.instr_list = []
+        self.instr_list = InstructionList()
 
         # MoveParam指令会给参数生成一个局部引用(local reference), 使用局部引用引用参数
         # 不能将它放入instr_list, 因为第一个基本块可以是循环
@@ -38,6 +112,7 @@ class IrBasicBlock(object):
         self.field_to_declare = list()
         self.method_to_declare = list()
         self.num = -1  # 基本块编号
+        self.id = -1  # index in the arrays of Graph
 
         # 处理异常相关
         self.in_catch = False
@@ -48,10 +123,11 @@ class IrBasicBlock(object):
         self.filled = False
         self.sealed = False
         self.current_definitions = {}
-        self.incomplete_phis = set()
+        # None until needed, most blocks never get any
+        self.incomplete_phis = None
         self.phis = set()
 
-        self.catch_successors = set()
+        self.catch_successors = None
 
         if dvm_basicblock:
             self.start = self.dvm_basicblock.get_start()
@@ -65,8 +141,8 @@ class IrBasicBlock(object):
         return self.label
 
     def add_ins_before(self, new_ins, before_ins):
-        pos = self.instr_list.index(before_ins)
-        self.instr_list = self.instr_list[:pos] + [new_ins] + self.instr_list[pos:]
+        self.instr_list.insert_before(new_ins, before_ins)
+        new_ins.parent = self
 
     def remove_ins(self, ins):
         self.instr_list.remove(ins)
@@ -91,13 +167,15 @@ class IrBasicBlock(object):
         visitor.visit_statement_node(self)
 
     def add_incomplete_phi(self, phi):
+        if self.incomplete_phis is None:
+            self.incomplete_phis = set()
         self.incomplete_phis.add(phi)
 
     def get_incomplete_phis(self):
-        return self.incomplete_phis
+        return self.incomplete_phis or ()
 
     def clear_incomplete_phis(self):
-        self.incomplete_phis.clear()
+        self.incomplete_phis = None
 
     def add_phi(self, phi):
         self.phis.add(phi)
@@ -110,8 +188,9 @@ class IrBasicBlock(object):
         self.phis.clear()
 
     def add_catch_successor(self, node):
-        if node not in self.catch_successors:
-            self.catch_successors.add(node)
+        if self.catch_successors is None:
+            self.catch_successors = set()
+        self.catch_successors.add(node)
 
     @property
     def label(self):
@@ -131,6 +210,8 @@ class IrBasicBlock(object):
 
 
 class LandingPad(IrBasicBlock):
+    __slots__ = ('node', 'handles')
+
     def __init__(self, source):
         super(LandingPad, self).__init__(None)
         self.node = source
@@ -0,0 +1,207 @@
+# encoding=utf8
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from androguard.core.bytecodes import dvm
+
+logger = logging.getLogger('dex2c.cache')
+
+# Bump when the layout of a cache entry changes
+CACHE_FORMAT = 3
+
+# The modules the generated code depends on
+COMPILER_MODULES = ('analyses', 'basic_blocks', 'compiler', 'cost', 'graph', 'instruction', 'opcode_ins', 'util',
+                    'writer')
+
+_compiler_fingerprint = None
+
+
+def compiler_fingerprint():
+    """
+    Hash of the sources of the compiler modules, so that any change of the generated code
+    invalidates the cached code.
+    """
+    global _compiler_fingerprint
+    if _compiler_fingerprint is None:
+        h = hashlib.sha256(b'dex2c-cache-%d' % CACHE_FORMAT)
+        source_dir = os.path.dirname(os.path.abspath(__file__))
+        for module in COMPILER_MODULES:
+            name = module + '.py'
+            h.update(name.encode('utf-8'))
+            with open(os.path.join(source_dir, name), 'rb') as fp:
+                h.update(fp.read())
+        _compiler_fingerprint = h.hexdigest()
+    return _compiler_fingerprint
+
+
+def method_cache_key(method, dynamic_register):
+    """
+    Key of a method's generated code. Instructions are hashed in their resolved form
+    (type/field/method descriptors and strings rather than dex indexes), so the key does
+    not change when unrelated classes are added to the dex. Switch payloads are hashed
+    with their branch targets, array payloads with their element width and raw data.
+    """
+    h = hashlib.sha256(compiler_fingerprint().encode('ascii'))
+    h.update(b'dynamic_register=%d\n' % bool(dynamic_register))
+    h.update(('%s->%s%s\n' % (method.get_class_name(), method.get_name(), method.get_descriptor())).encode('utf-8'))
+    h.update(b'access=%x\n' % method.get_access_flags())
+
+    code = method.get_code()
+    if code is None:
+        return h.hexdigest()
+
+    h.update(b'%d %d %d\n' % (code.get_registers_size(), code.get_ins_size(), code.get_outs_size()))
+    for ins in code.get_bc().get_instructions():
+        h.update(('%s %s\n' % (ins.get_name(), ins.get_output())).encode('utf-8', 'surrogatepass'))
+        if isinstance(ins, (dvm.PackedSwitch, dvm.SparseSwitch)):
+            # the output of a switch payload only lists its keys
+            h.update(('keys %s targets %s\n' % (ins.get_keys(), ins.get_targets())).encode('ascii'))
+        elif isinstance(ins, dvm.FillArrayData):
+            h.update(b'width %d size %d\n' % (ins.element_width, ins.size))
+            h.update(bytes(ins.get_data()))
+
+    for try_item in code.get_tries():
+        h.update(b'try %d %d\n' % (try_item.get_start_addr(), try_item.get_insn_count()))
+    handlers = code.get_handlers()
+    if handlers:
+        cm = method.CM
+        for handler in handlers.get_list():
+            h.update(b'handler %d %d\n' % (handler.get_off(), handler.get_catch_all_addr()))
+            for pair in handler.get_handlers():
+                h.update(('%s %d\n' % (cm.get_type(pair.get_type_idx()), pair.get_addr())).encode('utf-8'))
+    return h.hexdigest()
+
+
+class CompileCache(object):
+    """
+    On-disk cache of the (code, prototype, JNI cost) generated for a method, bounded to `max_size`
+    bytes. Entries are evicted least recently used first, an entry's mtime being refreshed
+    on every hit.
+
+    A long-lived process can also keep up to `mem_size` bytes of the most recently used
+    entries in memory.
+    """
+
+    def __init__(self, cache_dir, max_size=512 * 1024 * 1024, mem_size=0):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.mem_size = mem_size
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _remember(self, key, entry):
+        if not self.mem_size:
+            return
+        with self.lock:
+            # an entry written again may now have its JNI cost
+            old = self.memory.pop(key, None)
+            if old is not None:
+                self.memory_used -= len(old[0]) + len(old[1])
+            self.memory[key] = entry
+            self.memory_used += len(entry[0]) + len(entry[1])
+            while self.memory_used > self.mem_size:
+                _, (code, prototype, _) = self.memory.popitem(last=False)
+                self.memory_used -= len(code) + len(prototype)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key, with_jni=False):
+        """
+        The (code, prototype, JNI cost) cached for `key`, or None. With `with_jni`, an
+        entry written without the JNI cost is a miss.
+        """
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and (entry[2] is not None or not with_jni):
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        entry = entry['code'], entry['prototype'], entry.get('jni')
+        if entry[2] is None and with_jni:
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, code, prototype, jni=None):
+        self._remember(key, (code, prototype, jni))
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+            json.dump({'code': code, 'prototype': prototype, 'jni': jni}, fp)
+        os.replace(tmp, path)
+
+    def prune(self):
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total <= self.max_size:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            self.evicted += 1
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return 'compile cache: %d hits, %d misses (%.1f%% hit rate), %d entries evicted' % (
+            self.hits, self.misses, rate, self.evicted)
@@ -24,23 +24,34 @@ from builtins import object
 from builtins import range
 from builtins import str
 
+from dex2c.analyses import CFG_ANALYSES, LOOPS, RPO, AnalysisManager, preserves
 from dex2c.basic_blocks import fill_node_from_block
+from dex2c.cost import jni_cost
 
 import logging
+import operator
 import struct
-from collections import defaultdict
+import time
+from collections import defaultdict, deque
 import androguard.core.androconf as androconf
 import dex2c.util as util
 from androguard.core.analysis import analysis
 from androguard.core.bytecodes import apk, dvm
 from dex2c.graph import construct
-from dex2c.instruction import Param, ThisParam, MoveParam, Phi, Variable, LoadConstant
+from dex2c.instruction import Param, ThisParam, MoveParam, Phi, Value, Variable, LoadConstant
 from dex2c.writer import Writer
 from androguard.util import read
 
 DEBUG = False
 # DEBUG = True
 
+# type inference gives up after as many sweeps over the instructions
+MAX_INFER_SWEEPS = 500
+# sweeps over all the instructions before only those whose operands changed are visited
+EAGER_INFER_SWEEPS = 4
+
+_type_state = operator.attrgetter('var_type', 'type_sealed')
+
 logger = logging.getLogger('dex2c.compiler')
 
 def auto_vm(filename):
@@ -75,10 +86,11 @@ class RegisterAllocator(object):
 
 
 class IrMethod(object):
-    def __init__(self, graph, method):
+    def __init__(self, graph, method, analyses=None):
         self.method = method
 
         self.graph = graph
+        self.analyses = analyses
         self.entry = graph.entry
         self.offset_to_node = graph.offset_to_node
         self.node_to_landing_pad = graph.node_to_landing_pad
@@ -112,7 +124,7 @@ class IrMethod(object):
 
 
 class IrBuilder(object):
-    def __init__(self, methanalysis, dynamic_register):
+    def __init__(self, methanalysis, dynamic_register, with_jni_cost=False):
         method = methanalysis.get_method()
         self.method = method
         self.irmethod = None
@@ -123,7 +135,11 @@ class IrBuilder(object):
         self.var_to_name = defaultdict()
         self.offset_to_node = {}
         self.graph = None
+        # AnalysisManager of the graph
+        self.analyses = None
         self.dynamic_register = dynamic_register
+        # the JNI cost needs the loops of the method, only computed when asked for
+        self.with_jni_cost = with_jni_cost
 
         self.access = util.get_access_method(method.get_access_flags())
 
@@ -137,6 +153,10 @@ class IrBuilder(object):
 
         self.var_versions = defaultdict(int)
 
+        # time spent in infer_type, reported by get_stats
+        self.infer_time = 0.0
+        self.stats = {}
+
         code = self.method.get_code()
         if code:
             start = code.registers_size - code.ins_size
@@ -165,8 +185,12 @@ class IrBuilder(object):
         if self.start_block is None:
             return
 
+        start = time.perf_counter()
         graph = construct(self.start_block)
         self.graph = graph
+        self.analyses = AnalysisManager(graph)
+        # construct numbered the nodes in reverse post order
+        self.analyses.provide(RPO, list(graph.rpo))
         if DEBUG:
             util.create_png(self.cls_name, self.name, graph, 'blocks')
 
@@ -176,25 +200,63 @@ class IrBuilder(object):
         self.build()
         if DEBUG:
             util.create_png(self.cls_name, self.name + 'ir', graph, 'blocks')
+        cost = jni_cost(graph, self.analyses.get(LOOPS)) if self.with_jni_cost else None
 
-        irmethod = IrMethod(graph, self.method)
+        irmethod = IrMethod(graph, self.method, self.analyses)
         irmethod.rtype = self.get_return_type()
         irmethod.params = self.lparams
         irmethod.params_type = self.params_type
+        built = time.perf_counter()
 
         writer = Writer(irmethod, self.dynamic_register)
         writer.write_method()
         irmethod.writer = writer
+
+        self.stats = {
+            'ir': built - start - self.infer_time,
+            'infer_type': self.infer_time,
+            'write': time.perf_counter() - built,
+            'blocks': len(irmethod.irblocks),
+            'instructions': sum(len(node.get_instr_list()) for node in irmethod.irblocks),
+            'phis': sum(len(node.phis) for node in irmethod.irblocks),
+            'jni': cost.as_dict() if cost else None,
+        }
         return irmethod
 
+    def release(self):
+        """
+        Break the reference cycles of the IR (instructions and their block, values and
+        their users, phis and their block), so that it is freed as soon as the method is
+        written rather than by a later garbage collection.
+        """
+        if self.graph is None:
+            return
+        for node in self.graph.nodes + self.graph.landing_pads:
+            for ins in list(node.instr_list) + node.move_param_insns:
+                value = ins.value
+                if value is not None:
+                    value.uses = None
+                    value.definition = None
+                ins.parent = ins.ins_list = None
+                ins.prev_ins = ins.next_ins = None
+            for phi in node.phis.union(node.get_incomplete_phis()):
+                phi.uses = None
+                phi.operands = None
+                phi.block = None
+            node.instr_list = node.move_param_insns = None
+            node.phis = node.incomplete_phis = None
+            node.current_definitions = None
+        self.graph = None
+        self.analyses = None
+
     def build(self):
         self.define_params()
 
         self.graph.entry.sealed = True  # Entry has Predecessor?
 
-        todo = [self.graph.entry]
+        todo = deque([self.graph.entry])
         while todo:
-            node = todo.pop(0)
+            node = todo.popleft()
             if node.filled:
                 continue
             self.curret_block = node
@@ -202,30 +264,39 @@ class IrBuilder(object):
             self.try_seal_block(node)
             todo.extend(self.graph.all_sucs(node))
 
-        self.remove_trivial_phi()
+        run = self.analyses.run
+        run(self.remove_trivial_phi)
         if DEBUG:
             util.create_png(self.cls_name, self.name + '_before_hack', self.graph, 'blocks')
-        self.hack_polymorphic_constant()
+        run(self.hack_polymorphic_constant)
         if DEBUG:
             util.create_png(self.cls_name, self.name + '_after_hack', self.graph, 'blocks')
-        self.infer_type()
-        self.fix_const_type()
-        self.verify_operand_type()
-        self.verify_phi_operand_type()
+        run(self.infer_type)
+        run(self.fix_const_type)
+        run(self.verify_operand_type)
+        run(self.verify_phi_operand_type)
 
         # self.dump_type()
 
-        self.add_var_to_decl()
+        run(self.add_var_to_decl)
 
+    @preserves(*CFG_ANALYSES)
     def remove_trivial_phi(self):
-        Changed = True
-        while Changed:
-            Changed = False
-            for node in self.graph.rpo:
-                phis = list(node.phis)
-                for phi in phis:
-                    Changed |= phi.remove_trivial_phi()
-
+        # a phi only becomes trivial when a phi it uses is removed, only the users of
+        # the removed phis are visited again
+        todo = deque(phi for node in self.analyses.get(RPO) for phi in list(node.phis))
+        queued = set(todo)
+        while todo:
+            phi = todo.popleft()
+            queued.discard(phi)
+            users = [user for user in phi.get_users() if isinstance(user, Phi) and user is not phi]
+            if phi.remove_trivial_phi():
+                for user in users:
+                    if user not in queued:
+                        queued.add(user)
+                        todo.append(user)
+
+    @preserves(*CFG_ANALYSES)
     def verify_operand_type(self):
         nodes = self.graph.compute_block_order()
         for node in nodes:
@@ -234,8 +305,9 @@ class IrBuilder(object):
                 if var and var.get_type() is None:
                     raise Exception('unkonw type %s' % var)
 
+    @preserves(*CFG_ANALYSES)
     def verify_phi_operand_type(self):
-        for node in self.graph.rpo:
+        for node in self.analyses.get(RPO):
             phis = list(node.phis)
             for phi in phis:
                 same_type = phi.get_type()
@@ -250,6 +322,7 @@ class IrBuilder(object):
                     else:
                         raise Exception("inconsistency phi operand type %s %s %s" % (phi, same_type, op_type))
 
+    @preserves(*CFG_ANALYSES)
     def hack_polymorphic_constant(self):
         nodes = self.graph.compute_block_order()
         todo_list = []
@@ -257,8 +330,7 @@ class IrBuilder(object):
             for ins in node.get_instr_list():
                 if isinstance(ins, LoadConstant) and ins.get_value_type() is None:
                     todo_list.append(ins)
-        while todo_list:
-            ins = todo_list.pop(0)
+        for ins in todo_list:
             bb = ins.parent
             for user in ins.get_users():
                 new_val = self.write_variable(ins.get_value().get_register())
@@ -268,27 +340,95 @@ class IrBuilder(object):
                 user.replase_use_of_with(ins.get_value(), new_val)
             ins.parent.remove_ins(ins)
 
-    def infer_type(self):
-        Changed = True
-        nodes = self.graph.compute_block_order()
-        max = 500
-        while Changed:
+    @preserves(*CFG_ANALYSES)
+    def infer_type(self, changed=None):
+        start = time.perf_counter()
+        try:
+            self._infer_type(changed)
+        finally:
+            self.infer_time += time.perf_counter() - start
+
+    def _infer_type(self, changed=None):
+        """
+        Resolve the types of the phis and instructions until nothing changes, sweeping
+        over them in block order while a type changes.
+
+        Most methods settle in a few sweeps. After EAGER_INFER_SWEEPS, a sweep only
+        visits the phis and instructions reading a value whose type changed since they
+        were last resolved, the others would not change anything. With `changed` values,
+        only their readers are visited first.
+        """
+        items = []
+        for node in self.graph.compute_block_order():
+            items.extend(node.phis)
+            items.extend(node.get_instr_list())
+
+        sweeps = 0
+        if changed is None:
+            Changed = True
+            while Changed and sweeps < EAGER_INFER_SWEEPS:
+                sweeps += 1
+                Changed = False
+                for item in items:
+                    Changed |= item.resolve_type()
+            if not Changed:
+                return
+
+        # values read and written by each item, and the items reading each value
+        item_values = []
+        readers = defaultdict(list)
+        for pos, item in enumerate(items):
+            if isinstance(item, Phi):
+                values = [item] + list(item.get_operands().values())
+            else:
+                values = [item.value] + item.operands
+            values = [v for v in set(values) if isinstance(v, Value)]
+            item_values.append(values)
+            for value in values:
+                readers[value].append(pos)
+
+        # dirty[pos]: items[pos] is to be resolved in the current sweep, again[pos] in the next one
+        if changed is None:
+            dirty = bytearray(b'\x01' * len(items))
+        else:
+            dirty = bytearray(len(items))
+            for value in changed:
+                for pos in readers.get(value, ()):
+                    dirty[pos] = 1
+        resolvers = [item.resolve_type for item in items]
+        pos = dirty.find(1)
+        while pos >= 0:
             # self.dump_type()
-            max -= 1
-            if max == 0:
+            sweeps += 1
+            if sweeps == MAX_INFER_SWEEPS:
                 raise Exception("type infer failed")
 
-            Changed = False
-            for node in nodes:
-                for phi in node.phis:
-                    Changed |= phi.resolve_type()
-                for ins in node.get_instr_list():
-                    Changed |= ins.resolve_type()
+            again = bytearray(len(items))
+            find = dirty.find
+            while pos >= 0:
+                values = item_values[pos]
+                before = list(map(_type_state, values))
+                if resolvers[pos]():
+                    again[pos] = 1
+                after = list(map(_type_state, values))
+                if after != before:
+                    for value, old, new in zip(values, before, after):
+                        if old != new:
+                            for reader in readers[value]:
+                                if reader <= pos:
+                                    again[reader] = 1
+                                else:
+                                    dirty[reader] = 1
+                pos = find(1, pos + 1)
+            dirty = again
+            pos = dirty.find(1)
 
     # 无法推导出的常量类型,根据其大小,设置类型
+    @preserves(*CFG_ANALYSES)
     def fix_const_type(self):
-        nodes = self.graph.rpo
+        nodes = self.analyses.get(RPO)
         Changed = False
+        changed = []
         for node in nodes:
             for ins in node.get_instr_list():
                 if isinstance(ins, LoadConstant) and ins.get_value_type() is None:
@@ -296,13 +436,15 @@ class IrBuilder(object):
                         Changed = True
                         logger.debug("Set constant type to int: %s" % ins)
                         ins.set_value_type('I')
+                        changed.append(ins.get_value())
                     else:
                         Changed = True
                         logger.debug("Set constant type to long: %s" % ins)
                         ins.set_value_type('J')
+                        changed.append(ins.get_value())
 
         if Changed:
-            self.infer_type()
+            self.infer_type(changed)
 
     def dump_type(self):
         nodes = self.graph.compute_block_order()
@@ -312,6 +454,7 @@ class IrBuilder(object):
                 if var is not None:
                     print('Type: %s %s' % (var, var.get_type()))
 
+    @preserves(*CFG_ANALYSES)
     def add_var_to_decl(self):
         entry = self.graph.entry
         nodes = self.graph.compute_block_order()
@@ -340,9 +483,7 @@ class IrBuilder(object):
             return
 
         for suc in sucs:
-            preds = self.graph.all_preds(suc)
-            filled = list(filter(lambda pred: pred.filled, preds))
-            if len(filled) == len(preds):
+            if all(pred.filled for pred in self.graph.all_preds(suc)):
                 self.seal_block(suc)
 
     def seal_block(self, block):
@@ -385,23 +526,58 @@ class IrBuilder(object):
             return value
 
     def read_variable_recursive(self, register, block):
-        preds = self.graph.all_preds(block)
-        if not block.sealed:
-            value = self.new_ssa_variable(register, True)
-            block.add_incomplete_phi(value)
-            value.set_block(block)
-        elif len(preds) == 1:
-            value = self.read_variable(register, preds[0])
-        else:
-            value = self.new_ssa_variable(register, True)
-            block.update_current_definition(register, value)
-            block.add_phi(value)
-            value.set_block(block)
-            for pred in preds:
-                incoming = self.read_variable(register, pred)
-                value.add_operand(pred, incoming)
-        block.update_current_definition(register, value)
-        return value
+        # the blocks waiting for the value of the register in a predecessor, as
+        # [block, phi or None, preds, index of the predecessor]; a list rather
+        # than recursion, as the chains of blocks can be long
+        pending = []
+        while True:
+            # the register has no definition in `block` yet
+            preds = self.graph.all_preds(block)
+            value = None
+            if not block.sealed:
+                value = self.new_ssa_variable(register, True)
+                block.add_incomplete_phi(value)
+                value.set_block(block)
+                block.update_current_definition(register, value)
+            elif len(preds) == 1:
+                pending.append([block, None, preds, 0])
+            else:
+                phi = self.new_ssa_variable(register, True)
+                block.update_current_definition(register, phi)
+                block.add_phi(phi)
+                phi.set_block(block)
+                if preds:
+                    pending.append([block, phi, preds, 0])
+                else:
+                    value = phi
+            if value is None:
+                value = preds[0].read_current_definition(register)
+                if value is None:
+                    block = preds[0]
+                    continue
+
+            # hand the value over to the blocks waiting for it
+            while pending:
+                waiting = pending[-1]
+                block, phi, preds, index = waiting
+                if phi is None:
+                    block.update_current_definition(register, value)
+                    pending.pop()
+                    continue
+                phi.add_operand(preds[index], value)
+                index += 1
+                if index < len(preds):
+                    waiting[3] = index
+                    value = preds[index].read_current_definition(register)
+                    if value is None:
+                        block = preds[index]
+                        break
+                else:
+                    block.update_current_definition(register, phi)
+                    value = phi
+                    pending.pop()
+            else:
+                return value
 
     def define_params(self):
         entry = self.graph.entry
@@ -553,19 +729,29 @@ class DvMachine(object):
 
 
 class Dex2C:
-    def __init__(self, vm, vmx, dynamic_register):
-        self.vm = vm
+    def __init__(self, vms, vmx, dynamic_register, with_jni_cost=False):
+        self.vms = vms
         self.vmx = vmx
         self.dynamic_register = dynamic_register
+        self.with_jni_cost = with_jni_cost
         
-    def get_source_method(self, m):
+    def get_source_method(self, m, stats=None):
+        """
+        The code and prototype of method `m`. The time spent in each step and the size
+        of the IR of the method are added to the `stats` dict.
+        """
         mx = self.vmx.get_method(m)
-        z = IrBuilder(mx, self.dynamic_register)
+        z = IrBuilder(mx, self.dynamic_register, self.with_jni_cost)
         irmethod = z.process()
+        if stats is not None:
+            stats.update(z.stats)
         if irmethod:
-            return (irmethod.get_source(), irmethod.get_prototype())
+            source = (irmethod.get_source(), irmethod.get_prototype())
+            irmethod.writer = None
         else:
-            return (None, None)
+            source = (None, None)
+        z.release()
+        return source
 
     def get_source_class(self, _class):
         c = DvClass(_class, self.vmx)
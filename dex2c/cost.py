@@ -0,0 +1,139 @@
+# encoding=utf8
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+
+from dex2c.analyses import DominatorTree, LoopForest
+from dex2c.instruction import (ArrayLengthExpression, ArrayLoadExpression, ArrayStoreInstruction,
+                               CheckCastExpression, FillArrayExpression, FilledArrayExpression, GotoInst,
+                               InstanceExpression, InstanceInstruction, InstanceOfExpression, InvokeInstruction,
+                               LoadConstant, MonitorEnterExpression, MonitorExitExpression, NewArrayExpression,
+                               NewInstance, NopExpression, StaticExpression, StaticInstruction, ThrowExpression)
+
+logger = logging.getLogger('dex2c.cost')
+
+LOOP_WEIGHT = 10
+# deeper nests are weighted as this depth
+MAX_LOOP_DEPTH = 3
+
+# Instructions going through JNI, by category
+JNI_INSTRUCTIONS = (
+    ('invoke', (InvokeInstruction,)),
+    ('field', (InstanceExpression, InstanceInstruction, StaticExpression, StaticInstruction)),
+    ('array', (ArrayLoadExpression, ArrayStoreInstruction, ArrayLengthExpression)),
+    ('alloc', (NewInstance, NewArrayExpression, FilledArrayExpression, FillArrayExpression)),
+    ('type', (CheckCastExpression, InstanceOfExpression)),
+    ('monitor', (MonitorEnterExpression, MonitorExitExpression)),
+    ('throw', (ThrowExpression,)),
+)
+JNI_CATEGORIES = [category for category, _ in JNI_INSTRUCTIONS] + ['const']
+
+# Control flow only, not counted
+FREE_INSTRUCTIONS = (GotoInst, NopExpression)
+
+
+def instruction_category(ins):
+    """
+    The JNI category of `ins`, None for the instructions that stay native.
+    """
+    for category, classes in JNI_INSTRUCTIONS:
+        if isinstance(ins, classes):
+            return category
+    if isinstance(ins, LoadConstant) and ins.get_cst().get_type() in ('Ljava/lang/String;', 'Ljava/lang/Class;'):
+        # NewStringUTF / FindClass
+        return 'const'
+    return None
+
+
+def loop_depths(graph):
+    """
+    {node: number of natural loops containing it}, loops being found from the back
+    edges of the graph, the edges whose target dominates their source.
+    """
+    return LoopForest(graph, DominatorTree(graph)).depths
+
+
+class JniCost(object):
+    """
+    Static estimate of the JNI transitions of a compiled method. Each call into the JVM
+    (invoke, field or array element access, allocation, ...) costs a transition that ART
+    does not pay for the same bytecode, so a method doing mostly such calls gets slower
+    once compiled. Instructions are weighted LOOP_WEIGHT times per enclosing loop.
+    """
+
+    def __init__(self):
+        self.counts = dict((category, 0) for category in JNI_CATEGORIES)
+        self.compute = 0
+        self.weighted_jni = 0
+        self.weighted_total = 0
+        self.max_loop_depth = 0
+
+    @property
+    def density(self):
+        """
+        Share of the weighted instructions that are JNI calls.
+        """
+        if not self.weighted_total:
+            return 0.0
+        return float(self.weighted_jni) / self.weighted_total
+
+    def as_dict(self):
+        d = dict(self.counts)
+        d.update({
+            'compute': self.compute,
+            'weighted_jni': self.weighted_jni,
+            'weighted_total': self.weighted_total,
+            'max_loop_depth': self.max_loop_depth,
+            'density': self.density,
+        })
+        return d
+
+
+def jni_cost(graph, loops=None):
+    """
+    The JniCost of `graph`, with its LoopForest `loops` if already computed.
+    """
+    cost = JniCost()
+    depths = loop_depths(graph) if loops is None else loops.depths
+    for node in graph.nodes:
+        depth = depths.get(node, 0)
+        cost.max_loop_depth = max(cost.max_loop_depth, depth)
+        weight = LOOP_WEIGHT ** min(depth, MAX_LOOP_DEPTH)
+        for ins in node.get_instr_list():
+            if isinstance(ins, FREE_INSTRUCTIONS):
+                continue
+            category = instruction_category(ins)
+            if category is None:
+                cost.compute += 1
+            else:
+                cost.counts[category] += 1
+                cost.weighted_jni += weight
+            cost.weighted_total += weight
+    return cost
+
+
+def write_jni_report(path, entries, max_density=None):
+    """
+    Write the JNI cost and verdict of the compiled methods, densest first, as JSON.
+    """
+    entries = sorted(entries, key=lambda e: (-e.get('density', 0.0), e['method']))
+    report = {
+        'max_jni_density': max_density,
+        'loop_weight': LOOP_WEIGHT,
+        'methods': entries,
+    }
+    with open(path, 'w') as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+    logger.info('JNI cost report written to %s' % path)
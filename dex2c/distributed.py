@@ -0,0 +1,339 @@
+# encoding=utf8
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import hashlib
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+
+logger = logging.getLogger('dex2c.distributed')
+
+# Messages are pickled, never accept connections that are not authenticated
+AUTHKEY_ENV = 'DCC_AUTHKEY'
+
+DEFAULT_UNIT_SIZE = 16
+MAX_ATTEMPTS = 3
+# seconds a worker is given to load the dex files of a unit, then per method of the unit
+LOAD_TIMEOUT = 600.0
+METHOD_TIMEOUT = 60.0
+
+
+def get_authkey():
+    authkey = os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise Exception('distributed compilation needs a shared secret in $%s' % AUTHKEY_ENV)
+    return authkey.encode('utf-8')
+
+
+def parse_address(text):
+    """
+    'host:port' -> (host, port)
+    """
+    host, _, port = text.rpartition(':')
+    if not host or not port.isdigit():
+        raise Exception('bad address %s, expected host:port' % text)
+    return host, int(port)
+
+
+def dexes_key(dexes, params):
+    """
+    Identifies the dex files of a run and its compile parameters, the state workers keep.
+    """
+    h = hashlib.sha256(repr(sorted(params.items())).encode('utf-8'))
+    for buff in dexes:
+        h.update(hashlib.sha256(buff).digest())
+    return h.hexdigest()
+
+
+class WorkUnit(object):
+    def __init__(self, unit_id, indexes):
+        self.id = unit_id
+        self.indexes = indexes
+        self.attempts = 0
+        self.deadline = None
+        # connection of the worker holding the unit
+        self.conn = None
+
+
+class Coordinator(object):
+    """
+    Hand out the compilation of methods to workers connected over TCP.
+
+    A work unit is a list of method indexes, in the list of the methods of all dex
+    files. Workers first ask for the raw dex files, once per `key`, then repeatedly:
+
+        {'cmd': 'fetch', 'key': key}     -> {'dexes': [bytes, ...], 'params': {...}}
+        {'cmd': 'get'}                   -> {'unit': id, 'key': key, 'indexes': [...]}
+                                            or {'done': True}
+        {'cmd': 'loaded', 'unit': id}
+        {'cmd': 'result', 'unit': id,
+         'results': [(code, prototype, error, stats), ...]}
+
+    A unit held by a worker that goes away, or that a worker still holds after
+    `load_timeout` seconds to load the dex files then `method_timeout` seconds per
+    method of the unit, is queued again, split in single methods so that a method
+    crashing or hanging its worker does not fail the others.
+    A method whose unit failed `max_attempts` times gets an error result.
+    """
+
+    def __init__(self, address, dexes, params, authkey, unit_size=DEFAULT_UNIT_SIZE, max_attempts=MAX_ATTEMPTS,
+                 load_timeout=LOAD_TIMEOUT, method_timeout=METHOD_TIMEOUT):
+        self.address = address
+        self.dexes = dexes
+        self.key = dexes_key(dexes, params)
+        self.params = params
+        self.authkey = authkey
+        self.unit_size = unit_size
+        self.max_attempts = max_attempts
+        self.load_timeout = load_timeout
+        self.method_timeout = method_timeout
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.running = {}
+        self.results = {}
+        self.names = {}
+        self.closed = False
+        self.units = itertools.count()
+        self.workers = 0
+        self.listener = None
+        self.thread = None
+        self.handlers = []
+
+    def start(self):
+        self.listener = Listener(self.address, authkey=self.authkey)
+        # the actual port when listening on port 0
+        self.address = self.listener.address
+        self.thread = threading.Thread(target=self._accept, name='dcc-coordinator', daemon=True)
+        self.thread.start()
+        logger.info('coordinator listening on %s:%d' % self.address)
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                if self.closed:
+                    return
+                raise
+            except Exception:
+                logger.warning('rejected connection', exc_info=True)
+                continue
+            if self.closed:
+                conn.close()
+                return
+            handler = threading.Thread(target=self._handle, args=(conn,), daemon=True)
+            handler.start()
+            self.handlers.append(handler)
+
+    def _handle(self, conn):
+        with self.cond:
+            self.workers += 1
+        held = set()
+        try:
+            with conn:
+                while True:
+                    request = conn.recv()
+                    cmd = request.get('cmd')
+                    if cmd == 'fetch':
+                        if request.get('key') != self.key:
+                            raise Exception('unknown dex files %s' % request.get('key'))
+                        conn.send({'dexes': self.dexes, 'params': self.params})
+                    elif cmd == 'get':
+                        unit = self._next_unit(conn)
+                        if unit is None:
+                            conn.send({'done': True})
+                            return
+                        held.add(unit.id)
+                        conn.send({'unit': unit.id, 'key': self.key, 'indexes': unit.indexes})
+                    elif cmd == 'loaded':
+                        self._loaded(request['unit'])
+                    elif cmd == 'result':
+                        held.discard(request['unit'])
+                        self._complete(request['unit'], request['results'])
+                    else:
+                        raise Exception('unknown command %s' % cmd)
+        except (EOFError, OSError):
+            pass
+        except Exception:
+            logger.warning('worker failed', exc_info=True)
+        finally:
+            with self.cond:
+                self.workers -= 1
+            for unit_id in held:
+                self._fail(unit_id)
+
+    def _next_unit(self, conn):
+        with self.cond:
+            # idle workers are held until there is work or the coordinator closes
+            while not self.queue and not self.closed:
+                self.cond.wait()
+            if not self.queue or self.closed:
+                return None
+            unit = self.queue.popleft()
+            unit.attempts += 1
+            # until the worker has loaded the dex files, which may take long the first time
+            unit.deadline = time.time() + self.load_timeout
+            unit.conn = conn
+            self.running[unit.id] = unit
+            return unit
+
+    def _loaded(self, unit_id):
+        with self.cond:
+            unit = self.running.get(unit_id)
+            if unit is not None:
+                unit.deadline = time.time() + self.method_timeout * len(unit.indexes)
+
+    def _complete(self, unit_id, results):
+        with self.cond:
+            unit = self.running.pop(unit_id, None)
+            if unit is None:
+                return
+            for index, result in zip(unit.indexes, results):
+                self.results[index] = tuple(result)
+            self.cond.notify_all()
+
+    def _fail(self, unit_id):
+        with self.cond:
+            unit = self.running.pop(unit_id, None)
+            if unit is None:
+                return
+            logger.warning('worker lost unit %d (%d methods, attempt %d)' % (unit.id, len(unit.indexes), unit.attempts))
+            self._retry(unit)
+
+    def _expire(self):
+        """
+        Queue again the units held past their deadline, and drop the workers holding
+        them, which may be hung.
+        """
+        now = time.time()
+        for unit in [unit for unit in self.running.values() if unit.deadline < now]:
+            del self.running[unit.id]
+            logger.warning('worker timed out on unit %d (%d methods, attempt %d)' %
+                           (unit.id, len(unit.indexes), unit.attempts))
+            self._retry(unit)
+            try:
+                # wakes up the handler blocked in recv(), closing the connection would not
+                sock = socket.socket(fileno=os.dup(unit.conn.fileno()))
+                with sock:
+                    sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _retry(self, unit):
+        # the retries get new ids, the worker that had the unit may still complete or
+        # lose it
+        if len(unit.indexes) > 1 or unit.attempts < self.max_attempts:
+            for index in unit.indexes:
+                retry = WorkUnit(next(self.units), [index])
+                retry.attempts = unit.attempts
+                self.queue.append(retry)
+        else:
+            index = unit.indexes[0]
+            name = self.names.get(index, '#%d' % index)
+            self.results[index] = (None, None, '%s:worker failed %d times' % (name, unit.attempts), None)
+        self.cond.notify_all()
+
+    def compile(self, indexes, names=None):
+        """
+        Yield the (code, prototype, error, stats) result of each of the methods at `indexes`, in
+        the order of `indexes` whatever the order in which the workers complete them.
+        `names` {index: method name} are used in the errors of the methods that failed.
+        """
+        indexes = list(indexes)
+        with self.cond:
+            self.names.update(names or {})
+            for i in range(0, len(indexes), self.unit_size):
+                self.queue.append(WorkUnit(next(self.units), indexes[i:i + self.unit_size]))
+            self.cond.notify_all()
+
+        waited = time.time()
+        for index in indexes:
+            with self.cond:
+                while index not in self.results:
+                    self._expire()
+                    if self.workers == 0 and time.time() - waited > 10:
+                        logger.info('waiting for workers on %s:%d' % self.address)
+                        waited = time.time()
+                    self.cond.wait(1)
+                result = self.results.pop(index)
+            yield result
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.listener is not None:
+            # wake up accept()
+            try:
+                Client(self.address, authkey=self.authkey).close()
+            except Exception:
+                pass
+            self.thread.join()
+            self.listener.close()
+        # idle workers are told that the run is done
+        for handler in self.handlers:
+            handler.join(1)
+
+
+def run_worker(address, authkey, compile_unit, retry_interval=1.0, once=False):
+    """
+    Connect to the coordinator at `address` and compile the units it hands out, then
+    wait for the next coordinator, unless `once`.
+
+    `compile_unit(key, fetch, indexes, loaded)` returns the results of the methods at
+    `indexes` of the dex files identified by `key`; `fetch()` gets these dex files and
+    the compile parameters from the coordinator, `loaded()` tells it that they are
+    loaded and the compilation starts.
+    """
+    while True:
+        try:
+            conn = Client(address, authkey=authkey)
+        except (ConnectionError, OSError):
+            time.sleep(retry_interval)
+            continue
+
+        with conn:
+            try:
+                while True:
+                    conn.send({'cmd': 'get'})
+                    unit = conn.recv()
+                    if unit.get('done'):
+                        break
+
+                    def fetch(key=unit['key']):
+                        conn.send({'cmd': 'fetch', 'key': key})
+                        response = conn.recv()
+                        return response['dexes'], response['params']
+
+                    def loaded(unit_id=unit['unit']):
+                        conn.send({'cmd': 'loaded', 'unit': unit_id})
+
+                    results = compile_unit(unit['key'], fetch, unit['indexes'], loaded)
+                    conn.send({'cmd': 'result', 'unit': unit['unit'], 'results': results})
+            except (EOFError, ConnectionError):
+                logger.info('coordinator went away')
+            except Exception:
+                logger.error('worker failed\n%s' % traceback.format_exc())
+                raise
+
+        if once:
+            return
+        # let the coordinator close its listener before reconnecting
+        time.sleep(retry_interval)
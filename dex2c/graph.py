@@ -17,7 +17,7 @@ from builtins import range
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from builtins import str
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from dex2c.basic_blocks import (IrBasicBlock, LandingPad)
 from dex2c.instruction import *
@@ -26,6 +26,13 @@ logger = logging.getLogger('dex2c.graph')
 
 
 class Graph(object):
+    """
+    Control flow graph of a method. Each node gets an integer id, which indexes the
+    successors and predecessors (normal then catch edges) of the node, computed once
+    until an edge of the node changes. The block order is kept until a node is added
+    or removed.
+    """
+
     def __init__(self):
         self.entry = None
         self.exit = None
@@ -41,11 +48,43 @@ class Graph(object):
         self.offset_to_node = {}
         self.node_to_landing_pad = {}
 
+        # id -> tuple of nodes, None when to be computed again
+        self.node_sucs = []
+        self.node_preds = []
+        self.block_order = None
+
+    def node_id(self, node):
+        if node.id < 0:
+            node.id = len(self.node_sucs)
+            self.node_sucs.append(None)
+            self.node_preds.append(None)
+        return node.id
+
+    def invalidate(self, node=None):
+        """
+        Forget the successors and predecessors of `node`, or everything cached.
+        """
+        if node is None:
+            self.node_sucs = [None] * len(self.node_sucs)
+            self.node_preds = [None] * len(self.node_preds)
+            self.block_order = None
+        else:
+            node_id = self.node_id(node)
+            self.node_sucs[node_id] = None
+            self.node_preds[node_id] = None
+
     def sucs(self, node):
         return self.edges.get(node, [])[:]
 
     def all_sucs(self, node):
-        return self.edges.get(node, []) + self.catch_edges.get(node, [])
+        node_id = node.id
+        if node_id < 0:
+            # a node neither added nor linked yet
+            node_id = self.node_id(node)
+        sucs = self.node_sucs[node_id]
+        if sucs is None:
+            sucs = self.node_sucs[node_id] = tuple(self.edges.get(node, []) + self.catch_edges.get(node, []))
+        return sucs
 
     def all_catches(self, node):
         return self.catch_edges.get(node, [])[:]
@@ -54,11 +93,19 @@ class Graph(object):
         return [n for n in self.reverse_edges.get(node, []) if not n.in_catch]
 
     def all_preds(self, node):
-        return (self.reverse_edges.get(node, []) + self.reverse_catch_edges.get(
-            node, []))
+        node_id = node.id
+        if node_id < 0:
+            node_id = self.node_id(node)
+        preds = self.node_preds[node_id]
+        if preds is None:
+            preds = self.node_preds[node_id] = tuple(self.reverse_edges.get(node, []) +
+                                                     self.reverse_catch_edges.get(node, []))
+        return preds
 
     def add_node(self, node):
+        self.node_id(node)
         self.nodes.append(node)
+        self.block_order = None
 
     def add_landing_pad(self, pad):
         self.landing_pads.append(pad)
@@ -70,6 +117,8 @@ class Graph(object):
         lpreds = self.reverse_edges[e2]
         if e1 not in lpreds:
             lpreds.append(e1)
+        self.invalidate(e1)
+        self.invalidate(e2)
 
     def remove_edge(self, e1, e2):
         lsucs = self.edges[e1]
@@ -79,6 +128,8 @@ class Graph(object):
         lpreds = self.reverse_edges[e2]
         if e1 in lpreds:
             lpreds.remove(e1)
+        self.invalidate(e1)
+        self.invalidate(e2)
 
     def add_catch_edge(self, e1, e2):
         lsucs = self.catch_edges[e1]
@@ -87,6 +138,8 @@ class Graph(object):
         lpreds = self.reverse_catch_edges[e2]
         if e1 not in lpreds:
             lpreds.append(e1)
+        self.invalidate(e1)
+        self.invalidate(e2)
 
     def remove_node(self, node):
         preds = self.reverse_edges.get(node, [])
@@ -105,6 +158,11 @@ class Graph(object):
         for suc in exc_succs:
             self.reverse_catch_edges[suc].remove(node)
 
+        for other in preds + succs + exc_preds + exc_succs:
+            self.invalidate(other)
+        self.invalidate(node)
+        self.block_order = None
+
         self.nodes.remove(node)
         if node in self.rpo:
             self.rpo.remove(node)
@@ -146,10 +204,15 @@ class Graph(object):
         self.rpo = sorted(self.nodes, key=lambda n: n.num)
 
     def compute_block_order(self):
-        list = sorted(self.nodes, key=lambda n: n.start)
-        for num, node in enumerate(list):
+        """
+        The nodes by offset, numbered in this order.
+        """
+        if self.block_order is None:
+            self.block_order = sorted(self.nodes, key=lambda n: n.start)
+        # compute_rpo numbers them differently
+        for num, node in enumerate(self.block_order):
             node.num = num
-        return list
+        return list(self.block_order)
 
     def post_order(self):
         """
@@ -157,18 +220,31 @@ class Graph(object):
         children of a node before visiting the node itself.
         """
 
-        def _visit(n, cnt):
-            visited.add(n)
-            for suc in self.all_sucs(n):
-                if suc not in visited:
-                    for cnt, s in _visit(suc, cnt):
-                        yield cnt, s
+        # an explicit stack of the nodes being visited and of the index of
+        # their next successor, so that deep graphs do not recurse
+        all_sucs = self.all_sucs
+        visited = {self.entry}
+        nodes = [self.entry]
+        indexes = [0]
+        cnt = 1
+        while nodes:
+            n = nodes[-1]
+            sucs = all_sucs(n)
+            i = indexes[-1]
+            while i < len(sucs) and sucs[i] in visited:
+                i += 1
+            if i < len(sucs):
+                suc = sucs[i]
+                indexes[-1] = i + 1
+                visited.add(suc)
+                nodes.append(suc)
+                indexes.append(0)
+                continue
+            nodes.pop()
+            indexes.pop()
             n.po = cnt
-            yield cnt + 1, n
-
-        visited = set()
-        for _, node in _visit(self.entry, 1):
-            yield node
+            cnt += 1
+            yield n
 
     def draw(self, name, dname, draw_branches=True):
         from pydot import Dot, Edge,Node
@@ -207,73 +283,93 @@ class Graph(object):
 
 
 def dom_lt(graph):
-    """Dominator algorithm from Lengaeur-Tarjan"""
-
-    def _dfs(v, n):
-        semi[v] = n = n + 1
-        vertex[n] = label[v] = v
-        ancestor[v] = 0
-        for w in graph.all_sucs(v):
-            if not semi[w]:
-                parent[w] = v
-                n = _dfs(w, n)
-            pred[w].add(v)
-        return n
-
-    def _compress(v):
-        u = ancestor[v]
-        if ancestor[u]:
-            _compress(u)
-            if semi[label[u]] < semi[label[v]]:
-                label[v] = label[u]
-            ancestor[v] = ancestor[u]
+    """
+    Dominator algorithm from Lengaeur-Tarjan. The nodes reachable from the
+    entry are numbered in depth first order, the algorithm works on the
+    numbers, 0 standing for no node.
+    """
+    all_sucs = graph.all_sucs
+    number = {graph.entry: 1}
+    vertex = [None, graph.entry]
+    parent = [0, 0]
+    pred = [None, []]
+
+    # Step 1: depth first numbering, without recursion
+    nodes = [graph.entry]
+    indexes = [0]
+    while nodes:
+        v = nodes[-1]
+        sucs = all_sucs(v)
+        i = indexes[-1]
+        if i == len(sucs):
+            nodes.pop()
+            indexes.pop()
+            continue
+        indexes[-1] = i + 1
+        w = sucs[i]
+        nw = number.get(w)
+        if nw is None:
+            nw = number[w] = len(vertex)
+            vertex.append(w)
+            parent.append(number[v])
+            pred.append([])
+            nodes.append(w)
+            indexes.append(0)
+        pred[nw].append(number[v])
+
+    n = len(vertex) - 1
+    semi = list(range(n + 1))
+    label = list(range(n + 1))
+    ancestor = [0] * (n + 1)
+    dom = [0] * (n + 1)
+    bucket = [[] for _ in range(n + 1)]
 
     def _eval(v):
-        if ancestor[v]:
-            _compress(v)
-            return label[v]
-        return v
-
-    def _link(v, w):
-        ancestor[w] = v
-
-    parent, ancestor, vertex = {}, {}, {}
-    label, dom = {}, {}
-    pred, bucket = defaultdict(set), defaultdict(set)
-
-    # Step 1:
-    semi = {v: 0 for v in graph.nodes}
-    n = _dfs(graph.entry, 0)
-    for i in range(n, 1, -1):
-        w = vertex[i]
+        if not ancestor[v]:
+            return v
+        # compress the path to the root of the forest: walk up, then
+        # update the labels from the top down
+        path = []
+        u = v
+        while ancestor[ancestor[u]]:
+            path.append(u)
+            u = ancestor[u]
+        for u in reversed(path):
+            a = ancestor[u]
+            if semi[label[a]] < semi[label[u]]:
+                label[u] = label[a]
+            ancestor[u] = ancestor[a]
+        return label[v]
+
+    for w in range(n, 1, -1):
         # Step 2:
         for v in pred[w]:
             u = _eval(v)
-            y = semi[w] = min(semi[w], semi[u])
-        bucket[vertex[y]].add(w)
+            if semi[u] < semi[w]:
+                semi[w] = semi[u]
+        bucket[semi[w]].append(w)
         pw = parent[w]
-        _link(pw, w)
+        ancestor[w] = pw
         # Step 3:
-        bpw = bucket[pw]
-        while bpw:
-            v = bpw.pop()
+        for v in bucket[pw]:
             u = _eval(v)
             dom[v] = u if semi[u] < semi[v] else pw
+        bucket[pw] = []
     # Step 4:
-    for i in range(2, n + 1):
-        w = vertex[i]
-        dw = dom[w]
-        if dw != vertex[semi[w]]:
-            dom[w] = dom[dw]
-    dom[graph.entry] = None
-    return dom
+    for w in range(2, n + 1):
+        if dom[w] != semi[w]:
+            dom[w] = dom[dom[w]]
+
+    idom = {vertex[w]: vertex[dom[w]] for w in range(2, n + 1)}
+    idom[graph.entry] = None
+    return idom
 
 
 def bfs(start):
-    to_visit = [start]
+    to_visit = deque([start])
     visited = set([start])
     while to_visit:
-        node = to_visit.pop(0)
+        node = to_visit.popleft()
         yield node
         if node.exception_analysis:
             for _, _, exception in node.exception_analysis.exceptions:
@@ -16,6 +16,7 @@
 # limitations under the License.
 
 import logging
+import sys
 from builtins import object
 from typing import List, Set
 from dex2c import util
@@ -24,12 +25,15 @@ logger = logging.getLogger('dex2c.instruction')
 
 
 class Value(object):
+    __slots__ = ('var_type', 'type_sealed', 'definition', 'uses', 'is_const')
+
     def __init__(self):
         self.var_type = None
         self.type_sealed = False
 
         self.definition = None
-        self.uses = set()
+        # user -> Use
+        self.uses = {}
         self.is_const = False
 
     def set_type(self, vtype: str):
@@ -99,40 +103,31 @@ class Value(object):
         return len(self.uses) == 0
 
     def get_uses(self):
-        return self.uses
+        return list(self.uses.values())
 
     def get_users(self):
-        users = set()
-        for use in self.uses:
-            users.add(use.get_user())
-        return list(users)
+        return list(self.uses)
 
     def add_user(self, instr):
-        for use in self.uses:
-            if use.get_user() == instr:
-                return
-        else:
-            use = Use(self, instr)
-            self.uses.add(use)
+        if instr not in self.uses:
+            self.uses[instr] = Use(self, instr)
 
     def visit_decl(self, visitor):
         return visitor.visit_decl(self)
 
     def remove_user(self, user):
-        new_uses = set()
-        for use in self.uses:
-            if user != use.get_user():
-                new_uses.add(use)
-        self.uses = new_uses
+        self.uses.pop(user, None)
 
     def replace_all_uses_with(self, new_value):
-        for use in self.uses:
+        for use in list(self.uses.values()):
             user = use.get_user()
             user.replase_use_of_with(use.get_value(), new_value)
         self.uses.clear()
 
 
 class Use(object):
+    __slots__ = ('value', 'user')
+
     def __init__(self, value: Value, user):
         self.value = value
         self.user = user
@@ -145,6 +140,8 @@ class Use(object):
 
 
 class Constant(Value):
+    __slots__ = ('constant',)
+
     def __init__(self, value, vtype=None):
         super(Constant, self).__init__()
         self.constant = value
@@ -177,6 +174,8 @@ class Constant(Value):
 
 
 class Variable(Value):
+    __slots__ = ('register', 'version')
+
     def __init__(self, register, version):
         super(Variable, self).__init__()
         self.register = register
@@ -202,11 +201,12 @@ class Variable(Value):
 
 
 class Phi(Variable):
+    __slots__ = ('operands', 'block')
+
     def __init__(self, register, version):
         super(Phi, self).__init__(register, version)
         self.operands = {}
         self.block = None
-        self.phi_users = set()
 
     def get_operands(self):
         return self.operands
@@ -295,17 +295,37 @@ class Phi(Variable):
 
 
 class Instruction(object):
+    __slots__ = ('value', 'operands', 'parent', 'ins_list', 'prev_ins', 'next_ins', 'offset', 'next_offset',
+                 'dvm_instr', '_live_in', '_live_out')
+
     def __init__(self):
         self.value: Value = None
         self.operands: List[Value] = []
         self.parent = None  # bb
+        # the InstructionList of parent holding the instruction, and its neighbours there
+        self.ins_list = None
+        self.prev_ins = None
+        self.next_ins = None
         self.offset = -1  # current instruction's offset, used by branch instruction
         self.next_offset = -1  # next instruction's offset, used to get next basicblock
         self.dvm_instr = None
 
         # 活跃信息,如果一个引用类型变量在live_in但不在live_out,需要释放引用
-        self.live_in: Set[Value] = set()
-        self.live_out: Set[Value] = set()
+        # allocated on first use, most instructions never get any
+        self._live_in: Set[Value] = None
+        self._live_out: Set[Value] = None
+
+    @property
+    def live_in(self):
+        if self._live_in is None:
+            self._live_in = set()
+        return self._live_in
+
+    @property
+    def live_out(self):
+        if self._live_out is None:
+            self._live_out = set()
+        return self._live_out
 
     def set_value(self, value):
         self.value = value
@@ -371,6 +391,8 @@ class Instruction(object):
 
 
 class LoadConstant(Instruction):
+    __slots__ = ()
+
     def __init__(self, value, cst):
         super(LoadConstant, self).__init__()
         self.value = value
@@ -403,6 +425,8 @@ class LoadConstant(Instruction):
 
 
 class Param(object):
+    __slots__ = ('declared', 'value', 'this')
+
     def __init__(self, value):
         self.declared = True
         self.value = value
@@ -419,6 +443,8 @@ class Param(object):
 
 
 class ThisParam(Param):
+    __slots__ = ()
+
     def __init__(self, value):
         super(ThisParam, self).__init__(value)
         self.this = True
@@ -431,6 +457,8 @@ class ThisParam(Param):
 
 
 class MoveParam(Instruction):
+    __slots__ = ('param',)
+
     def __init__(self, param):
         super(MoveParam, self).__init__()
         self.param = param
@@ -449,6 +477,8 @@ class MoveParam(Instruction):
 
 
 class MoveExpression(Instruction):
+    __slots__ = ()
+
     def __init__(self, lhs, rhs):
         super(MoveExpression, self).__init__()
         self.value = lhs
@@ -480,6 +510,8 @@ class MoveExpression(Instruction):
 
 
 class MoveResultExpression(MoveExpression):
+    __slots__ = ()
+
     def __init__(self, lhs, rhs):
         super(MoveResultExpression, self).__init__(lhs, rhs)
 
@@ -491,6 +523,8 @@ class MoveResultExpression(MoveExpression):
 
 
 class ArrayStoreInstruction(Instruction):
+    __slots__ = ('elem_type',)
+
     def __init__(self, rhs, array, index, _type):
         super(ArrayStoreInstruction, self).__init__()
         rhs.add_user(self)
@@ -538,6 +572,8 @@ class ArrayStoreInstruction(Instruction):
 
 
 class StaticInstruction(Instruction):
+    __slots__ = ('cls', 'ftype', 'name', 'clsdesc')
+
     def __init__(self, rhs, klass, ftype, name):
         super(StaticInstruction, self).__init__()
         self.cls = util.get_type(klass)
@@ -564,6 +600,8 @@ class StaticInstruction(Instruction):
 
 
 class InstanceInstruction(Instruction):
+    __slots__ = ('atype', 'cls', 'name', 'clsdesc')
+
     def __init__(self, rhs, lhs, klass, atype, name):
         super(InstanceInstruction, self).__init__()
         self.atype = atype
@@ -596,6 +634,8 @@ class InstanceInstruction(Instruction):
 
 
 class NewInstance(Instruction):
+    __slots__ = ('type',)
+
     def __init__(self, lhs, ins_type):
         super(NewInstance, self).__init__()
         self.value = lhs
@@ -619,6 +659,8 @@ class NewInstance(Instruction):
 
 
 class InvokeInstruction(Instruction):
+    __slots__ = ('invoke_type', 'is_static', 'clsdesc', 'name', 'rtype', 'ptype', 'args', 'triple')
+
     def __init__(self, invoke_type, clsname, name, thiz, result, rtype, ptype, args, triple):
         super(InvokeInstruction, self).__init__()
         self.invoke_type = invoke_type
@@ -641,7 +683,8 @@ class InvokeInstruction(Instruction):
             arg.add_user(self)
             self.operands.append(arg)
 
-        self.triple = triple
+        # get_triple builds new strings on each call
+        self.triple = tuple(sys.intern(s) for s in triple)
         assert (triple[1] == name)
 
     @property
@@ -694,6 +737,8 @@ class InvokeInstruction(Instruction):
 
 
 class InvokeRangeInstruction(InvokeInstruction):
+    __slots__ = ()
+
     def __init__(self, clsname, name, rtype, ptype, args, triple):
         base = args.pop(0)
         super(InvokeRangeInstruction, self).__init__(clsname, name, base, rtype,
@@ -701,24 +746,32 @@ class InvokeRangeInstruction(InvokeInstruction):
 
 
 class InvokeDirectInstruction(InvokeInstruction):
+    __slots__ = ()
+
     def __init__(self, clsname, name, base, rtype, ptype, args, triple):
         super(InvokeDirectInstruction, self).__init__(
             clsname, name, base, rtype, ptype, args, triple)
 
 
 class InvokeStaticInstruction(InvokeInstruction):
+    __slots__ = ()
+
     def __init__(self, clsname, name, base, rtype, ptype, args, triple):
         super(InvokeStaticInstruction, self).__init__(
             clsname, name, base, rtype, ptype, args, triple)
 
 
 class InvokeSuperInstruction(InvokeInstruction):
+    __slots__ = ()
+
     def __init__(self, clsname, name, base, rtype, ptype, args, triple):
         super(InvokeSuperInstruction, self).__init__(clsname, name, base, rtype,
                                                      ptype, args, triple)
 
 
 class ReturnInstruction(Instruction):
+    __slots__ = ('rtype',)
+
     def __init__(self, arg, rtype=None):
         super(ReturnInstruction, self).__init__()
         self.rtype = rtype
@@ -753,6 +806,8 @@ class ReturnInstruction(Instruction):
 
 
 class NopExpression(Instruction):
+    __slots__ = ()
+
     def __init__(self):
         super(NopExpression, self).__init__()
         pass
@@ -762,6 +817,8 @@ class NopExpression(Instruction):
 
 
 class GotoInst(Instruction):
+    __slots__ = ('target',)
+
     def __init__(self, target):
         super(GotoInst, self).__init__()
         self.target = target
@@ -774,6 +831,8 @@ class GotoInst(Instruction):
 
 
 class SwitchExpression(Instruction):
+    __slots__ = ('cases',)
+
     def __init__(self, src, cases):
         super(SwitchExpression, self).__init__()
         # src.set_type('I')
@@ -792,6 +851,8 @@ class SwitchExpression(Instruction):
 
 
 class CheckCastExpression(Instruction):
+    __slots__ = ('type', 'clsdesc')
+
     def __init__(self, arg, _type, descriptor=None):
         super(CheckCastExpression, self).__init__()
         self.type = descriptor
@@ -816,6 +877,8 @@ class CheckCastExpression(Instruction):
 
 
 class InstanceOfExpression(Instruction):
+    __slots__ = ('clsdesc',)
+
     def __init__(self, result, obj, clsdesc):
         super(InstanceOfExpression, self).__init__()
         self.clsdesc = clsdesc
@@ -839,11 +902,15 @@ class InstanceOfExpression(Instruction):
 
 
 class ArrayExpression(Instruction):
+    __slots__ = ()
+
     def __init__(self):
         super(ArrayExpression, self).__init__()
 
 
 class ArrayLoadExpression(ArrayExpression):
+    __slots__ = ('elem_type',)
+
     def __init__(self, result, arg, index, _type):
         super(ArrayLoadExpression, self).__init__()
         self.value = result
@@ -889,6 +956,8 @@ class ArrayLoadExpression(ArrayExpression):
 
 
 class ArrayLengthExpression(ArrayExpression):
+    __slots__ = ()
+
     def __init__(self, result, array):
         super(ArrayLengthExpression, self).__init__()
         self.value = result
@@ -910,6 +979,8 @@ class ArrayLengthExpression(ArrayExpression):
 
 
 class NewArrayExpression(ArrayExpression):
+    __slots__ = ('type', 'elem_type')
+
     def __init__(self, result, asize, atype):
         super(NewArrayExpression, self).__init__()
         self.value = result
@@ -941,6 +1012,8 @@ class NewArrayExpression(ArrayExpression):
 
 
 class FilledArrayExpression(ArrayExpression):
+    __slots__ = ('size', 'type', 'elem_type')
+
     def __init__(self, result, asize, atype, args):
         super(FilledArrayExpression, self).__init__()
         self.value = result
@@ -967,6 +1040,8 @@ class FilledArrayExpression(ArrayExpression):
 
 
 class FillArrayExpression(ArrayExpression):
+    __slots__ = ('filldata',)
+
     def __init__(self, reg, value):
         super(FillArrayExpression, self).__init__()
         self.filldata = value
@@ -985,6 +1060,8 @@ class FillArrayExpression(ArrayExpression):
 
 
 class MoveExceptionExpression(Instruction):
+    __slots__ = ('type',)
+
     def __init__(self, value, _type):
         super(MoveExceptionExpression, self).__init__()
         self.value = value
@@ -1002,6 +1079,8 @@ class MoveExceptionExpression(Instruction):
 
 
 class MonitorEnterExpression(Instruction):
+    __slots__ = ()
+
     def __init__(self, ref):
         super(MonitorEnterExpression, self).__init__()
         ref.add_user(self)
@@ -1018,6 +1097,8 @@ class MonitorEnterExpression(Instruction):
 
 
 class MonitorExitExpression(Instruction):
+    __slots__ = ()
+
     def __init__(self, ref):
         super(MonitorExitExpression, self).__init__()
         ref.add_user(self)
@@ -1034,6 +1115,8 @@ class MonitorExitExpression(Instruction):
 
 
 class ThrowExpression(Instruction):
+    __slots__ = ()
+
     def __init__(self, ref):
         super(ThrowExpression, self).__init__()
         ref.add_user(self)
@@ -1050,6 +1133,8 @@ class ThrowExpression(Instruction):
 
 
 class BinaryExpression(Instruction):
+    __slots__ = ('op', 'op_type')
+
     def __init__(self, op, result, arg1, arg2, vtype):
         super(BinaryExpression, self).__init__()
         self.value = result
@@ -1078,6 +1163,8 @@ class BinaryExpression(Instruction):
 
 
 class BinaryCompExpression(BinaryExpression):
+    __slots__ = ()
+
     def __init__(self, op, result, arg1, arg2, _type):
         super(BinaryCompExpression, self).__init__(op, result, arg1, arg2, _type)
         result.refine_type('I')
@@ -1091,16 +1178,22 @@ class BinaryCompExpression(BinaryExpression):
 
 
 class BinaryExpression2Addr(BinaryExpression):
+    __slots__ = ()
+
     def __init__(self, result, op, dest, arg, _type):
         super(BinaryExpression2Addr, self).__init__(result, op, dest, arg, _type)
 
 
 class BinaryExpressionLit(BinaryExpression):
+    __slots__ = ()
+
     def __init__(self, op, result, arg1, arg2):
         super(BinaryExpressionLit, self).__init__(op, result, arg1, arg2, 'I')
 
 
 class UnaryExpression(Instruction):
+    __slots__ = ('op', 'type')
+
     def __init__(self, result, op, arg, _type):
         super(UnaryExpression, self).__init__()
         result.refine_type(_type)
@@ -1121,6 +1214,8 @@ class UnaryExpression(Instruction):
 
 
 class CastExpression(Instruction):
+    __slots__ = ('type', 'src_type', 'op')
+
     def __init__(self, result, op, dest_type, arg, src_type):
         super(CastExpression, self).__init__()
         self.type = dest_type
@@ -1150,6 +1245,8 @@ CONDS = {'==': '!=', '!=': '==', '<': '>=', '<=': '>', '>=': '<', '>': '<=', }
 
 
 class ConditionalExpression(Instruction):
+    __slots__ = ('op', 'target')
+
     def __init__(self, op, arg1, arg2, target):
         super(ConditionalExpression, self).__init__()
         self.op = op
@@ -1186,6 +1283,8 @@ class ConditionalExpression(Instruction):
 
 
 class ConditionalZExpression(Instruction):
+    __slots__ = ('op', 'target')
+
     def __init__(self, op, arg, target):
         super(ConditionalZExpression, self).__init__()
         self.op = op
@@ -1206,6 +1305,8 @@ class ConditionalZExpression(Instruction):
 
 
 class InstanceExpression(Instruction):
+    __slots__ = ('cls', 'ftype', 'name', 'clsdesc')
+
     def __init__(self, result, arg, klass, ftype, name):
         super(InstanceExpression, self).__init__()
         self.value = result
@@ -1245,6 +1346,8 @@ class InstanceExpression(Instruction):
 
 
 class StaticExpression(Instruction):
+    __slots__ = ('cls', 'ftype', 'name', 'clsdesc')
+
     def __init__(self, result, cls_name, field_type, field_name):
         super(StaticExpression, self).__init__()
         self.value = result
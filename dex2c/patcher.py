@@ -0,0 +1,109 @@
+# encoding=utf8
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+import struct
+import zlib
+
+
+logger = logging.getLogger('dex2c.patcher')
+
+ACC_NATIVE = 0x100
+
+
+def read_uleb128(buff, off):
+    """
+    Decode the unsigned LEB128 at `off`, return (value, size in bytes)
+    """
+    result = 0
+    shift = 0
+    size = 0
+    while True:
+        b = buff[off + size]
+        size += 1
+        result |= (b & 0x7f) << shift
+        shift += 7
+        if b < 0x80:
+            return result, size
+
+
+def encode_uleb128(value, size=None):
+    """
+    Encode `value` as unsigned LEB128. If `size` is given, the encoding is padded with
+    continuation bytes to exactly `size` bytes, which dex readers accept.
+    """
+    out = bytearray()
+    while True:
+        b = value & 0x7f
+        value >>= 7
+        if value == 0 and (size is None or len(out) + 1 >= size):
+            out.append(b)
+            break
+        out.append(b | 0x80)
+
+    if size is not None and len(out) != size:
+        raise ValueError('%d does not fit in %d bytes' % (value, size))
+    return bytes(out)
+
+
+def fix_checksums(buff):
+    """
+    Recompute the SHA-1 signature and adler32 checksum of the dex header in place
+    (same as DalvikVMFormat.fix_checksums, with the checksum packed unsigned).
+    """
+    buff[12:32] = hashlib.sha1(buff[32:]).digest()
+    buff[8:12] = struct.pack('<I', zlib.adler32(buff[12:]) & 0xffffffff)
+    return buff
+
+
+def patch_native_methods(vm, method_triples):
+    """
+    Turn the methods of `vm` whose triple is in `method_triples` into native methods.
+
+    The access_flags and code_off of an encoded_method are rewritten in place in the
+    class_data_item: code_off becomes 0 and the native flag is set. Adding the flag can
+    take one more byte than the original flags, but code_off always shrinks by more than
+    that (a code item never lives in the first 128 bytes of a dex), so the new values are
+    padded to the original size and no other offset in the file moves. The orphaned code
+    item is left in place.
+
+    :return: the patched dex as a bytearray and the number of patched methods
+    """
+    buff = bytearray(vm[:])
+    patched = 0
+    for m in vm.get_methods():
+        triple = (m.get_class_name(),) + m.get_triple()[1:]
+        if triple not in method_triples:
+            continue
+
+        off = m.offset
+        _, size = read_uleb128(buff, off)  # method_idx_diff
+        flags_off = off + size
+        access_flags, flags_size = read_uleb128(buff, flags_off)
+        _, code_off_size = read_uleb128(buff, flags_off + flags_size)
+
+        if access_flags & ACC_NATIVE:
+            continue
+
+        new_flags = encode_uleb128(access_flags | ACC_NATIVE)
+        room = flags_size + code_off_size
+        if len(new_flags) >= room:
+            raise Exception('no room to patch method %s' % '%s->%s%s' % triple)
+
+        buff[flags_off:flags_off + room] = new_flags + encode_uleb128(0, room - len(new_flags))
+        patched += 1
+
+    fix_checksums(buff)
+    return buff, patched
@@ -0,0 +1,113 @@
+# encoding=utf8
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import threading
+
+logger = logging.getLogger('dex2c.profiling')
+
+# Bumped whenever a field of the report changes meaning or goes away
+SCHEMA_VERSION = 1
+
+# Steps of the compilation of a method, as recorded by IrBuilder
+METHOD_STEPS = ('ir', 'infer_type', 'write')
+IR_SIZES = ('blocks', 'instructions', 'phis')
+
+TOP_METHODS = 20
+
+
+class CompileProfile(object):
+    """
+    Statistics of the methods compiled by a compile_dex run.
+    """
+
+    def __init__(self):
+        self.methods = {}
+        self.cached = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def add(self, name, stats, error=None):
+        with self.lock:
+            if error:
+                self.failed += 1
+            elif stats is None:
+                self.cached += 1
+            else:
+                self.methods[name] = stats
+
+    def as_dict(self, top=TOP_METHODS):
+        steps = dict((step, sum(s.get(step, 0.0) for s in self.methods.values())) for step in METHOD_STEPS)
+        methods = []
+        for name in sorted(self.methods):
+            stats = self.methods[name]
+            entry = {'method': name, 'time': stats.get('time', 0.0)}
+            for key in METHOD_STEPS + IR_SIZES:
+                entry[key] = stats.get(key, 0)
+            entry['jni_density'] = stats['jni']['density'] if stats.get('jni') else 0.0
+            methods.append(entry)
+        slowest = sorted(methods, key=lambda m: (-m['time'], m['method']))[:top]
+        return {
+            'compiled': len(self.methods),
+            'cached': self.cached,
+            'failed': self.failed,
+            # summed over the methods, whatever the process they were compiled in
+            'time': sum(m['time'] for m in methods),
+            'steps': steps,
+            'slowest': [m['method'] for m in slowest],
+            'methods': methods,
+        }
+
+
+def cache_counters(cache):
+    if cache is None:
+        return None
+    return cache.hits, cache.misses, cache.evicted
+
+
+def cache_stats(cache, before):
+    """
+    Lookups of `cache` since its counters were `before`, caches of a dcc server being
+    shared by its jobs.
+    """
+    if cache is None:
+        return None
+    hits, misses, evicted = [now - then for now, then in zip(cache_counters(cache), before)]
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': float(hits) / lookups if lookups else 0.0,
+        'evicted': evicted,
+    }
+
+
+def make_report(infile, stages, profile, cache=None, top=TOP_METHODS):
+    summary = stages.summary()
+    return {
+        'schema': SCHEMA_VERSION,
+        'input': infile,
+        'wall': summary['wall'],
+        'phases': stages.phases(),
+        'critical_path': summary['critical_path'],
+        'methods': profile.as_dict(top),
+        'cache': cache,
+    }
+
+
+def write_report(path, report):
+    with open(path, 'w') as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+    logger.info('profile report written to %s' % path)
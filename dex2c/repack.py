@@ -0,0 +1,279 @@
+# encoding=utf8
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import struct
+import zipfile
+import zlib
+
+logger = logging.getLogger('dex2c.repack')
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_OF_CENTRAL_DIR = struct.Struct('<IHHHHIIH')
+
+LOCAL_HEADER_SIG = 0x04034b50
+CENTRAL_HEADER_SIG = 0x02014b50
+END_OF_CENTRAL_DIR_SIG = 0x06054b50
+
+# Extra field used by apksigner/zipalign to pad the data of stored entries
+ALIGNMENT_EXTRA_ID = 0xd935
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+# 1981-01-01 00:00:00, the timestamp of entries added to the APK
+DEFAULT_DOS_TIME = (1981, 1, 1, 0, 0, 0)
+
+COPY_CHUNK = 1024 * 1024
+
+
+def dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    dostime = hour << 11 | minute << 5 | second // 2
+    dosdate = (year - 1980) << 9 | month << 5 | day
+    return dostime, dosdate
+
+
+def encode_filename(name):
+    try:
+        return name.encode('ascii'), 0
+    except UnicodeEncodeError:
+        return name.encode('utf-8'), FLAG_UTF8
+
+
+def strip_alignment_extra(extra):
+    """
+    Drop a previous alignment padding from the local extra field of an entry.
+    """
+    out = b''
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, size = struct.unpack_from('<HH', extra, pos)
+        if pos + 4 + size > len(extra):
+            # Not a well-formed extra field (zipalign pads with bare zeros), drop it
+            return out
+        if header_id != ALIGNMENT_EXTRA_ID:
+            out += extra[pos:pos + 4 + size]
+        pos += 4 + size
+    return out
+
+
+def alignment_extra(offset, extra, alignment):
+    """
+    Local extra field for an entry whose header starts at `offset`, so that its data
+    begins on a multiple of `alignment`.
+    """
+    base = offset + len(extra) + 6
+    pad = -base % alignment
+    return extra + struct.pack('<HHH', ALIGNMENT_EXTRA_ID, 2 + pad, alignment) + b'\0' * pad
+
+
+class NewEntry(object):
+    """
+    An entry that does not come from the input APK.
+    """
+
+    def __init__(self, name, data, compress_type=zipfile.ZIP_DEFLATED, date_time=DEFAULT_DOS_TIME,
+                 external_attr=0):
+        self.name = name
+        self.data = data
+        self.compress_type = compress_type
+        self.date_time = date_time
+        self.external_attr = external_attr
+
+
+class ApkRepacker(object):
+    """
+    Write a copy of an APK with some entries replaced, added or dropped.
+
+    Entries that are kept unchanged are copied raw, without being decompressed, in their
+    original order. The data of stored entries is aligned on 4 bytes, and on 4096 bytes
+    for shared libraries so they can be mapped straight from the APK.
+
+    The output is produced in two steps, `write_entries` then `write_central_directory`,
+    so that an APK signing block can be inserted in between.
+    """
+
+    def __init__(self, src_path, replace=None, drop=None):
+        """
+        :param replace: {entry name: NewEntry}, entries not in the input are appended
+        :param drop: predicate on entry names, for entries to leave out
+        """
+        self.src_path = src_path
+        self.replace = dict(replace or {})
+        self.drop = drop
+        self.central_directory = []
+        self.cd_offset = None
+
+    @staticmethod
+    def alignment_for(name):
+        if name.endswith('.so'):
+            return 4096
+        return 4
+
+    def entries(self):
+        """
+        The entries of the output, in order, as (name, ZipInfo of the input entry or None,
+        NewEntry or None) triples.
+        """
+        entries = []
+        pending = dict(self.replace)
+        with zipfile.ZipFile(self.src_path) as zf:
+            for info in zf.infolist():
+                name = info.filename
+                if name in pending:
+                    entries.append((name, info, pending.pop(name)))
+                elif self.drop and self.drop(name):
+                    continue
+                else:
+                    entries.append((name, info, None))
+
+        for name in sorted(pending):
+            entries.append((name, None, pending[name]))
+        return entries
+
+    def write_entries(self, out, head=(), entries=None):
+        """
+        Write the local entries to `out`, starting with the NewEntry list `head`.
+        Returns the offset of the end of the entries.
+        """
+        if entries is None:
+            entries = self.entries()
+
+        self.central_directory = []
+        for entry in head:
+            self._write_new(out, entry)
+
+        with open(self.src_path, 'rb') as src:
+            for name, info, entry in entries:
+                if entry is not None:
+                    self._write_new(out, entry, info)
+                else:
+                    self._copy_raw(out, src, info)
+
+        self.cd_offset = out.tell()
+        return self.cd_offset
+
+    def _copy_raw(self, out, src, info):
+        if info.header_offset >= 0xffffffff or info.compress_size >= 0xffffffff \
+                or info.file_size >= 0xffffffff:
+            raise Exception('zip64 entry %s is not supported' % info.filename)
+
+        src.seek(info.header_offset)
+        header = src.read(LOCAL_HEADER.size)
+        fields = LOCAL_HEADER.unpack(header)
+        if fields[0] != LOCAL_HEADER_SIG:
+            raise Exception('bad local header for %s' % info.filename)
+        name_len, extra_len = fields[9], fields[10]
+        raw_name = src.read(name_len)
+        extra = src.read(extra_len)
+
+        flags = info.flag_bits & ~FLAG_DATA_DESCRIPTOR
+        offset = out.tell()
+        if info.compress_type == zipfile.ZIP_STORED:
+            extra = alignment_extra(offset + LOCAL_HEADER.size + len(raw_name),
+                                    strip_alignment_extra(extra), self.alignment_for(info.filename))
+
+        dostime, dosdate = dos_date_time(info.date_time)
+        out.write(LOCAL_HEADER.pack(LOCAL_HEADER_SIG, info.extract_version, flags, info.compress_type,
+                                    dostime, dosdate, info.CRC, info.compress_size, info.file_size,
+                                    len(raw_name), len(extra)))
+        out.write(raw_name)
+        out.write(extra)
+
+        remaining = info.compress_size
+        while remaining:
+            chunk = src.read(min(COPY_CHUNK, remaining))
+            if not chunk:
+                raise Exception('truncated entry %s' % info.filename)
+            out.write(chunk)
+            remaining -= len(chunk)
+
+        self.central_directory.append((info, raw_name, flags, offset))
+
+    def _write_new(self, out, entry, original=None):
+        data = entry.data
+        crc = zlib.crc32(data) & 0xffffffff
+        if entry.compress_type == zipfile.ZIP_STORED:
+            payload = data
+        else:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            payload = compressor.compress(data) + compressor.flush()
+        if len(payload) >= 0xffffffff or len(data) >= 0xffffffff:
+            raise Exception('entry %s is too large' % entry.name)
+
+        info = zipfile.ZipInfo(entry.name, original.date_time if original else entry.date_time)
+        info.compress_type = entry.compress_type
+        info.CRC = crc
+        info.compress_size = len(payload)
+        info.file_size = len(data)
+        info.external_attr = original.external_attr if original else entry.external_attr
+        info.create_system = original.create_system if original else 0
+        info.extract_version = 20 if entry.compress_type == zipfile.ZIP_DEFLATED else 10
+        info.create_version = info.extract_version
+        info.extra = b''
+        info.comment = b''
+
+        raw_name, flags = encode_filename(entry.name)
+        offset = out.tell()
+        extra = b''
+        if entry.compress_type == zipfile.ZIP_STORED:
+            extra = alignment_extra(offset + LOCAL_HEADER.size + len(raw_name), extra,
+                                    self.alignment_for(entry.name))
+
+        dostime, dosdate = dos_date_time(info.date_time)
+        out.write(LOCAL_HEADER.pack(LOCAL_HEADER_SIG, info.extract_version, flags, info.compress_type,
+                                    dostime, dosdate, crc, len(payload), len(data),
+                                    len(raw_name), len(extra)))
+        out.write(raw_name)
+        out.write(extra)
+        out.write(payload)
+
+        self.central_directory.append((info, raw_name, flags, offset))
+
+    def write_central_directory(self, out, cd_offset=None):
+        """
+        Write the central directory and the end of central directory record. `cd_offset`
+        is where the central directory starts, when it is not where the entries end.
+        """
+        if cd_offset is None:
+            cd_offset = out.tell()
+
+        start = out.tell()
+        for info, raw_name, flags, offset in self.central_directory:
+            dostime, dosdate = dos_date_time(info.date_time)
+            out.write(CENTRAL_HEADER.pack(CENTRAL_HEADER_SIG,
+                                          info.create_version | info.create_system << 8,
+                                          info.extract_version, flags, info.compress_type,
+                                          dostime, dosdate, info.CRC, info.compress_size, info.file_size,
+                                          len(raw_name), len(info.extra), len(info.comment),
+                                          0, info.internal_attr, info.external_attr, offset))
+            out.write(raw_name)
+            out.write(info.extra)
+            out.write(info.comment)
+        cd_size = out.tell() - start
+
+        count = len(self.central_directory)
+        if count >= 0xffff:
+            raise Exception('too many entries: %d' % count)
+        out.write(END_OF_CENTRAL_DIR.pack(END_OF_CENTRAL_DIR_SIG, 0, 0, count, count,
+                                          cd_size, cd_offset, 0))
+        return cd_size
+
+    def write(self, out_path):
+        with open(out_path, 'wb') as out:
+            self.write_entries(out)
+            self.write_central_directory(out)
+
@@ -0,0 +1,199 @@
+# encoding=utf8
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import logging
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+
+logger = logging.getLogger('dex2c.server')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job(object):
+    def __init__(self, job_id, params):
+        self.id = job_id
+        self.params = params
+        self.state = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def status(self):
+        now = time.time()
+        return {
+            'id': self.id,
+            'infile': self.params.get('apkfile'),
+            'state': self.state,
+            'queued': (self.started or now) - self.submitted,
+            'wall': (self.finished or now) - self.started if self.started else 0.0,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class DccServer(object):
+    """
+    Long-lived server running dcc jobs on a pool of `workers` threads.
+
+    Requests are dicts sent over a multiprocessing connection (a UNIX socket path, or a
+    (host, port) pair), each answered by a dict:
+
+        {'cmd': 'submit', 'params': {...}} -> {'job': id}
+        {'cmd': 'status', 'job': id}       -> job status, all jobs if no id
+        {'cmd': 'wait', 'job': id}         -> job status once it is finished
+        {'cmd': 'shutdown'}
+
+    Messages are pickled, only clients knowing `authkey` are accepted and a UNIX socket
+    is only accessible to its owner.
+
+    `run_job(params)` does the work of a job and returns its result. `on_idle()` is
+    called whenever the last running job finishes.
+    """
+
+    def __init__(self, address, run_job, authkey, workers=2, on_idle=None):
+        if not authkey:
+            raise Exception('the dcc server needs an authkey')
+        self.address = address
+        self.run_job = run_job
+        self.on_idle = on_idle
+        self.authkey = authkey
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dcc-job')
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.stopping = False
+        self.listener = None
+
+    def serve_forever(self):
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+        # the socket is created without access for the group and the others
+        umask = os.umask(0o077)
+        try:
+            self.listener = Listener(self.address, authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        logger.info('dcc server listening on %s' % (self.address,))
+        try:
+            while not self.stopping:
+                try:
+                    conn = self.listener.accept()
+                except OSError:
+                    if self.stopping:
+                        break
+                    raise
+                except Exception:
+                    logger.warning('rejected connection', exc_info=True)
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self.executor.shutdown(wait=True)
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.unlink(self.address)
+
+    def _handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    response = self._dispatch(request)
+                except Exception as e:
+                    response = {'error': str(e)}
+                conn.send(response)
+
+    def _dispatch(self, request):
+        cmd = request.get('cmd')
+        if cmd == 'submit':
+            return {'job': self.submit(request['params']).id}
+        elif cmd == 'status':
+            if request.get('job') is None:
+                return {'jobs': [job.status() for job in self.jobs.values()]}
+            return self._job(request['job']).status()
+        elif cmd == 'wait':
+            job = self._job(request['job'])
+            job.done.wait()
+            return job.status()
+        elif cmd == 'shutdown':
+            self.shutdown()
+            return {}
+        raise Exception('unknown command %s' % cmd)
+
+    def _job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise Exception('no job %s' % job_id)
+        return job
+
+    def submit(self, params):
+        with self.lock:
+            job = Job(next(self.ids), params)
+            self.jobs[job.id] = job
+        logger.info('job %d queued: %s' % (job.id, params.get('apkfile')))
+        self.executor.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        with self.lock:
+            self.active += 1
+        job.state = RUNNING
+        job.started = time.time()
+        try:
+            job.result = self.run_job(job.params)
+            job.state = DONE
+        except Exception:
+            job.error = traceback.format_exc()
+            job.state = FAILED
+            logger.error('job %d failed' % job.id, exc_info=True)
+        finally:
+            job.finished = time.time()
+            logger.info('job %d %s in %.2fs' % (job.id, job.state, job.finished - job.started))
+            job.done.set()
+            with self.lock:
+                self.active -= 1
+                idle = self.active == 0
+            if idle and self.on_idle:
+                self.on_idle()
+
+    def shutdown(self):
+        self.stopping = True
+        # wake up accept()
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except Exception:
+            pass
+
+
+def request(address, message, authkey):
+    with Client(address, authkey=authkey) as conn:
+        conn.send(message)
+        response = conn.recv()
+    if 'error' in response and len(response) == 1:
+        raise Exception(response['error'])
+    return response
@@ -0,0 +1,270 @@
+# encoding=utf8
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import hashlib
+import io
+import logging
+import os
+import struct
+import threading
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+from asn1crypto import cms, x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+
+from dex2c.repack import NewEntry
+
+logger = logging.getLogger('dex2c.signer')
+
+V2_CHUNK_SIZE = 1024 * 1024
+APK_SIGNATURE_SCHEME_V2_BLOCK_ID = 0x7109871a
+APK_SIG_BLOCK_MAGIC = b'APK Sig Block 42'
+
+SIGNATURE_RSA_PKCS1_V1_5_WITH_SHA256 = 0x0103
+SIGNATURE_ECDSA_WITH_SHA256 = 0x0201
+
+# JAR signatures with SHA-256 are only verified from API level 18
+MIN_SDK_VERSION_SHA256 = 18
+
+
+def lp(data):
+    """Length-prefixed value of the v2 signing block"""
+    return struct.pack('<I', len(data)) + data
+
+
+def lp_sequence(items):
+    return lp(b''.join(lp(item) for item in items))
+
+
+def chunk_digest(chunk):
+    return hashlib.sha256(b'\xa5' + struct.pack('<I', len(chunk)) + chunk).digest()
+
+
+def manifest_section(lines):
+    """
+    Encode the `lines` of a manifest section, wrapped at 72 bytes as the JAR format requires.
+    """
+    out = []
+    for line in lines:
+        raw = line.encode('utf-8')
+        out.append(raw[:72])
+        raw = raw[72:]
+        while raw:
+            out.append(b' ' + raw[:71])
+            raw = raw[71:]
+    return b''.join(l + b'\r\n' for l in out) + b'\r\n'
+
+
+class ChunkDigestWriter(object):
+    """
+    File wrapper computing the v2 chunk digests of everything written through it, the
+    digests being computed in `pool` while the writing goes on.
+    """
+
+    def __init__(self, out, pool):
+        self.out = out
+        self.pool = pool
+        self.buff = bytearray()
+        self.pending = []
+
+    def write(self, data):
+        self.out.write(data)
+        self.buff += data
+        while len(self.buff) >= V2_CHUNK_SIZE:
+            self._submit(bytes(self.buff[:V2_CHUNK_SIZE]))
+            del self.buff[:V2_CHUNK_SIZE]
+
+    def tell(self):
+        return self.out.tell()
+
+    def _submit(self, chunk):
+        self.pending.append(self.pool.apply_async(chunk_digest, (chunk,)))
+
+    def digests(self):
+        if self.buff:
+            self._submit(bytes(self.buff))
+            self.buff = bytearray()
+        return [result.get() for result in self.pending]
+
+
+class ApkSigner(object):
+    """
+    Sign APKs with the JAR (v1) and APK Signature Scheme v2 signatures.
+    """
+
+    def __init__(self, key_path, cert_path, jobs=None):
+        with open(key_path, 'rb') as fp:
+            key_data = fp.read()
+        if key_data.startswith(b'-----'):
+            self.key = serialization.load_pem_private_key(key_data, None)
+        else:
+            self.key = serialization.load_der_private_key(key_data, None)
+
+        with open(cert_path, 'rb') as fp:
+            cert_data = fp.read()
+        if cert_data.startswith(b'-----'):
+            cert_data = base64.b64decode(b''.join(
+                line for line in cert_data.splitlines() if line and not line.startswith(b'-----')))
+        self.cert = x509.Certificate.load(cert_data)
+        self.cert_der = self.cert.dump()
+
+        if isinstance(self.key, rsa.RSAPrivateKey):
+            self.key_type = 'RSA'
+        elif isinstance(self.key, ec.EllipticCurvePrivateKey):
+            self.key_type = 'EC'
+        else:
+            raise Exception('unsupported signing key type %s' % type(self.key).__name__)
+
+        self.jobs = jobs or os.cpu_count() or 2
+
+    def _sign(self, data, hash_algorithm):
+        if self.key_type == 'RSA':
+            return self.key.sign(data, padding.PKCS1v15(), hash_algorithm)
+        return self.key.sign(data, ec.ECDSA(hash_algorithm))
+
+    def sign(self, repacker, out_path, min_sdk_version=None):
+        """
+        Write the output of `repacker` to `out_path`, signed. The APK is written once:
+        the v1 digests are computed from the input before the entries are written, and the
+        v2 chunk digests while they are.
+        """
+        pool = ThreadPool(self.jobs)
+        try:
+            entries = repacker.entries()
+            v1_entries = self._v1_signature(repacker, entries, pool, min_sdk_version)
+            with open(out_path, 'wb') as fp:
+                writer = ChunkDigestWriter(fp, pool)
+                cd_offset = repacker.write_entries(writer, v1_entries, entries)
+                entries_digests = writer.digests()
+
+                central_directory = io.BytesIO()
+                repacker.write_central_directory(central_directory, cd_offset)
+                central_directory = central_directory.getvalue()
+                # no archive comment, the end of central directory record is the last 22 bytes
+                cd, eocd = central_directory[:-22], central_directory[-22:]
+
+                signing_block = self._v2_signing_block(entries_digests, cd, eocd, pool)
+                fp.write(signing_block)
+                fp.write(cd)
+                fp.write(eocd[:16] + struct.pack('<I', cd_offset + len(signing_block)) + eocd[20:])
+        finally:
+            pool.close()
+            pool.join()
+
+    def _v1_signature(self, repacker, entries, pool, min_sdk_version):
+        if self.key_type == 'RSA' and min_sdk_version is not None and min_sdk_version < MIN_SDK_VERSION_SHA256:
+            digest_name, hash_algorithm, cms_digest = 'SHA1', hashes.SHA1(), 'sha1'
+        else:
+            digest_name, hash_algorithm, cms_digest = 'SHA-256', hashes.SHA256(), 'sha256'
+        hash_name = hash_algorithm.name
+
+        local = threading.local()
+        opened = []
+
+        def digest_entry(item):
+            name, info, entry = item
+            if entry is not None:
+                data = entry.data
+            else:
+                zf = getattr(local, 'zf', None)
+                if zf is None:
+                    zf = local.zf = zipfile.ZipFile(repacker.src_path)
+                    opened.append(zf)
+                data = zf.read(info)
+            return name, base64.b64encode(hashlib.new(hash_name, data).digest()).decode('ascii')
+
+        files = [item for item in entries if not item[0].endswith('/')]
+        try:
+            digests = sorted(pool.map(digest_entry, files))
+        finally:
+            for zf in opened:
+                zf.close()
+
+        manifest = manifest_section(['Manifest-Version: 1.0', 'Created-By: 1.0 (Android)'])
+        sf_sections = []
+        for name, digest in digests:
+            section = manifest_section(['Name: %s' % name, '%s-Digest: %s' % (digest_name, digest)])
+            manifest += section
+            sf_sections.append(manifest_section([
+                'Name: %s' % name,
+                '%s-Digest: %s' % (digest_name, base64.b64encode(hashlib.new(hash_name, section).digest()).decode('ascii'))]))
+
+        sf = manifest_section([
+            'Signature-Version: 1.0',
+            'Created-By: 1.0 (Android)',
+            '%s-Digest-Manifest: %s' % (digest_name, base64.b64encode(hashlib.new(hash_name, manifest).digest()).decode('ascii')),
+            'X-Android-APK-Signed: 2',
+        ]) + b''.join(sf_sections)
+
+        signature = self._sign(sf, hash_algorithm)
+        if self.key_type == 'RSA':
+            signature_algorithm = 'rsassa_pkcs1v15'
+        else:
+            signature_algorithm = '%s_ecdsa' % cms_digest
+
+        signed_data = cms.SignedData({
+            'version': 'v1',
+            'digest_algorithms': [{'algorithm': cms_digest}],
+            'encap_content_info': {'content_type': 'data'},
+            'certificates': [self.cert],
+            'signer_infos': [{
+                'version': 'v1',
+                'sid': cms.SignerIdentifier({
+                    'issuer_and_serial_number': {
+                        'issuer': self.cert.issuer,
+                        'serial_number': self.cert.serial_number,
+                    }
+                }),
+                'digest_algorithm': {'algorithm': cms_digest},
+                'signature_algorithm': {'algorithm': signature_algorithm},
+                'signature': signature,
+            }],
+        })
+        block = cms.ContentInfo({'content_type': 'signed_data', 'content': signed_data}).dump()
+
+        return [
+            NewEntry('META-INF/MANIFEST.MF', manifest),
+            NewEntry('META-INF/CERT.SF', sf),
+            NewEntry('META-INF/CERT.%s' % self.key_type, block),
+        ]
+
+    def _v2_signing_block(self, entries_digests, cd, eocd, pool):
+        digests = list(entries_digests)
+        for section in (cd, eocd):
+            chunks = [section[i:i + V2_CHUNK_SIZE] for i in range(0, len(section), V2_CHUNK_SIZE)]
+            digests.extend(pool.map(chunk_digest, chunks))
+        content_digest = hashlib.sha256(b'\x5a' + struct.pack('<I', len(digests)) + b''.join(digests)).digest()
+
+        if self.key_type == 'RSA':
+            algorithm = SIGNATURE_RSA_PKCS1_V1_5_WITH_SHA256
+        else:
+            algorithm = SIGNATURE_ECDSA_WITH_SHA256
+
+        signed_data = b''.join([
+            lp_sequence([struct.pack('<I', algorithm) + lp(content_digest)]),
+            lp_sequence([self.cert_der]),
+            lp_sequence([]),
+        ])
+        signature = self._sign(signed_data, hashes.SHA256())
+        public_key = self.key.public_key().public_bytes(serialization.Encoding.DER,
+                                                        serialization.PublicFormat.SubjectPublicKeyInfo)
+        signer = lp(signed_data) + lp_sequence([struct.pack('<I', algorithm) + lp(signature)]) + lp(public_key)
+        value = lp_sequence([signer])
+
+        pair = struct.pack('<QI', 4 + len(value), APK_SIGNATURE_SCHEME_V2_BLOCK_ID) + value
+        block_size = len(pair) + 8 + len(APK_SIG_BLOCK_MAGIC)
+        return struct.pack('<Q', block_size) + pair + struct.pack('<Q', block_size) + APK_SIG_BLOCK_MAGIC
@@ -0,0 +1,206 @@
+# encoding=utf8
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+logger = logging.getLogger('dex2c.stages')
+
+
+def rusage():
+    """
+    (CPU time of the finished child processes, peak RSS of this process and of its
+    largest child in KB), zeros where getrusage is not available.
+    """
+    if resource is None:
+        return 0.0, 0, 0
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return children.ru_utime + children.ru_stime, own.ru_maxrss, children.ru_maxrss
+
+
+class Stage(object):
+    def __init__(self, name, after):
+        self.name = name
+        self.after = after
+        self.future = None
+        self.start = None
+        self.end = None
+        self.cpu = 0.0
+        self.children_cpu = 0.0
+        self.peak_rss = 0
+        self.children_peak_rss = 0
+
+    @property
+    def wall(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+    def result(self):
+        return self.future.result()
+
+
+class StageExecutor(object):
+    """
+    Run the stages of a pipeline in threads, each stage starting as soon as the stages it
+    depends on are done. The heavy lifting of the stages happens in subprocesses (apktool,
+    ndk-build) or process pools, so the threads only have to wait for them.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='dcc-stage')
+        self.origin = time.time()
+
+    def submit(self, name, fn, *args, after=()):
+        stage = Stage(name, list(after))
+        stage.future = self.executor.submit(self._run, stage, fn, args)
+        self.stages.append(stage)
+        return stage
+
+    def _run(self, stage, fn, args):
+        for dep in stage.after:
+            dep.result()
+        stage.start = time.time()
+        cpu = time.thread_time()
+        children_cpu = rusage()[0]
+        try:
+            return fn(*args)
+        finally:
+            stage.end = time.time()
+            stage.cpu = time.thread_time() - cpu
+            end_children_cpu, stage.peak_rss, stage.children_peak_rss = rusage()
+            stage.children_cpu = end_children_cpu - children_cpu
+            logger.info('stage %s done in %.2fs' % (stage.name, stage.wall))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def critical_path(self):
+        """
+        The chain of stages that determined the total wall time: starting from the stage
+        that finished last, follow the dependency that finished last.
+        """
+        done = [s for s in self.stages if s.end is not None]
+        if not done:
+            return []
+        stage = max(done, key=lambda s: s.end)
+        path = [stage]
+        while True:
+            deps = [s for s in stage.after if s.end is not None]
+            if not deps:
+                break
+            stage = max(deps, key=lambda s: s.end)
+            path.append(stage)
+        return path[::-1]
+
+    def summary(self):
+        """
+        Per-stage start and wall times, in seconds, and the critical path.
+        """
+        done = [s for s in self.stages if s.end is not None]
+        return {
+            'wall': max(s.end for s in done) - self.origin if done else 0.0,
+            'stages': [(s.name, s.start - self.origin, s.wall) for s in done],
+            'critical_path': [s.name for s in self.critical_path()],
+        }
+
+    def phases(self):
+        """
+        Timings and resource usage of the finished stages, in seconds and KB. `cpu` is the
+        time of the stage's thread, `children_cpu` that of the child processes that
+        finished while the stage ran, stages running at the same time share them. The
+        peak RSS are the highest seen when the stage finished.
+        """
+        return [{
+            'name': s.name,
+            'start': s.start - self.origin,
+            'wall': s.wall,
+            'cpu': s.cpu,
+            'children_cpu': s.children_cpu,
+            'peak_rss_kb': s.peak_rss,
+            'children_peak_rss_kb': s.children_peak_rss,
+        } for s in self.stages if s.end is not None]
+
+    def report(self):
+        summary = self.summary()
+        if not summary['stages']:
+            return
+        walls = {}
+        for name, start, wall in summary['stages']:
+            walls[name] = wall
+            logger.info('stage %-12s start %7.2fs  wall %7.2fs' % (name, start, wall))
+        path = summary['critical_path']
+        logger.info('critical path: %s (%.2fs of %.2fs wall)' % (
+            ' -> '.join(path), sum(walls[name] for name in path), summary['wall']))
+
+
+class WarmupBuilder(object):
+    """
+    Run `cmds` (ndk-build -k, one per ABI) concurrently in the background each time
+    `batch` more sources have been written, so that the objects of the methods generated
+    so far are already built when the final build starts. Failures of these runs are
+    expected (the sources are not complete yet) and ignored.
+    """
+
+    def __init__(self, cmds, batch=64):
+        self.cmds = cmds
+        self.batch = batch
+        self.pending = 0
+        self.runs = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._loop, name='dcc-warmup', daemon=True)
+        self.thread.start()
+
+    def notify(self, count=1):
+        with self.cond:
+            self.pending += count
+            if self.pending >= self.batch:
+                self.cond.notify()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.stopped and self.pending < self.batch:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                self.pending = 0
+            self.runs += 1
+            logger.debug('warm-up build #%d' % self.runs)
+            procs = [subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                     for cmd in self.cmds]
+            for proc in procs:
+                proc.wait()
+
+    def stop(self):
+        """
+        Wait for the running warm-up build, if any, and stop.
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
+        logger.info('%d warm-up builds' % self.runs)
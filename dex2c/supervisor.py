@@ -0,0 +1,212 @@
+# encoding=utf8
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import multiprocessing
+import time
+from collections import deque
+from multiprocessing.connection import wait
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+logger = logging.getLogger('dex2c.supervisor')
+
+
+def address_space():
+    """
+    Bytes of address space of this process, 0 where it is not known.
+    """
+    if resource is None:
+        return 0
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[0]) * resource.getpagesize()
+    except (IOError, ValueError):
+        return 0
+
+
+def limit_memory(size):
+    """
+    Let this process allocate at most `size` more bytes of address space. Not
+    enforced where setrlimit is not available.
+    """
+    if size is None or resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    # a forked worker starts with the address space of its parent
+    limit = address_space() + size
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _worker_main(conn, work, initializer, initargs, memory_limit):
+    if initializer is not None:
+        initializer(*initargs)
+    base = address_space()
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            return
+        if item is None:
+            return
+        # each item gets the whole budget, whatever the previous ones left allocated
+        limit_memory(memory_limit)
+        result = work(item)
+        # a worker that kept much of the memory of its items, e.g. with a heap
+        # fragmented by a MemoryError, exits after the result and a new one takes its place
+        recycle = memory_limit is not None and address_space() - base > memory_limit // 2
+        conn.send((result, recycle))
+        if recycle:
+            return
+
+
+class Worker(object):
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.item = None
+        self.started = None
+
+    def kill(self):
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+
+
+class Supervisor(object):
+    """
+    Run `work(item)` in `jobs` worker processes, one item at a time per worker. A worker
+    whose item takes more than `timeout` seconds is killed, as is one that dies, and a
+    new one takes its place; `failed(item, reason)` gives the result of such an item.
+    Each item may allocate `memory_limit` bytes, an allocation above it raising
+    MemoryError in the worker. A worker that kept over half of this budget allocated
+    after an item is replaced.
+    """
+
+    def __init__(self, jobs, work, failed, initializer=None, initargs=(), timeout=None, memory_limit=None,
+                 context=None):
+        self.jobs = max(1, jobs)
+        # multiprocessing context starting the workers
+        self.context = context or multiprocessing.get_context()
+        self.work = work
+        self.failed = failed
+        self.initializer = initializer
+        self.initargs = initargs
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.workers = []
+        self.restarted = 0
+
+    def start(self):
+        self.workers = [self._spawn() for _ in range(self.jobs)]
+
+    def _spawn(self):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=_worker_main, daemon=True,
+                                          args=(child_conn, self.work, self.initializer, self.initargs,
+                                                self.memory_limit))
+        process.start()
+        child_conn.close()
+        return Worker(process, conn)
+
+    def _replace(self, worker):
+        worker.kill()
+        self.workers[self.workers.index(worker)] = self._spawn()
+        self.restarted += 1
+        logger.debug('worker %d replaced' % worker.process.pid)
+
+    def _wait(self, busy):
+        timeout = None
+        if self.timeout is not None:
+            now = time.monotonic()
+            timeout = max(0.0, min(w.started + self.timeout for w in busy) - now)
+        return wait([w.conn for w in busy] + [w.process.sentinel for w in busy], timeout)
+
+    def map(self, items):
+        """
+        Yield the result of each of `items`, in the order of `items`.
+        """
+        items = list(items)
+        todo = deque(items)
+        results = {}
+        position = 0
+        if not self.workers:
+            self.start()
+
+        while position < len(items):
+            for worker in list(self.workers):
+                if worker.item is None and todo:
+                    worker.item = todo.popleft()
+                    worker.started = time.monotonic()
+                    try:
+                        worker.conn.send(worker.item)
+                    except OSError:
+                        # the worker died while idle, the item goes to the new one
+                        todo.appendleft(worker.item)
+                        worker.item = None
+                        self._replace(worker)
+
+            busy = [w for w in self.workers if w.item is not None]
+            if not busy:
+                continue
+            ready = self._wait(busy)
+            now = time.monotonic()
+            for worker in busy:
+                if worker.conn in ready or worker.process.sentinel in ready:
+                    try:
+                        # a result may have been sent just before the worker exited
+                        if worker.conn.poll():
+                            results[worker.item], recycle = worker.conn.recv()
+                            worker.item = None
+                            if recycle:
+                                self._replace(worker)
+                            continue
+                    except (EOFError, OSError):
+                        pass
+                    worker.process.join()
+                    reason = 'compiler process died (exit code %s)' % worker.process.exitcode
+                elif self.timeout is not None and now - worker.started >= self.timeout:
+                    reason = 'timed out after %gs' % self.timeout
+                else:
+                    continue
+                results[worker.item] = self.failed(worker.item, reason)
+                self._replace(worker)
+
+            while position < len(items) and items[position] in results:
+                yield results.pop(items[position])
+                position += 1
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in self.workers:
+            worker.process.join(1)
+            worker.kill()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
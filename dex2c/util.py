@@ -16,6 +16,7 @@
 # limitations under the License.
 
 import logging
+import sys
 
 logger = logging.getLogger('dex2c.util')
 
@@ -197,7 +198,7 @@ def get_type(atype, size=None):
     res = TYPE_DESCRIPTOR.get(atype)
     if res is None:
         if atype[0] == 'L':
-            res = atype[1:-1]
+            res = sys.intern(atype[1:-1])
         elif atype[0] == '[':
             res = atype
         else:
@@ -234,7 +235,8 @@ def get_params_type(descriptor):
     """
     params = descriptor.split(')')[0][1:].split()
     if params:
-        return [param for param in params]
+        # shared by all the values typed from the descriptor
+        return [sys.intern(param) for param in params]
     return []
 
 
@@ -568,7 +568,6 @@ class Writer(object):
     def visit_move_exception(self, ins, var):
         self.write_trace(ins)
         self.write_kill_local_reference(var)
-        var.declared = True
         var.visit(self)
         self.write(' = exception;\n')
 
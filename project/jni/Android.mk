@@ -1,5 +1,10 @@
 LOCAL_PATH:= $(call my-dir)
 
+# Optional compiler launcher (e.g. ccache), passed by dcc.py as DCC_COMPILER_LAUNCHER=...
+ifneq ($(DCC_COMPILER_LAUNCHER),)
+NDK_CCACHE := $(DCC_COMPILER_LAUNCHER)
+endif
+
 include $(CLEAR_VARS)
 LOCAL_MODULE    := nc
 LOCAL_LDLIBS    := -llog
@@ -0,0 +1,137 @@
+import unittest
+
+from dex2c.analyses import (CFG_ANALYSES, DOMINATORS, LOOPS, RPO, AnalysisManager, DominatorTree, LoopForest,
+                            preserves)
+from dex2c.graph import Graph
+
+
+class Node(object):
+    def __init__(self, num):
+        self.id = -1
+        self.num = num
+        self.start = num
+
+    def __repr__(self):
+        return 'Node(%d)' % self.num
+
+
+def make_graph(count, edges):
+    graph = Graph()
+    nodes = [Node(i) for i in range(count)]
+    for node in nodes:
+        graph.add_node(node)
+    for a, b in edges:
+        graph.add_edge(nodes[a], nodes[b])
+    graph.entry = nodes[0]
+    return graph, nodes
+
+
+def nested_loops():
+    # 0 -> 1 outer header -> 2 inner header -> 3 -> 2, 3 -> 4 -> 1, 1 -> 5 exit
+    return make_graph(6, [(0, 1), (1, 2), (2, 3), (3, 2), (3, 4), (4, 1), (1, 5)])
+
+
+class DominatorTreeTest(unittest.TestCase):
+    def test_diamond(self):
+        graph, nodes = make_graph(4, [(0, 1), (0, 2), (1, 3), (2, 3)])
+        dominators = DominatorTree(graph)
+
+        self.assertEqual(dominators.immediate_dominator(nodes[3]), nodes[0])
+        for node in nodes:
+            self.assertTrue(dominators.dominates(nodes[0], node))
+            self.assertTrue(dominators.dominates(node, node))
+        self.assertFalse(dominators.dominates(nodes[1], nodes[3]))
+        self.assertFalse(dominators.dominates(nodes[2], nodes[3]))
+        self.assertFalse(dominators.dominates(nodes[3], nodes[0]))
+
+    def test_unreachable(self):
+        graph, nodes = make_graph(3, [(0, 1)])
+        dominators = DominatorTree(graph)
+
+        self.assertNotIn(nodes[2], dominators)
+        self.assertFalse(dominators.dominates(nodes[0], nodes[2]))
+
+
+class LoopForestTest(unittest.TestCase):
+    def test_nested_loops(self):
+        graph, nodes = nested_loops()
+        loops = LoopForest(graph, DominatorTree(graph))
+
+        self.assertEqual(len(loops), 2)
+        self.assertEqual([loops.depth(node) for node in nodes], [0, 1, 2, 2, 1, 0])
+        outer, inner = loops.loop_of(nodes[4]), loops.loop_of(nodes[3])
+        self.assertEqual(outer.header, nodes[1])
+        self.assertEqual(inner.header, nodes[2])
+        self.assertEqual(outer.body, set(nodes[1:5]))
+        self.assertEqual(inner.body, {nodes[2], nodes[3]})
+        self.assertIs(inner.parent, outer)
+        self.assertEqual(inner.depth, 2)
+        self.assertEqual(loops.roots, [outer])
+        self.assertIsNone(loops.loop_of(nodes[5]))
+
+
+class AnalysisManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.graph, self.nodes = nested_loops()
+        self.analyses = AnalysisManager(self.graph)
+
+    def test_cached(self):
+        loops = self.analyses.get(LOOPS)
+        self.assertIs(self.analyses.get(LOOPS), loops)
+        self.assertTrue(self.analyses.is_cached(DOMINATORS))
+        self.analyses.get(DOMINATORS)
+        self.assertEqual(self.analyses.computed[LOOPS], 1)
+        self.assertEqual(self.analyses.computed[DOMINATORS], 1)
+
+    def test_preserved(self):
+        @preserves(*CFG_ANALYSES)
+        def keep():
+            pass
+
+        dominators = self.analyses.get(DOMINATORS)
+        self.analyses.get(LOOPS)
+        self.analyses.run(keep)
+        self.assertTrue(self.analyses.is_cached(LOOPS))
+        self.assertIs(self.analyses.get(DOMINATORS), dominators)
+        self.assertEqual(self.analyses.computed[DOMINATORS], 1)
+
+    def test_edit_invalidates(self):
+        nodes = self.nodes
+
+        def enter_inner_loop():
+            # 3 is entered from 0 too: 2 no longer dominates it, and 3 -> 2 is no
+            # longer a back edge
+            self.graph.add_edge(nodes[0], nodes[3])
+
+        self.assertTrue(self.analyses.get(DOMINATORS).dominates(nodes[2], nodes[3]))
+        self.assertEqual(self.analyses.get(LOOPS).depth(nodes[3]), 2)
+        self.analyses.get(RPO)
+        self.analyses.run(enter_inner_loop)
+        for name in CFG_ANALYSES:
+            self.assertFalse(self.analyses.is_cached(name))
+
+        dominators = self.analyses.get(DOMINATORS)
+        self.assertEqual(self.analyses.computed[DOMINATORS], 2)
+        self.assertFalse(dominators.dominates(nodes[2], nodes[3]))
+        self.assertEqual(dominators.immediate_dominator(nodes[3]), nodes[0])
+        self.assertEqual(self.analyses.get(LOOPS).depth(nodes[3]), 0)
+
+    def test_dropped_dependency(self):
+        # loops are built on the dominators, they go with them
+        @preserves(RPO, LOOPS)
+        def edit():
+            pass
+
+        self.analyses.get(LOOPS)
+        self.analyses.get(RPO)
+        self.analyses.run(edit)
+        self.assertTrue(self.analyses.is_cached(RPO))
+        self.assertFalse(self.analyses.is_cached(DOMINATORS))
+        self.assertFalse(self.analyses.is_cached(LOOPS))
+        self.analyses.get(LOOPS)
+        self.assertEqual(self.analyses.computed[LOOPS], 2)
+        self.assertEqual(self.analyses.computed[DOMINATORS], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import struct
+import unittest
+
+from androguard.core.bytecodes.dvm import FillArrayData, PackedSwitch, SparseSwitch
+
+from dex2c.cache import method_cache_key
+
+
+class FakeBC(object):
+    def __init__(self, instructions):
+        self.instructions = instructions
+
+    def get_instructions(self):
+        return iter(self.instructions)
+
+
+class FakeCode(object):
+    def __init__(self, instructions):
+        self.bc = FakeBC(instructions)
+
+    def get_registers_size(self):
+        return 2
+
+    def get_ins_size(self):
+        return 1
+
+    def get_outs_size(self):
+        return 0
+
+    def get_bc(self):
+        return self.bc
+
+    def get_tries(self):
+        return []
+
+    def get_handlers(self):
+        return None
+
+
+class FakeMethod(object):
+    def __init__(self, instructions):
+        self.code = FakeCode(instructions)
+
+    def get_class_name(self):
+        return 'LTest;'
+
+    def get_name(self):
+        return 'test'
+
+    def get_descriptor(self):
+        return '(I)V'
+
+    def get_access_flags(self):
+        return 0x9
+
+    def get_code(self):
+        return self.code
+
+
+def packed_switch(first_key, targets):
+    return PackedSwitch(struct.pack('=HHi', 0x100, len(targets), first_key) +
+                        b''.join(struct.pack('=l', t) for t in targets))
+
+
+def sparse_switch(keys, targets):
+    return SparseSwitch(struct.pack('=HH', 0x200, len(keys)) +
+                        b''.join(struct.pack('=l', k) for k in keys) +
+                        b''.join(struct.pack('=l', t) for t in targets))
+
+
+def fill_array_data(width, data):
+    return FillArrayData(struct.pack('=HHI', 0x300, width, len(data) // width) + data)
+
+
+class MethodCacheKeyTest(unittest.TestCase):
+    def key(self, payload):
+        return method_cache_key(FakeMethod([payload]), False)
+
+    def test_packed_switch_targets(self):
+        self.assertEqual(self.key(packed_switch(0, [10, 20])), self.key(packed_switch(0, [10, 20])))
+        self.assertNotEqual(self.key(packed_switch(0, [10, 20])), self.key(packed_switch(0, [20, 10])))
+
+    def test_sparse_switch_targets(self):
+        self.assertNotEqual(self.key(sparse_switch([1, 5], [10, 20])), self.key(sparse_switch([1, 5], [20, 10])))
+        self.assertNotEqual(self.key(sparse_switch([1, 5], [10, 20])), self.key(sparse_switch([1, 6], [10, 20])))
+
+    def test_fill_array_data(self):
+        self.assertNotEqual(self.key(fill_array_data(1, b'\x01\x02\x03\x04')),
+                            self.key(fill_array_data(2, b'\x01\x02\x03\x04')))
+        self.assertNotEqual(self.key(fill_array_data(2, b'\x01\x02\x03\x04')),
+                            self.key(fill_array_data(2, b'\x01\x02\x03\x05')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import threading
+import time
+import unittest
+
+from dex2c.distributed import Coordinator, run_worker
+
+AUTHKEY = b'test'
+
+
+def results(indexes):
+    return [('code%d' % i, 'prototype', None, None) for i in indexes]
+
+
+class CoordinatorTest(unittest.TestCase):
+    def compile(self, compile_unit, count, **kwargs):
+        coordinator = Coordinator(('127.0.0.1', 0), [b'dex'], {}, AUTHKEY, unit_size=4, method_timeout=0.5,
+                                  **kwargs)
+        coordinator.start()
+        try:
+            worker = threading.Thread(target=run_worker, args=(coordinator.address, AUTHKEY, compile_unit),
+                                      kwargs={'retry_interval': 0.1})
+            worker.daemon = True
+            worker.start()
+            return list(coordinator.compile(range(count)))
+        finally:
+            coordinator.close()
+
+    def test_slow_load(self):
+        # loading the dex files takes longer than the deadline of a unit
+        def compile_unit(key, fetch, indexes, loaded):
+            fetch()
+            time.sleep(1.5)
+            loaded()
+            return results(indexes)
+
+        self.assertEqual(self.compile(compile_unit, 1, max_attempts=1), results(range(1)))
+
+    def test_hanging_method(self):
+        hung = []
+
+        def compile_unit(key, fetch, indexes, loaded):
+            loaded()
+            if 3 in indexes and not hung:
+                hung.append(indexes)
+                time.sleep(2)
+            return results(indexes)
+
+        self.assertEqual(self.compile(compile_unit, 6), results(range(6)))
+        self.assertEqual(hung, [[0, 1, 2, 3]])
+
+    def test_load_timeout(self):
+        def compile_unit(key, fetch, indexes, loaded):
+            time.sleep(1)
+            return results(indexes)
+
+        codes = [code for code, _, _, _ in self.compile(compile_unit, 2, load_timeout=0.3, max_attempts=1)]
+        self.assertEqual(codes, [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
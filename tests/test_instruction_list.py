@@ -0,0 +1,63 @@
+import unittest
+
+from dex2c.basic_blocks import InstructionList
+from dex2c.instruction import Instruction
+
+
+class InstructionListTest(unittest.TestCase):
+    def test_remove(self):
+        first, second = InstructionList(), InstructionList()
+        a, b, c = Instruction(), Instruction(), Instruction()
+        first.append(a)
+        first.append(b)
+        second.append(c)
+
+        with self.assertRaises(ValueError):
+            first.remove(c)
+        first.remove(a)
+        with self.assertRaises(ValueError):
+            first.remove(a)
+        self.assertEqual(list(first), [b])
+        self.assertEqual(len(first), 1)
+        self.assertEqual(list(second), [c])
+
+    def test_insert_before(self):
+        first, second = InstructionList(), InstructionList()
+        a, b, c = Instruction(), Instruction(), Instruction()
+        first.append(a)
+        second.append(b)
+
+        with self.assertRaises(ValueError):
+            first.insert_before(c, b)
+        first.insert_before(c, a)
+        self.assertEqual(list(first), [c, a])
+        with self.assertRaises(ValueError):
+            first.insert_before(c, a)
+        with self.assertRaises(ValueError):
+            second.insert_before(a, b)
+        self.assertEqual(list(first), [c, a])
+        self.assertEqual(list(second), [b])
+
+    def test_append_linked(self):
+        first, second = InstructionList(), InstructionList()
+        a, b = Instruction(), Instruction()
+        first.append(a)
+        first.append(b)
+
+        with self.assertRaises(ValueError):
+            first.append(a)
+        with self.assertRaises(ValueError):
+            second.append(b)
+        self.assertEqual(list(first), [a, b])
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 0)
+
+        # a removed instruction may be appended again
+        first.remove(a)
+        second.append(a)
+        self.assertEqual(list(first), [b])
+        self.assertEqual(list(second), [a])
+
+
+if __name__ == '__main__':
+    unittest.main()
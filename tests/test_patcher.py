@@ -0,0 +1,51 @@
+import hashlib
+import struct
+import unittest
+import zlib
+
+from androguard.core.bytecodes import dvm
+
+from bench.dexgen import CLASS_NAME, build_dex, const_method, loop_method
+from dex2c.patcher import ACC_NATIVE, encode_uleb128, patch_native_methods, read_uleb128
+
+
+class Uleb128Test(unittest.TestCase):
+    def test_padded(self):
+        for value in (0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 0x12345):
+            for size in range(len(encode_uleb128(value)), 6):
+                encoded = encode_uleb128(value, size)
+                self.assertEqual(len(encoded), size)
+                self.assertEqual(read_uleb128(encoded, 0), (value, size))
+
+    def test_too_large(self):
+        with self.assertRaises(ValueError):
+            encode_uleb128(0x4000, 1)
+
+
+class PatchNativeMethodsTest(unittest.TestCase):
+    def test_round_trip(self):
+        vm = dvm.DalvikVMFormat(build_dex([loop_method(10, 'loop'), const_method(10, 'const')]))
+        buff, patched = patch_native_methods(vm, {(CLASS_NAME, 'loop', '(II)I')})
+        self.assertEqual(patched, 1)
+        self.assertEqual(len(buff), len(vm.get_buff()))
+
+        checksum, = struct.unpack('<I', buff[8:12])
+        self.assertEqual(checksum, zlib.adler32(bytes(buff[12:])))
+        self.assertEqual(bytes(buff[12:32]), hashlib.sha1(bytes(buff[32:])).digest())
+
+        methods = dict((m.get_name(), m) for m in dvm.DalvikVMFormat(bytes(buff)).get_methods())
+        self.assertTrue(methods['loop'].get_access_flags() & ACC_NATIVE)
+        self.assertEqual(methods['loop'].get_code_off(), 0)
+        self.assertIsNone(methods['loop'].get_code())
+        self.assertFalse(methods['const'].get_access_flags() & ACC_NATIVE)
+        self.assertNotEqual(methods['const'].get_code_off(), 0)
+
+    def test_already_native(self):
+        vm = dvm.DalvikVMFormat(build_dex([loop_method(10, 'loop')]))
+        buff, _ = patch_native_methods(vm, {(CLASS_NAME, 'loop', '(II)I')})
+        _, patched = patch_native_methods(dvm.DalvikVMFormat(bytes(buff)), {(CLASS_NAME, 'loop', '(II)I')})
+        self.assertEqual(patched, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
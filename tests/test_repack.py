@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from dex2c.repack import LOCAL_HEADER, ApkRepacker, NewEntry
+
+
+def data_offset(zf, info):
+    """
+    Offset of the data of an entry, after its local header.
+    """
+    zf.fp.seek(info.header_offset)
+    fields = LOCAL_HEADER.unpack(zf.fp.read(LOCAL_HEADER.size))
+    return info.header_offset + LOCAL_HEADER.size + fields[9] + fields[10]
+
+
+def raw_data(path, info):
+    with zipfile.ZipFile(path) as zf:
+        start = data_offset(zf, info)
+    with open(path, 'rb') as fp:
+        fp.seek(start)
+        return fp.read(info.compress_size)
+
+
+class ApkRepackerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'in.apk')
+        with zipfile.ZipFile(self.src, 'w') as zf:
+            zf.writestr('AndroidManifest.xml', b'manifest' * 100, zipfile.ZIP_DEFLATED)
+            zf.writestr('classes.dex', b'old dex' * 100, zipfile.ZIP_DEFLATED)
+            zf.writestr('res/raw/a', b'odd', zipfile.ZIP_STORED)
+            zf.writestr('res/raw/bb', b'stored data', zipfile.ZIP_STORED)
+            zf.writestr('lib/x86/libfoo.so', b'\x7fELF' + b'\0' * 100, zipfile.ZIP_STORED)
+            zf.writestr('META-INF/CERT.SF', b'signature', zipfile.ZIP_DEFLATED)
+        self.out = os.path.join(self.tmp, 'out.apk')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def repack(self):
+        replace = {
+            'classes.dex': NewEntry('classes.dex', b'new dex' * 100),
+            'lib/x86/libnc.so': NewEntry('lib/x86/libnc.so', b'\x7fELF native', zipfile.ZIP_STORED),
+        }
+        ApkRepacker(self.src, replace, drop=lambda name: name.startswith('META-INF/')).write(self.out)
+
+    def test_entries(self):
+        self.repack()
+        with zipfile.ZipFile(self.out) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), ['AndroidManifest.xml', 'classes.dex', 'res/raw/a', 'res/raw/bb',
+                                             'lib/x86/libfoo.so', 'lib/x86/libnc.so'])
+            self.assertEqual(zf.read('classes.dex'), b'new dex' * 100)
+            self.assertEqual(zf.read('res/raw/bb'), b'stored data')
+            self.assertEqual(zf.read('lib/x86/libnc.so'), b'\x7fELF native')
+
+    def test_raw_copy(self):
+        self.repack()
+        with zipfile.ZipFile(self.src) as src, zipfile.ZipFile(self.out) as out:
+            for name in ('AndroidManifest.xml', 'res/raw/bb'):
+                self.assertEqual(raw_data(self.src, src.getinfo(name)), raw_data(self.out, out.getinfo(name)))
+                self.assertEqual(src.getinfo(name).CRC, out.getinfo(name).CRC)
+
+    def test_alignment(self):
+        self.repack()
+        with zipfile.ZipFile(self.out) as zf:
+            for info in zf.infolist():
+                if info.compress_type != zipfile.ZIP_STORED:
+                    continue
+                alignment = 4096 if info.filename.endswith('.so') else 4
+                self.assertEqual(data_offset(zf, info) % alignment, 0, info.filename)
+
+    def test_repack_twice(self):
+        # the alignment padding of a repacked APK is replaced, not added to
+        self.repack()
+        again = os.path.join(self.tmp, 'again.apk')
+        ApkRepacker(self.out).write(again)
+        with open(self.out, 'rb') as a, open(again, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import base64
+import hashlib
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+import zipfile
+
+from asn1crypto import cms
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+from dex2c.repack import ApkRepacker
+from dex2c.signer import APK_SIG_BLOCK_MAGIC, APK_SIGNATURE_SCHEME_V2_BLOCK_ID, V2_CHUNK_SIZE, ApkSigner, \
+    chunk_digest
+
+TESTKEY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testkey')
+
+
+def read_lp(buff, pos):
+    """
+    Length-prefixed value at `pos`, and the position after it.
+    """
+    size, = struct.unpack_from('<I', buff, pos)
+    return buff[pos + 4:pos + 4 + size], pos + 4 + size
+
+
+def read_lp_sequence(buff):
+    items = []
+    pos = 0
+    while pos < len(buff):
+        item, pos = read_lp(buff, pos)
+        items.append(item)
+    return items
+
+
+def parse_manifest(data):
+    """
+    Sections of a manifest as lists of unwrapped lines.
+    """
+    sections = []
+    for raw in data.split(b'\r\n\r\n'):
+        if not raw:
+            continue
+        lines = []
+        for line in raw.split(b'\r\n'):
+            if line.startswith(b' '):
+                lines[-1] += line[1:]
+            else:
+                lines.append(line)
+        sections.append([line.decode('utf-8') for line in lines])
+    return sections
+
+
+class ApkSignerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        src = os.path.join(cls.tmp, 'in.apk')
+        with zipfile.ZipFile(src, 'w') as zf:
+            zf.writestr('AndroidManifest.xml', b'manifest' * 100, zipfile.ZIP_DEFLATED)
+            zf.writestr('classes.dex', os.urandom(3 * V2_CHUNK_SIZE // 2), zipfile.ZIP_STORED)
+            zf.writestr('res/raw/a long name to wrap the manifest lines of the signature files.txt', b'x')
+            zf.writestr('META-INF/OLD.SF', b'old signature')
+        cls.path = os.path.join(cls.tmp, 'out.apk')
+        signer = ApkSigner(os.path.join(TESTKEY, 'testkey.pk8'), os.path.join(TESTKEY, 'testkey.x509.pem'))
+        signer.sign(ApkRepacker(src, drop=lambda name: name.startswith('META-INF/')), cls.path)
+        cls.public_key = signer.key.public_key()
+        with open(cls.path, 'rb') as fp:
+            cls.apk = fp.read()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def signing_block(self):
+        """
+        (offset of the signing block, offset of the central directory, v2 signature block)
+        """
+        eocd = self.apk[-22:]
+        self.assertEqual(eocd[:4], b'PK\x05\x06')
+        cd_offset, = struct.unpack_from('<I', eocd, 16)
+        self.assertEqual(self.apk[cd_offset:cd_offset + 4], b'PK\x01\x02')
+
+        self.assertEqual(self.apk[cd_offset - 16:cd_offset], APK_SIG_BLOCK_MAGIC)
+        size, = struct.unpack_from('<Q', self.apk, cd_offset - 24)
+        block_offset = cd_offset - size - 8
+        self.assertEqual(struct.unpack_from('<Q', self.apk, block_offset), (size,))
+
+        pairs = {}
+        pos = block_offset + 8
+        while pos < cd_offset - 24:
+            pair_size, pair_id = struct.unpack_from('<QI', self.apk, pos)
+            pairs[pair_id] = self.apk[pos + 12:pos + 8 + pair_size]
+            pos += 8 + pair_size
+        self.assertEqual(pos, cd_offset - 24)
+        return block_offset, cd_offset, pairs[APK_SIGNATURE_SCHEME_V2_BLOCK_ID]
+
+    def test_zip(self):
+        with zipfile.ZipFile(self.path) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertNotIn('META-INF/OLD.SF', zf.namelist())
+
+    def test_v2_block(self):
+        block_offset, cd_offset, v2 = self.signing_block()
+        signer, = read_lp_sequence(read_lp(v2, 0)[0])
+        signed_data, pos = read_lp(signer, 0)
+        signatures, pos = read_lp(signer, pos)
+        public_key, pos = read_lp(signer, pos)
+        self.assertEqual(pos, len(signer))
+        self.assertEqual(public_key, self.public_key.public_bytes(serialization.Encoding.DER,
+                                                                  serialization.PublicFormat.SubjectPublicKeyInfo))
+
+        algorithm_signature, = read_lp_sequence(signatures)
+        algorithm, = struct.unpack_from('<I', algorithm_signature)
+        signature, _ = read_lp(algorithm_signature, 4)
+        self.public_key.verify(signature, signed_data, padding.PKCS1v15(), hashes.SHA256())
+
+        digests, pos = read_lp(signed_data, 0)
+        algorithm_digest, = read_lp_sequence(digests)
+        self.assertEqual(struct.unpack_from('<I', algorithm_digest), (algorithm,))
+        content_digest, _ = read_lp(algorithm_digest, 4)
+
+        # the digest covers the end of central directory with the offset it had before
+        # the signing block was inserted
+        eocd = self.apk[-22:-6] + struct.pack('<I', block_offset) + self.apk[-2:]
+        chunks = []
+        for section in (self.apk[:block_offset], self.apk[cd_offset:-22], eocd):
+            chunks += [section[i:i + V2_CHUNK_SIZE] for i in range(0, len(section), V2_CHUNK_SIZE)]
+        expected = hashlib.sha256(b'\x5a' + struct.pack('<I', len(chunks)) +
+                                  b''.join(chunk_digest(chunk) for chunk in chunks)).digest()
+        self.assertEqual(content_digest, expected)
+
+    def test_v1_digests(self):
+        with zipfile.ZipFile(self.path) as zf:
+            manifest = zf.read('META-INF/MANIFEST.MF')
+            sf = zf.read('META-INF/CERT.SF')
+            block = zf.read('META-INF/CERT.RSA')
+            entries = dict((name, zf.read(name)) for name in zf.namelist() if not name.startswith('META-INF/'))
+
+        def digest(data):
+            return base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')
+
+        sections = parse_manifest(manifest)
+        names = {}
+        for lines in sections[1:]:
+            self.assertEqual(len(lines), 2)
+            name = lines[0][len('Name: '):]
+            self.assertEqual(lines[1], 'SHA-256-Digest: %s' % digest(entries[name]))
+            names[name] = lines
+        self.assertEqual(sorted(names), sorted(entries))
+
+        sf_sections = parse_manifest(sf)
+        self.assertIn('SHA-256-Digest-Manifest: %s' % digest(manifest), sf_sections[0])
+        self.assertIn('X-Android-APK-Signed: 2', sf_sections[0])
+        raw_sections = manifest.split(b'\r\n\r\n')[1:-1]
+        self.assertEqual(len(raw_sections), len(sf_sections) - 1)
+        for raw, lines in zip(raw_sections, sf_sections[1:]):
+            self.assertEqual(lines[1], 'SHA-256-Digest: %s' % digest(raw + b'\r\n\r\n'))
+
+        signer_info = cms.ContentInfo.load(block)['content']['signer_infos'][0]
+        self.public_key.verify(signer_info['signature'].native, sf, padding.PKCS1v15(), hashes.SHA256())
+
+    @unittest.skipUnless(shutil.which('apksigner'), 'apksigner is not installed')
+    def test_apksigner_verify(self):
+        subprocess.check_call(['apksigner', 'verify', '--min-sdk-version', '24', self.path])
+
+
+if __name__ == '__main__':
+    unittest.main()